@@ -0,0 +1,57 @@
+"""
+Settings used by the benchmarks, in place of the project's settings.py.  Local paths point into fixtures/.
+"""
+import os
+
+_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+STAGING_HOST = ["bench-host"]
+PRODUCTION_HOST = ["bench-host"]
+PROJECT_USER = "bench"
+SUDO_USER = "bench"
+PROJECT_NAME = "bench"
+PROJECT_ROOT = "/home/bench/"
+
+MODULES = ["modules.os",
+           "modules.db",
+           "modules.packages",
+           "modules.django",
+           "modules.web",
+           "modules.supervisor"]
+
+OS_PACKAGE_LIST_PATH_REDHAT = os.path.join(_FIXTURES, "yum-packages.txt")
+OS_PACKAGE_LIST_PATH_UBUNTU = os.path.join(_FIXTURES, "apt-packages.txt")
+
+PACKAGES_PIP_REQUIREMENTS_PATH = os.path.join(_FIXTURES, "pip-requires.txt")
+
+DJANGO_GIT_REPO_URL = "git://example.com/bench.git"
+DJANGO_STAGING_GIT_BRANCH = "develop"
+DJANGO_STAGING_SERVER_NAME = "staging.example.com"
+DJANGO_PRODUCTION_GIT_BRANCH = "master"
+DJANGO_PRODUCTION_SERVER_NAME = "production.example.com"
+DJANGO_GUNICORN_PORT = '9010'
+DJANGO_LOCALSETTINGS_LOCAL_PATH = os.path.join(_FIXTURES, "localsettings.py")
+DJANGO_LOCALSETTINGS_TEMPLATE_DICT = {}
+DJANGO_LOCALSETTINGS_REMOTE_DESTINATION = "bench/localsettings.py"
+DJANGO_LOCALSETTINGS_NO_TEMPLATE = True
+
+WEB_HTTPD = "apache"
+WEB_CONFIG_TEMPLATE_PATH = os.path.join(_FIXTURES, "apache.conf")
+WEB_PARAM_DICT = {
+    "HOST_PORT": 80
+}
+
+SUPERVISOR_TEMPLATE_PATH = os.path.join(_FIXTURES, "supervisor.conf")
+SUPERVISOR_INIT_TEMPLATE = os.path.join(_FIXTURES, "supervisor-init")
+SUPERVISOR_DICT = {
+    "gunicorn_port": DJANGO_GUNICORN_PORT,
+    "gunicorn_workers": 3,
+    "project": PROJECT_NAME,
+}
+
+DB_DATABASE_NAME = "bench"
+DB_DATABASE_USER = "bench"
+DB_ALTERNATE_LOCATION = "/opt/data/"
+DB_MOVE_DB_AT_BOOTSTRAP = False
+
+FACTS_CACHE_TTL = 0 #never read or write the facts cache of the machine running the benchmarks
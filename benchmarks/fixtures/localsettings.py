@@ -0,0 +1,2 @@
+DEBUG = False
+DATABASES = {}
@@ -0,0 +1,202 @@
+"""
+Benchmarks for the deploy tools modules.
+
+Runs ``bootstrap`` and ``deploy`` of every module in modules/ against a stand-in host (a plan mode recorder, see
+modules/recorder.py: nothing is sent over the network) and records, per module and operating method, how many round trips to the host it made, how
+many bytes it sent/received and how long it took.  The numbers are compared with the baselines in baselines.json, and
+the run fails if any of them got worse by more than the threshold.
+
+Run it from the root of deploy tools::
+
+    $ python benchmarks/run.py                      #compare with the baselines
+    $ python benchmarks/run.py --update-baselines   #after a change that is meant to change the numbers
+    $ python benchmarks/run.py --rtt 0.05 modules.django modules.web   #with 50ms per round trip, two modules only
+
+Round trips and bytes are exact, so any increase beyond ``--threshold`` is a regression.  Wall time depends on the
+machine, so it has a threshold of its own (``--time-threshold``) and is only compared when both runs used the same
+``--rtt``.
+"""
+import os
+import sys
+import json
+import time
+import optparse
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, 'benchmarks')
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+OPERATING_METHODS = ('bootstrap', 'deploy')
+MIN_TIME_DIFFERENCE = 0.05 #wall time differences smaller than this (in seconds) are noise
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT)
+import bench_settings
+sys.modules['settings'] = bench_settings #the modules do 'import settings'
+
+from fabric.api import env
+from modules.recorder import Recorder
+
+
+def _module_names():
+    """
+    The modules in modules/ that have a bootstrap or deploy method (found without importing them).
+    """
+    names = []
+    folder = os.path.join(ROOT, 'modules')
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.py') or filename.startswith('_'):
+            continue
+        with open(os.path.join(folder, filename)) as f:
+            source = f.read()
+        if any('\ndef %s(' % method in source for method in OPERATING_METHODS):
+            names.append('modules.%s' % filename[:-3])
+    return names
+
+def _reset(env_backup):
+    """
+    Forgets everything the previous run left behind, so each one starts from scratch.
+    """
+    env.clear()
+    env.update(env_backup)
+    for name, attribute in (('modules.facts', '_probed'), ('modules.utils', '_installed_packages'),
+                            ('modules.uploads', '_checksums'), ('modules.context', '_contexts'),
+                            ('modules.ledger', '_ledgers'), ('modules.ledger', '_pending')):
+        module = sys.modules.get(name)
+        if module is not None:
+            getattr(module, attribute).clear()
+
+def run_benchmarks(names, rtt=0.0, repeat=1, verbose=False):
+    """
+    Returns {module: {method: {'round_trips', 'bytes', 'wall_time'} or {'error'}}}.
+    """
+    import fabfile
+    from modules import context, ledger
+    remote = Recorder(fake=True, rtt=rtt)
+    remote.install()
+    fabfile.staging() #the env a 'fab staging ...' run starts with
+    env.host_string = 'bench-host'
+    env_backup = dict(env)
+    results = {}
+    try:
+        for name in names:
+            module = __import__(name, fromlist=['*'])
+            for method in OPERATING_METHODS:
+                if not hasattr(module, method):
+                    continue
+                best = None
+                for i in range(repeat):
+                    _reset(env_backup)
+                    remote.calls = []
+                    buf = StringIO()
+                    real_stdout = sys.stdout
+                    sys.stdout = buf
+                    start = None
+                    try:
+                        remote.module = 'fabfile' #the context (and the host's facts) are worked out once per host, not per module
+                        ctx = context.resolve('staging')
+                        remote.module = name
+                        start = time.time()
+                        fabfile._call(module, method, ctx, (), {'deploy_level': 'staging'}) #as the fabfile calls it
+                        ledger.flush(ctx) #as the fabfile does when the host is done
+                        error = None
+                    except (Exception, SystemExit), e:
+                        error = '%s: %s' % (e.__class__.__name__, e)
+                    finally:
+                        sys.stdout = real_stdout
+                    elapsed = time.time() - (start or time.time())
+                    if verbose or error:
+                        print buf.getvalue()
+                    if error:
+                        best = {'error': error}
+                        break
+                    stats = remote.stats().get(name, {'round_trips': 0, 'bytes': 0})
+                    if best is None or elapsed < best['wall_time']:
+                        best = {'round_trips': stats['round_trips'], 'bytes': stats['bytes'], 'wall_time': round(elapsed, 4)}
+                results.setdefault(name, {})[method] = best
+    finally:
+        remote.uninstall()
+    return results
+
+def compare(results, baselines, threshold, time_threshold, rtt):
+    """
+    Returns a list of regressions (as strings).
+    """
+    regressions = []
+    for name in sorted(results):
+        for method, result in sorted(results[name].items()):
+            base = baselines.get('results', {}).get(name, {}).get(method)
+            if base is None:
+                continue
+            if 'error' in result:
+                if 'error' not in base:
+                    regressions.append('%s.%s now fails: %s' % (name, method, result['error']))
+                continue
+            if 'error' in base:
+                continue
+            for metric in ('round_trips', 'bytes'):
+                if result[metric] > base[metric] * (1 + threshold):
+                    regressions.append('%s.%s %s: %s -> %s' % (name, method, metric, base[metric], result[metric]))
+            if baselines.get('rtt') == rtt and result['wall_time'] - base['wall_time'] > MIN_TIME_DIFFERENCE \
+               and result['wall_time'] > base['wall_time'] * (1 + time_threshold):
+                regressions.append('%s.%s wall_time: %.3fs -> %.3fs' % (name, method, base['wall_time'], result['wall_time']))
+    return regressions
+
+def print_table(results, baselines):
+    print '%-24s %-10s %12s %12s %10s' % ('module', 'method', 'round trips', 'bytes', 'wall time')
+    for name in sorted(results):
+        for method, result in sorted(results[name].items()):
+            if 'error' in result:
+                print '%-24s %-10s %s' % (name, method, result['error'])
+                continue
+            base = baselines.get('results', {}).get(name, {}).get(method) or {}
+            def cell(metric, fmt):
+                value = fmt % result[metric]
+                if metric in base and fmt % base[metric] != value:
+                    value += ' (%s)' % (fmt % base[metric])
+                return value
+            print '%-24s %-10s %12s %12s %10s' % (name, method, cell('round_trips', '%d'), cell('bytes', '%d'),
+                                                 cell('wall_time', '%.3fs'))
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('--update-baselines', action='store_true', help='store this run as the new baselines')
+    parser.add_option('--threshold', type='float', default=0.10,
+                      help='allowed increase of round trips and bytes (default 0.10, i.e. 10%%)')
+    parser.add_option('--time-threshold', type='float', default=0.50,
+                      help='allowed increase of wall time (default 0.50, i.e. 50%%)')
+    parser.add_option('--rtt', type='float', default=0.0, help='seconds each round trip takes (default 0)')
+    parser.add_option('--repeat', type='int', default=3, help='runs per module, the fastest is kept (default 3)')
+    parser.add_option('--baselines', default=BASELINES_PATH, help='baselines file (default benchmarks/baselines.json)')
+    parser.add_option('-v', '--verbose', action='store_true', help="show the modules' output")
+    options, names = parser.parse_args()
+
+    names = names or _module_names()
+    results = run_benchmarks(names, rtt=options.rtt, repeat=options.repeat, verbose=options.verbose)
+    try:
+        with open(options.baselines) as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = {}
+    print_table(results, baselines)
+
+    if options.update_baselines:
+        merged = baselines.get('results', {})
+        merged.update(results)
+        with open(options.baselines, 'w') as f:
+            json.dump({'rtt': options.rtt, 'results': merged}, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print 'Baselines written to %s' % options.baselines
+        return 0
+
+    regressions = compare(results, baselines, options.threshold, options.time_threshold, options.rtt)
+    if regressions:
+        print '\nRegressions:'
+        for regression in regressions:
+            print '  ' + regression
+        return 1
+    print '\nNo regressions.'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
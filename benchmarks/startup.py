@@ -0,0 +1,72 @@
+"""
+Startup time of deploy tools.
+
+Times (in fresh processes, fastest of ``--repeat`` runs) what happens before the first remote command is sent:
+listing the commands, importing the fabfile, and finding out about the modules in ``MODULES`` either by importing
+all of them (what the fabfile used to do) or through the registry (what it does now, see modules/registry.py)::
+
+    $ python benchmarks/startup.py
+    $ python benchmarks/startup.py --repeat 20
+
+Most of ``fab -l`` is fabric (and paramiko) being imported, which deploy tools can't do anything about; the other
+lines show the part that is ours.
+"""
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, 'benchmarks')
+
+#runs with the benchmark settings, as benchmarks/run.py does
+_PRELUDE = ("import sys; sys.path[:0] = [%r, %r]; import bench_settings; sys.modules['settings'] = bench_settings; "
+            % (ROOT, BENCH_DIR))
+
+CASES = [
+    ('python', 'pass'),
+    ('import fabric.api', 'import fabric.api'),
+    ('import fabfile', 'import fabfile'),
+    ('import every module', 'import fabfile; from modules.utils import try_import; '
+                            '[try_import(m) for m in bench_settings.MODULES]'),
+    ('registry, every module', 'import fabfile; from modules import registry; '
+                               '[registry.info(m) for m in bench_settings.MODULES]'),
+    ('registry, load one module', 'import fabfile; from modules import registry; '
+                                  '[registry.info(m) for m in bench_settings.MODULES]; registry.load("modules.django")'),
+]
+
+
+def _time(argv, repeat):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            code = subprocess.call(argv, cwd=ROOT, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if code != 0:
+                return None
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=10, help='runs per case, the fastest is kept (default 10)')
+    parser.add_option('--fab', default=os.path.join(os.path.dirname(sys.executable), 'fab'),
+                      help='the fab script (default: the one next to this python)')
+    options, args = parser.parse_args()
+
+    cases = [(name, [sys.executable, '-c', _PRELUDE + code]) for name, code in CASES]
+    if os.path.exists(os.path.join(ROOT, 'settings.py')):
+        cases.append(('fab -l', [options.fab, '-l']))
+        cases.append(('fab commands', [options.fab, 'commands']))
+
+    print '%-28s %10s' % ('case', 'time')
+    for name, argv in cases:
+        elapsed = _time(argv, options.repeat)
+        print '%-28s %10s' % (name, elapsed is None and 'failed' or '%.1fms' % (elapsed * 1000))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,11 +29,12 @@ Each module has the following operating methods
 The settings file
 =================
 
-A module's operating methods (bootstrap, deploy, start, stop) are special in that they each take care to initialize
-the fabric env object correctly for their module.
+Before the modules run on a host, the settings and the host's facts are worked out once into a context (the
+environment, the project's paths on the host, the host's OS...), which is passed to each module's operating methods
+as ``ctx``.  Contexts can't be changed, so modules don't write to the global fabric env object (see the context
+module, which also shows how a module adds values of its own).
 
-The settings.py file for Deploy Tools allows the user to customize how the fabric env object is configured.  Each
-module has some unique fields that can be specified in the settings file.
+Each module has some unique fields that can be specified in the settings file.
 
 For example, in the :ref:`Django Module <django-module-settings>` the following settings can be configured:
 ::
@@ -48,6 +49,9 @@ For example, in the :ref:`Django Module <django-module-settings>` the following
 
 (Have a look at the settings.py.example file found in the root of this project for an example deployment setup).
 
+Deploy tools logs in to your hosts as ``SUDO_USER`` and keeps using that one SSH connection per host for every
+module, for the whole run.  Modules shouldn't change ``env.user`` (see the connections module).
+
 In addition to providing values for each module's settings, you also need to specify which modules deploy_tools should use,
 by modifying the ``MODULES`` field in settings.py::
 
@@ -60,6 +64,27 @@ by modifying the ``MODULES`` field in settings.py::
 
 As with django, it's possible to author your own modules and plug them into this list.
 
+-------------------
+Module dependencies
+-------------------
+Modules can declare what they need from other modules and what they give to them, with two module level lists::
+
+    REQUIRES = ["os_packages"] #things that must be done before this module runs
+    PROVIDES = ["virtualenv"]  #things this module takes care of
+
+The modules in ``MODULES`` are put in order using these lists (a module always runs after the modules that provide
+what it requires).  Requirements that no module in ``MODULES`` provides are ignored.  A module that doesn't declare
+``REQUIRES`` runs after every module listed before it, and every module listed after it waits for it, so modules
+that predate this behave exactly as they used to.
+
+Modules that don't depend on each other can be run at the same time (for each host), which makes a fresh
+``bootstrap`` a lot quicker (the database is set up while the OS packages are installed, the web server while the
+virtualenv is built).  This is switched off by default, to switch it on add this to your settings.py::
+
+    CONCURRENT_MODULES = True
+
+As with parallel hosts (see below), modules running at the same time can't answer prompts.
+
 
 ====================
 Other Usage Examples
@@ -89,6 +114,118 @@ Deploy_tools makes it possible to run these specific commands while still utiliz
 This will cause the *django* module (specified with the ``module=...`` arg to execute ``do_foo``.  Additional arguments,
 ``extra1`` and ``extra 2`` in this case, are passed on to the special command (``do_foo``) within the module (*django*).
 
+To see which extra commands each module in ``MODULES`` has::
+
+    $ fab commands
+
+Modules are only imported when one of their methods is about to run (see the registry module), so listing commands
+or running a single module doesn't load all of them.
+
+-----------------------------
+Running on many hosts at once
+-----------------------------
+By default each host listed in ``STAGING_HOST``/``PRODUCTION_HOST`` is handled one after the other.  For larger
+fleets the operating methods (and ``run_command``) take a ``parallel`` argument, which is the number of hosts
+that will be worked on at the same time::
+
+    $ fab production deploy:parallel=16
+    $ fab production run_command:do_foo,module=django,parallel=8
+
+Each host runs in its own process.  The output of every host goes to a file of its own (``logs/output/<host>.log``)
+instead of the terminal, which only shows a status line whenever a host moves on to another module, followed by a
+per-host success/failure summary with the last lines of output of the hosts that failed (see the output module).
+
+Note that hosts can't answer prompts in parallel mode, so make sure you're using key based logins (or pass ``-p``
+to fab) and that your sudo user doesn't need to type a password.
+
+---------------
+Rolling deploys
+---------------
+To keep most of a fleet serving during a deploy, give ``deploy`` a batch size (a number of hosts, or a share of
+them)::
+
+    $ fab production deploy:batch=25%
+    $ fab production deploy:batch=2,parallel=2
+
+The hosts are deployed one batch at a time.  After each batch, the app on each of its hosts is restarted (with
+``ROLLING_RESTART_COMMAND``, ``supervisorctl restart all`` by default) and checked (on ``DJANGO_GUNICORN_PORT``) and the deploy halts, leaving the remaining hosts alone, when a host doesn't come back or
+its error rate or latency is above the limits.  A batch may not be so big that fewer than ``ROLLING_MIN_CAPACITY``
+of the hosts keep serving.  See the health module for the settings.
+
+--------------------------
+Deploying at the same time
+--------------------------
+Commands that change a host (``deploy``, ``bootstrap``, ``start``, ``stop``, ``run_command``) take a lock on the
+host first.  When the host is locked, the command waits for it; when several deploys are waiting, only the newest
+one runs once the lock is free, the others leave that host to it.  A burst of deploys thus ends up as two deploys
+instead of one after the other.  Other commands just wait their turn.  When the artifact is distributed (see below),
+the hosts are locked before it's built, and stay locked until the deploy is done with all of them.  See the lock
+module (and ``fab production unlock``).
+
+------------
+Getting logs
+------------
+To get the logs of every host, from a given time on, merged into one file in time order::
+
+    $ fab production collect_logs:since=2h,parallel=8
+
+The logs are filtered and compressed on the hosts, and merged one line at a time (see the logs module).
+
+-------------------------------
+Distributing to large fleets
+-------------------------------
+With ``DISTRIBUTE_FANOUT`` set, ``deploy`` and ``bootstrap`` build the code (as a git bundle) and the wheelhouse
+into one artifact first, upload it to one host and have the hosts relay it to each other in a tree, instead of
+every host getting it over the same uplink (see the distribute module)::
+
+    DISTRIBUTE_FANOUT = 3
+
+-----------------------
+Seeing where time goes
+-----------------------
+Give any of the commands a ``trace`` file to have every remote operation timed::
+
+    $ fab staging deploy:trace=deploy_trace.json
+
+The file can be opened in chrome://tracing or Perfetto, and the slowest steps are listed at the end of the run
+(see the trace module).
+
+Put ``sample`` in front of a command to see, for each step, how busy the CPU, memory, disks and network of the
+hosts were (see the sampler module)::
+
+    $ fab staging sample bootstrap
+
+----------------------------------
+Seeing what a command would do
+----------------------------------
+Put ``plan`` in front of a command to see the remote commands, uploads and probes each module would make, without
+anything being sent to the hosts (and ``record`` to have them listed after a real run, with the redundant ones
+marked)::
+
+    $ fab staging plan deploy
+    $ fab staging record bootstrap:django
+
+See the recorder module.
+
+------------------------
+Skipping unchanged steps
+------------------------
+Slow steps (installing the pip requirements, the OS packages and supervisor, collectstatic) are skipped when their
+inputs (the requirements file, the package list, the commit...) didn't change since they last ran on the host, and
+the time that saved is shown at the end of the run.  Put ``force`` in front of a command to run them anyway::
+
+    $ fab production force:packages.pip_install deploy
+    $ fab production force deploy
+
+See the ledger module (and ``LEDGER_ENABLED``).
+
+--------------------------
+Config files and reloading
+--------------------------
+Config files (the apache conf, the supervisor conf, localsettings) are only uploaded when they differ from what's
+on the host, and apache is only reloaded (supervisor only updated) when its config actually changed.  Before a host
+is worked on, the checksums of every config file the modules manage are fetched in one go (see the uploads module).
+
 ===============
 Fabfile Methods
 ===============
@@ -96,14 +233,18 @@ Fabfile Methods
 """
 
 from fabric.api import *
-from fabric.colors import red
+from fabric.colors import red, green, yellow
 from fabric.contrib import files, console
-from fabric import utils
-from fabric.decorators import hosts
+from fabric import utils, state
+from fabric.decorators import hosts, runs_once
 
-from modules.utils import what_os, try_import
+from modules import connections, uploads, trace, recorder, registry, health, output, lock, sampler, context, ledger
 import settings as deploy_settings
+import math
 import posixpath
+import sys
+import time
+from StringIO import StringIO
 
 
 
@@ -113,7 +254,8 @@ def _setup_env():
     env.home = posixpath.split(env.deploy_root)
     env.deploy_modules = deploy_settings.MODULES
     env.show = ['debug']
-    _setup_paths()
+    env.user = deploy_settings.SUDO_USER #one login (and ssh connection) per host for the whole run
+    connections.install()
 
 def production():
     """ use production environment on remote host"""
@@ -130,80 +272,589 @@ def staging():
     env.deploy_level = 'staging'
     _setup_env()
 
-def _setup_paths():
+def _module_waves(names, infos):
+    """
+    Puts the modules in order using their REQUIRES and PROVIDES lists (as found by the registry).
+
+    Returns a list of 'waves' (lists of module names).  The modules in a wave don't depend on each other,
+    and only depend on modules from earlier waves.
+    """
+    providers = {}
+    for name in names:
+        for provided in infos[name].provides:
+            providers.setdefault(provided, set()).add(name)
+
+    deps = {}
+    barrier = None #last module seen that doesn't declare its requirements
+    for i, name in enumerate(names):
+        if infos[name].requires is None:
+            deps[name] = set(names[:i])
+            barrier = name
+            continue
+        deps[name] = set()
+        for required in infos[name].requires:
+            deps[name].update(providers.get(required, set()))
+        deps[name].discard(name)
+        if barrier is not None:
+            deps[name].add(barrier)
+
+    levels = {}
+    def level(name, path):
+        if name in path:
+            utils.abort('Circular module dependency: %s' % ' -> '.join(path + [name]))
+        if name not in levels:
+            levels[name] = 1 + max([level(d, path + [name]) for d in deps[name]] or [-1])
+        return levels[name]
+
+    waves = []
+    for name in names:
+        l = level(name, [])
+        while len(waves) <= l:
+            waves.append([])
+        waves[l].append(name)
+    return waves
+
+def _call(mod, cmd, ctx, args, kwargs):
+    """
+    Calls a function of a module for the current host.  Functions that take the host's context (see the context
+    module) get it first, extended by the module's ``extend_context()``; the others are called the old way, with a
+    'deploy_level' keyword argument.
     """
-    Creates all the various paths that will be needed
-    in deploying code, populating config templates, etc.
+    if not registry.info(mod.__name__).takes_context(cmd):
+        return getattr(mod, cmd)(*args, **kwargs)
+    kwargs = dict(kwargs)
+    deploy_level = kwargs.pop('deploy_level', None)
+    if ctx is None:
+        ctx = context.resolve(deploy_level)
+    if hasattr(mod, 'extend_context'):
+        ctx = mod.extend_context(ctx)
+    return getattr(mod, cmd)(ctx, *args, **kwargs)
+
+def _run_module_process(mod, cmd, ctx, args, kwargs, queue):
     """
-    # using posixpath to ensure unix style slashes. See bug-ticket: http://code.fabfile.org/attachments/61/posixpath.patch
-    env.project_root = deploy_settings.PROJECT_ROOT
-    env.www_root = posixpath.join(env.project_root,'www',env.environment)
-    env.log_dir = posixpath.join(env.www_root,'log')
-    env.code_root = posixpath.join(env.www_root,'code_root')
-    env.project_media = posixpath.join(env.code_root, 'media')
-    env.project_static = posixpath.join(env.project_root, 'static')
-    env.virtualenv_root = posixpath.join(env.www_root, 'python_env')
-    env.services = posixpath.join(env.project_root, 'services')
+    Body of the child process used to run one module alongside others (see CONCURRENT_MODULES).
+    """
+    state.connections.clear() #don't share the parent's ssh connection
+    buf = StringIO()
+    sys.stdout = sys.stderr = buf
+    result = {'module': mod.__name__, 'ok': True}
+    trace.take_events() #the parent keeps its own
+    try:
+        try:
+            with trace.module_span(mod.__name__, cmd):
+                _call(mod, cmd, ctx, args, kwargs)
+        finally:
+            if ctx is not None:
+                ledger.flush(ctx) #the steps this process ran (see the ledger module)
+    except SystemExit:
+        result['ok'] = False
+    except Exception, e:
+        result['ok'] = False
+        print red('%s: %s' % (e.__class__.__name__, e))
+    result['output'] = buf.getvalue()
+    result['trace'] = trace.take_events()
+    result['skipped'] = ledger.take_skipped()
+    queue.put(result)
+
+def _run_concurrently(mods, cmd, ctx, args, kwargs):
+    """
+    Runs the command on each of the given modules at the same time (one process each), then prints their
+    output one module after the other.
+    """
+    import multiprocessing #only needed with CONCURRENT_MODULES, so not loaded up front
+    queue = multiprocessing.Queue()
+    procs = []
+    for mod in mods:
+        print 'Module is: %s, args: %s, kwargs: %s (running concurrently)' % (mod, args, kwargs)
+        p = multiprocessing.Process(target=_run_module_process, args=(mod, cmd, ctx, args, kwargs, queue))
+        p.start()
+        procs.append(p)
+    results = {}
+    for p in procs:
+        r = queue.get()
+        results[r['module']] = r
+        trace.add_events(r['trace'])
+        ledger.add_skipped(r['skipped'])
+    for p in procs:
+        p.join()
+
+    failed = []
+    for mod in mods:
+        r = results[mod.__name__]
+        print green('---------- Output from %s ----------' % mod.__name__)
+        print r['output']
+        if not r['ok']:
+            failed.append(mod.__name__)
+    if failed:
+        utils.abort('Command "%s" failed in module(s): %s' % (cmd, ', '.join(failed)))
+
+def _load_module(name, cmd):
+    mod = registry.load(name)
+    if mod is None:
+        print red('Failed to import Module: %s. Command "%s" not executed.' % (name, cmd))
+        utils.abort('Failed to import Module: %s. Command "%s" not executed.' % (name, cmd))
+    return mod
+
+def _prefetch_checksums(names, infos, ctx, deploy_level):
+    """
+    Fetches the checksums of the config files the modules manage (see the uploads module) in one round trip.
+    """
+    paths = []
+    for name in names:
+        if infos[name].has('managed_files'):
+            paths.extend(_call(_load_module(name, 'managed_files'), 'managed_files', ctx, (), {'deploy_level': deploy_level}))
+    uploads.prefetch_checksums(paths)
 
-def run_command(cmd,module=None,*args,**kwargs):
+#commands that only read from the hosts, and don't need their lock (see the lock module)
+UNLOCKED_COMMANDS = ('collect_logs',)
+
+def _run_modules(cmd, module=None, *args, **kwargs):
     """
-    Calls the given command on a single specified module (specified with the 'mod' argument.
+    Calls the given command on each module (or just the one given with 'module') for the current host, holding the
+    host's lock (see the lock module).  Nothing is done if a newer deploy is waiting for the lock.  Hosts that were
+    locked before the artifact was distributed (see _with_artifact()) are left locked.
+    """
+    locked = cmd not in UNLOCKED_COMMANDS and not env.get('plan') and env.host_string not in env.get('held_locks', ())
+    if locked and not lock.acquire(cmd):
+        return
+    sampling = env.get('sample') and not env.get('plan')
+    if sampling:
+        sampler.start()
+    try:
+        _run_modules_unlocked(cmd, module, *args, **kwargs)
+    finally:
+        if sampling:
+            sampler.stop()
+        if locked:
+            lock.release()
+
+def _run_modules_unlocked(cmd, module=None, *args, **kwargs):
     """
+    Calls the given command on each module (or just the one given with 'module') for the current host.
+    Modules that don't have the command are skipped.  Modules are only imported when they're about to run (see the
+    registry module).
+    """
+    infos = {}
+    for m in (module and [module] or env.deploy_modules):
+        try:
+            infos[m] = registry.info(m)
+        except (ImportError, SyntaxError, IOError), e:
+            print red('Failed to find Module: %s (%s). Command "%s" not executed.' % (m, e, cmd))
+            utils.abort('Failed to find Module: %s. Command "%s" not executed.' % (m, cmd))
     if module is None:
-        modules = env.deploy_modules
+        modules = [m for m in env.deploy_modules if infos[m].has(cmd)]
+        for m in env.deploy_modules:
+            if m not in modules:
+                print 'Module %s has no "%s", skipping it.' % (m, cmd)
     else:
         modules = [module]
-    for m in modules:
-        mod = try_import(m)
-        if mod is not None:
+
+    deploy_level = kwargs.get('deploy_level') or env.get('deploy_level', 'staging')
+    ctx = None
+    if any(infos[m].takes_context(cmd) for m in modules):
+        ctx = context.resolve(deploy_level) #once for all the modules (and before any of them is forked off)
+    if cmd in ('deploy', 'bootstrap'):
+        _prefetch_checksums(modules, infos, ctx, deploy_level)
+
+    concurrent = getattr(deploy_settings, 'CONCURRENT_MODULES', False) and not recorder.active()
+    if concurrent and ctx is not None and ledger.enabled():
+        ledger.load(ctx) #once, before the modules are forked off
+    try:
+        _run_waves(cmd, modules, infos, ctx, concurrent, args, kwargs)
+    finally:
+        if ctx is not None:
+            ledger.flush(ctx)
+
+def _run_waves(cmd, modules, infos, ctx, concurrent, args, kwargs):
+    """
+    Runs the command on the given modules, a wave of modules that don't depend on each other at a time.
+    """
+    done = 0
+    for wave in _module_waves(modules, infos):
+        if concurrent and len(wave) > 1:
+            output.status('%s %s (%d-%d of %d)' % (', '.join(wave), cmd, done + 1, done + len(wave), len(modules)))
+            done += len(wave)
+            _run_concurrently([_load_module(m, cmd) for m in wave], cmd, ctx, args, kwargs)
+            continue
+        for m in wave:
+            done += 1
+            output.status('%s %s (%d of %d)' % (m, cmd, done, len(modules)))
+            mod = _load_module(m, cmd)
+            if not hasattr(mod, cmd):
+                utils.abort('Module %s has no command "%s" (see "fab commands").' % (m, cmd))
             print 'Module is: %s, args: %s, kwargs: %s' % (mod, args, kwargs)
-            getattr(mod,cmd)(*args,**kwargs)
+            with trace.module_span(m, cmd):
+                _call(mod, cmd, ctx, args, kwargs)
+
+def _run_buffered(cmd, module, args, kwargs):
+    """
+    Runs the command for the current host with its output going to the host's output file (see the output module).
+
+    Used in parallel mode, returns a dict with the last lines of the host's output, whether it succeeded and how long
+    it took.
+    """
+    buf = output.HostOutput(env.host_string)
+    result = {'host': env.host_string, 'ok': True, 'error': None, 'log': buf.path}
+    start = time.time()
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = buf
+    output.start_status(env.host_string, real_stdout)
+    trace.take_events() #the parent keeps its own
+    try:
+        try:
+            _run_modules(cmd, module, *args, **kwargs)
+        except SystemExit: #abort() prints its message and raises SystemExit
+            result['ok'] = False
+            result['error'] = 'aborted'
+        except Exception, e:
+            result['ok'] = False
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        connections.report()
+    finally:
+        sys.stdout, sys.stderr = real_stdout, real_stderr
+        result['skipped'] = ledger.take_skipped()
+        output.stop_status()
+        buf.close()
+    result['elapsed'] = time.time() - start
+    result['tail'] = buf.last_lines()
+    result['trace'] = trace.take_events()
+    for line in result['tail']:
+        if line.startswith('Fatal error: '):
+            result['error'] = line[len('Fatal error: '):]
+    return result
+
+def _print_summary(results, elapsed):
+    """
+    Prints the last lines of output of each host that failed, followed by a success/failure line per host.
+    """
+    for host in sorted(results):
+        if not results[host]['ok']:
+            print red('========== Last lines from %s (all of them are in %s) ==========' % (host, results[host].get('log')))
+            print '\n'.join(results[host]['tail'])
+
+    failed = [h for h in results if not results[h]['ok']]
+    print green('========== Summary (%d hosts, %d failed, %.1fs wall time) ==========' % (len(results), len(failed), elapsed))
+    for host in sorted(results):
+        r = results[host]
+        if r['ok']:
+            print green('%-30s OK      %8.1fs' % (host, r['elapsed']))
+        else:
+            print red('%-30s FAILED  %8.1fs  %s' % (host, r['elapsed'], r['error']))
+    return failed
+
+def _run_on_hosts(cmd, module=None, parallel=None, trace_path=None, *args, **kwargs):
+    """
+    Runs the command on every host in env.hosts.
+
+    Hosts are done one at a time unless 'parallel' is given, in which case up to that many hosts are
+    worked on at once (see the 'Running on many hosts at once' section above).  With 'trace_path', every
+    remote operation is timed and written to that file (see the trace module).
+    """
+    if env.get('plan') or env.get('record'):
+        return _run_on_hosts_recorded(cmd, module, *args, **kwargs)
+    if not trace_path and not env.get('sample'):
+        return _run_on_hosts_untraced(cmd, module, parallel, *args, **kwargs)
+    trace.start() #the sampler needs the steps' timings too
+    try:
+        _run_on_hosts_untraced(cmd, module, parallel, *args, **kwargs)
+    finally:
+        trace.summary()
+        if env.get('sample'):
+            sampler.report()
+        if trace_path:
+            trace.write(trace_path)
+
+def _run_on_hosts_recorded(cmd, module=None, *args, **kwargs):
+    """
+    Runs the command on every host (one at a time) with a recorder installed, then prints what was recorded
+    (see the 'plan' and 'record' commands).
+    """
+    rec = recorder.Recorder(fake=bool(env.get('plan')))
+    rec.install()
+    try:
+        execute(_run_modules, cmd, module, *args, hosts=env.hosts, **kwargs)
+    finally:
+        rec.uninstall()
+        rec.report()
+
+def _run_on_hosts_untraced(cmd, module=None, parallel=None, *args, **kwargs):
+    if not parallel:
+        execute(_run_modules, cmd, module, *args, hosts=env.hosts, **kwargs)
+        connections.report()
+        ledger.report()
+        return
+
+    pool_size = int(parallel)
+    start = time.time()
+    with settings(parallel=True, pool_size=pool_size, linewise=True):
+        results = execute(_run_buffered, cmd, module, args, kwargs, hosts=env.hosts)
+    for host, r in results.items():
+        if not isinstance(r, dict): #the process died before it could report back
+            results[host] = {'host': host, 'ok': False, 'error': repr(r), 'elapsed': 0.0, 'tail': [], 'trace': [], 'skipped': []}
+        trace.add_events(results[host]['trace'])
+        ledger.add_skipped(results[host]['skipped'])
+    failed = _print_summary(results, time.time() - start)
+    ledger.report()
+    if failed:
+        utils.abort('Command "%s" failed on %d of %d hosts: %s' % (cmd, len(failed), len(results), ', '.join(sorted(failed))))
+
+def _batches(hosts, batch):
+    """
+    Splits the hosts into batches of 'batch' hosts (or, for e.g. '25%', of that share of the hosts, rounded up).
+    """
+    batch = str(batch)
+    if batch.endswith('%'):
+        size = int(math.ceil(len(hosts) * float(batch[:-1]) / 100))
+    else:
+        size = int(batch)
+    size = max(1, min(size, len(hosts)))
+    return [hosts[i:i + size] for i in range(0, len(hosts), size)]
+
+def _restart_batch(hosts, parallel=None):
+    """
+    Restarts the app on the given hosts, so their health check sees the code that was just deployed.
+    """
+    if parallel:
+        with settings(parallel=True, pool_size=int(parallel), linewise=True):
+            results = execute(health.restart_app, hosts=hosts)
+    else:
+        results = execute(health.restart_app, hosts=hosts)
+    if not all(results.get(host) for host in hosts):
+        print yellow('ROLLING_RESTART_COMMAND is not set, the health check may see the code from before the deploy.')
+
+def _check_batch(hosts, parallel=None):
+    """
+    Runs the health check on the given hosts.  Returns {host: result} (see the health module).
+    """
+    if parallel:
+        with settings(parallel=True, pool_size=int(parallel), linewise=True):
+            results = execute(health.check_health, hosts=hosts)
+    else:
+        results = execute(health.check_health, hosts=hosts)
+    for host in hosts:
+        r = results.get(host)
+        if not isinstance(r, dict): #the process died before it could report back
+            r = results[host] = {'ok': False, 'reason': repr(r)}
+        if r['ok']:
+            print green('%-30s healthy   %d/%d requests failed, p90 %.3fs' % (host, r['errors'], r['samples'], r['latency']))
         else:
-            print red('Failed to import Module: %s. Command "%s" not executed.' % (m, cmd))
-            utils.abort('Failed to import Module: %s. Command "%s" not executed.' % (m, cmd))
+            print red('%-30s UNHEALTHY %s' % (host, r['reason']))
+    return results
+
+def _run_rolling(cmd, module=None, parallel=None, trace_path=None, batch=None, *args, **kwargs):
+    """
+    Runs the command on env.hosts one batch of hosts after the other, checking the health of each batch before
+    going on to the next (see 'Rolling deploys' above).
+    """
+    hosts = list(env.hosts)
+    batches = _batches(hosts, batch)
+    min_capacity = getattr(deploy_settings, 'ROLLING_MIN_CAPACITY', 0.5)
+    size = len(batches[0])
+    if len(hosts) > 1 and float(len(hosts) - size) / len(hosts) < min_capacity:
+        utils.abort('A batch of %d would leave %d of %d hosts serving, below ROLLING_MIN_CAPACITY (%s). '
+                    'Use a smaller batch.' % (size, len(hosts) - size, len(hosts), min_capacity))
+
+    if trace_path:
+        trace.start()
+    try:
+        for i, batch_hosts in enumerate(batches):
+            print green('========== Batch %d of %d: %s ==========' % (i + 1, len(batches), ', '.join(batch_hosts)))
+            with settings(hosts=batch_hosts):
+                _run_on_hosts(cmd, module, parallel, None, *args, **kwargs)
+            if env.get('plan'):
+                print 'Not restarting or checking the health of %s in plan mode.' % ', '.join(batch_hosts)
+                continue
+            _restart_batch(batch_hosts, parallel)
+            results = _check_batch(batch_hosts, parallel)
+            unhealthy = sorted(h for h in batch_hosts if not results[h]['ok'])
+            if unhealthy:
+                remaining = [h for b in batches[i + 1:] for h in b]
+                utils.abort('Halting the rolling %s: %s unhealthy after batch %d of %d. Not done yet: %s'
+                            % (cmd, ', '.join(unhealthy), i + 1, len(batches), ', '.join(remaining) or 'none'))
+    finally:
+        if trace_path:
+            trace.summary()
+            trace.write(trace_path)
+
+def _lock_hosts(cmd, hosts, parallel=None):
+    """
+    Takes the lock of the given hosts (see the lock module).  Returns the hosts whose lock was taken, leaving out the
+    ones a newer deploy is waiting for.
+    """
+    if parallel:
+        with settings(parallel=True, pool_size=int(parallel), linewise=True):
+            results = execute(lock.acquire, cmd, hosts=hosts)
+    else:
+        results = execute(lock.acquire, cmd, hosts=hosts)
+    return [host for host in hosts if results.get(host) is True]
+
+def _unlock_hosts(hosts, parallel=None):
+    """
+    Releases the lock of the given hosts, where this run holds it.
+    """
+    if parallel:
+        with settings(parallel=True, pool_size=int(parallel), linewise=True):
+            execute(lock.release, hosts=hosts)
+    else:
+        execute(lock.release, hosts=hosts)
+
+def _with_artifact(cmd, module, parallel, function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) after spreading the deploy artifact over the hosts, if DISTRIBUTE_FANOUT is set
+    (see the distribute module).  The hosts are locked before the artifact is built and unlocked once the function
+    is done, so a deploy waiting for a host can't replace the artifact the one holding its lock is using, and a burst
+    of deploys builds and relays the artifact once.  The function only gets the hosts whose lock was taken.
+    """
+    if not getattr(deploy_settings, 'DISTRIBUTE_FANOUT', 0) or len(env.hosts) < 2:
+        return function(*args, **kwargs)
+    if env.get('plan'):
+        print 'Not distributing the artifact in plan mode.'
+        return function(*args, **kwargs)
+    hosts = list(env.hosts)
+    try:
+        held = _lock_hosts(cmd, hosts, parallel)
+        if not held:
+            print yellow('Newer deploys are waiting for every host, leaving it to them.')
+            return
+        from modules import distribute #only loaded when it's used
+        distribute.distribute(held, env.deploy_level, module and [module] or env.deploy_modules)
+        with settings(hosts=held, held_locks=held):
+            return function(*args, **kwargs)
+    finally:
+        _unlock_hosts(hosts, parallel) #also when taking the locks failed half way
+
+@runs_once
+def collect_logs(since=None, parallel=None, output=None):
+    """
+    Gets the logs of every host (from 'since' on, e.g. 2h) and merges them into one file, in time order.
 
-def deploy(module=None):
+    If 'parallel' is specified, up to that many hosts are worked on at the same time.  See the logs module.
+    """
+    from modules import logs #only loaded when it's used
+    directory = logs.run_dir()
+    _run_on_hosts('collect_logs', 'modules.logs', parallel, None, since=since, directory=directory)
+    logs.merge_logs(directory, output)
+
+def commands():
+    """
+    Lists the operating methods and extra commands (for run_command) of each module in settings.MODULES.
+    """
+    for name in deploy_settings.MODULES:
+        try:
+            info = registry.info(name)
+        except (ImportError, SyntaxError, IOError), e:
+            print red('%s: not found (%s)' % (name, e))
+            continue
+        print green('%s%s' % (name, info.doc and ' - %s' % info.doc or ''))
+        print '    operating methods: %s' % (', '.join(info.operating_methods) or '-')
+        for command in info.commands:
+            print '    %-28s %s' % (command, info.functions[command])
+
+def unlock():
+    """
+    Breaks the deploy lock of the hosts, e.g. ``fab production unlock`` (see the lock module).
+    """
+    lock.release(force=True)
+
+def sample():
+    """
+    Makes the command that follows sample the CPU, memory, disk and network use of the hosts, per step.
+
+    e.g. ``fab staging sample bootstrap``.  See the sampler module.
+    """
+    env.sample = True
+
+def force(*steps):
+    """
+    Makes the command that follows run the given steps (all of them if none are given) even if their inputs didn't change.
+
+    e.g. ``fab production force:packages.pip_install deploy``.  See the ledger module.
+    """
+    env.force_steps = list(steps)
+
+def plan():
+    """
+    Makes the command that follows only show what it would do on the hosts (nothing is sent to them).
+
+    e.g. ``fab staging plan deploy``.  See the recorder module.
+    """
+    env.plan = True
+
+def record():
+    """
+    Makes the command that follows list every remote operation it made, and the ones that look redundant.
+
+    e.g. ``fab staging record deploy``.  See the recorder module.
+    """
+    env.record = True
+
+@runs_once
+def run_command(cmd,module=None,*args,**kwargs):
+    """
+    Calls the given command on a single specified module (specified with the 'mod' argument.
+    """
+    parallel = kwargs.pop('parallel', None)
+    trace_path = kwargs.pop('trace', None)
+    _run_on_hosts(cmd, module, parallel, trace_path, *args, **kwargs)
+
+@runs_once
+def deploy(module=None, parallel=None, trace=None, batch=None):
     """
     Runs the deploy command for each module.
 
     If 'module' argument is specified, this command will only be run for that specific module.
+    If 'parallel' is specified, up to that many hosts are worked on at the same time.
+    If 'trace' is specified, a timing trace of the run is written to that file.
+    If 'batch' is specified (e.g. 2 or 25%), hosts are deployed that many at a time, with a health check in between.
 
     'Deployment' is usually associated with a refreshing/updating
     of content/data
     """
-    run_command('deploy',module,deploy_level=env.deploy_level)
+    if batch:
+        _with_artifact('deploy', module, parallel, _run_rolling, 'deploy', module, parallel, trace, batch, deploy_level=env.deploy_level)
+    else:
+        _with_artifact('deploy', module, parallel, _run_on_hosts, 'deploy', module, parallel, trace, deploy_level=env.deploy_level)
 
 
-def bootstrap(module=None):
+@runs_once
+def bootstrap(module=None, parallel=None, trace=None):
     """
     Runs the bootstrap command for each module.
 
     If 'module' argument is specified, this command will only be run for that specific module.
+    If 'parallel' is specified, up to that many hosts are worked on at the same time.
+    If 'trace' is specified, a timing trace of the run is written to that file.
 
     Bootstrapping is usually associated with initial setup or
     the module being called upon for the first time.
     """
-    run_command('bootstrap',module,deploy_level=env.deploy_level)
+    _with_artifact('bootstrap', module, parallel, _run_on_hosts, 'bootstrap', module, parallel, trace, deploy_level=env.deploy_level)
 
 
-def start(module=None):
+@runs_once
+def start(module=None, parallel=None, trace=None):
     """
     Runs the start command for each module.
 
     If 'module' argument is specified, this command will only be run for that specific module.
+    If 'parallel' is specified, up to that many hosts are worked on at the same time.
+    If 'trace' is specified, a timing trace of the run is written to that file.
 
     'Starting' is usually associated with services that can be started/stopped. (Useful for restarting services manually)
     """
-    run_command('start',module,deploy_level=env.deploy_level)
+    _run_on_hosts('start', module, parallel, trace, deploy_level=env.deploy_level)
 
-def stop(module=None):
+@runs_once
+def stop(module=None, parallel=None, trace=None):
     """
     Runs the stop command for each module.
 
     If 'module' argument is specified, this command will only be run for that specific module.
+    If 'parallel' is specified, up to that many hosts are worked on at the same time.
+    If 'trace' is specified, a timing trace of the run is written to that file.
 
     'Stopping' is usually associated with services that can be started/stopped. (Useful for restarting services manually)
     """
-    run_command('stop', module, deploy_level=env.deploy_level)
+    _run_on_hosts('stop', module, parallel, trace, deploy_level=env.deploy_level)
 
 
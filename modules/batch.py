@@ -0,0 +1,152 @@
+"""
+Batched remote commands.
+
+Every ``sudo()`` or ``run()`` call is a separate round trip to the host.  Modules that need to run a handful of
+commands in a row (mkdir, chown, chmod, mv, ...) can queue them up in a ``RemoteBatch`` instead, which sends them
+to the host as one shell script, in one go.  Each command still gets its own exit status and output::
+
+    batch = RemoteBatch()
+    batch.add('mkdir -p %(log_dir)s' % ctx, user=ctx.sudo_user)
+    batch.add('chmod -R a+w %(log_dir)s' % ctx)
+    batch.add('rm %s' % old_conf, warn_only=True)
+    results = batch.execute()
+
+or, with the commands being executed at the end of the ``with`` block::
+
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p /some/folder')
+        batch.add('chmod a+w /some/folder')
+
+Like ``sudo()``, the batch stops at the first failing command and aborts (unless that command was added with
+``warn_only=True``, or ``env.warn_only`` is set).  Commands are run from the current ``cd()`` folder.
+"""
+import re
+from fabric import utils
+from fabric.api import env
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import sudo, run
+from fabric.state import output
+
+_BEGIN = re.compile(r'^@@DT_BEGIN (\d+)@@$')
+_END = re.compile(r'^@@DT_END (\d+) (\d+)@@$')
+
+
+class CommandResult(str):
+    """
+    Output of one batched command.  Like the return value of ``sudo()``, it's a string with some extra attributes:
+    ``command``, ``return_code`` (None if the command never ran), ``succeeded`` and ``failed``.
+    """
+    def __new__(cls, output, command, return_code):
+        result = str.__new__(cls, output)
+        result.command = command
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+def _quote(command):
+    """
+    Single quotes a command for use as a ``sh -c`` argument.
+
+    >>> print _quote("echo 'hi'")
+    'echo '\\''hi'\\'''
+    """
+    return "'%s'" % command.replace("'", "'\\''")
+
+
+class RemoteBatch(object):
+    """
+    A list of commands that are sent to the current host as one script.
+
+    With ``use_sudo=True`` (the default) the script runs as root (regardless of ``env.sudo_user``), and commands
+    can be given a ``user`` to run as.
+    """
+    def __init__(self, use_sudo=True):
+        self.use_sudo = use_sudo
+        self.commands = []
+        self.results = []
+
+    def add(self, command, user=None, warn_only=False):
+        """
+        Queues a command.  Nothing is sent to the host until ``execute()`` is called.
+        """
+        if user is not None and not self.use_sudo:
+            utils.abort('RemoteBatch: commands can only be run as another user in a sudo batch (%s)' % command)
+        self.commands.append((command, user, warn_only))
+
+    def script(self):
+        """
+        Returns the shell script that runs the queued commands.
+        """
+        lines = []
+        for i, (command, user, warn_only) in enumerate(self.commands):
+            if user is not None:
+                command = 'sudo -H -u %s sh -c %s' % (user, _quote(command))
+            else:
+                command = '(%s)' % command
+            lines.append('echo "@@DT_BEGIN %d@@"' % i)
+            lines.append('%s 2>&1' % command)
+            lines.append('__dt_rc=$?')
+            lines.append('echo "@@DT_END %d $__dt_rc@@"' % i)
+            if not (warn_only or env.warn_only):
+                lines.append('[ $__dt_rc -eq 0 ] || exit $__dt_rc')
+        return '\n'.join(lines)
+
+    def _parse(self, out):
+        outputs = {}
+        codes = {}
+        current = None
+        for line in out.replace('\r', '').split('\n'):
+            begin = _BEGIN.match(line)
+            end = _END.match(line)
+            if begin:
+                current = int(begin.group(1))
+                outputs[current] = []
+            elif end:
+                codes[int(end.group(1))] = int(end.group(2))
+                current = None
+            elif current is not None:
+                outputs[current].append(line)
+        results = []
+        for i, (command, user, warn_only) in enumerate(self.commands):
+            results.append(CommandResult('\n'.join(outputs.get(i, [])), command, codes.get(i)))
+        return results
+
+    def execute(self):
+        """
+        Runs all the queued commands on the host in one go, and returns a list of ``CommandResult``, one per command.
+        """
+        if not self.commands:
+            return []
+        for command, user, warn_only in self.commands:
+            if output.running:
+                print '[%s] batch %s: %s' % (env.host_string, user and 'sudo(%s)' % user or (self.use_sudo and 'sudo' or 'run'), command)
+        script = self.script() #before warn_only gets switched on below
+        with fab_settings(hide('running', 'stdout'), warn_only=True):
+            if self.use_sudo:
+                out = sudo(script, user='root')
+            else:
+                out = run(script)
+        self.results = self._parse(out)
+        if out.failed and self.results[0].return_code is None and not env.warn_only:
+            utils.abort('Batch of %d commands could not be run:\n%s' % (len(self.commands), out))
+
+        for result in self.results:
+            if output.stdout and result:
+                for line in result.split('\n'):
+                    print '[%s] out: %s' % (env.host_string, line)
+        for result, (command, user, warn_only) in zip(self.results, self.commands):
+            if result.return_code is None:
+                break
+            if result.failed and not warn_only and not env.warn_only:
+                utils.abort('Batched command returned %s while executing "%s":\n%s' % (result.return_code, command, result))
+        self.commands = []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
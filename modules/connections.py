@@ -0,0 +1,66 @@
+"""
+SSH connection bookkeeping.
+
+Fabric keeps one SSH connection per ``user@host:port`` and reuses it for every ``run()``/``sudo()``/``put()`` on
+that host.  A new connection (with its handshake, authentication and, for sudo, password prompt) is only made
+when the user or host changes.  To make the most of this, the fabfile sets ``env.user`` once (to
+``settings.SUDO_USER``) for the whole ``fab`` run and modules must not change it.
+
+``install()`` (called by the fabfile) makes fabric's connection cache keep count of how many connections were
+opened per (host, user), how long they took to set up and how many times they were reused.  ``report()``
+prints these numbers, which the fabfile does at the end of each run.
+
+Note that modules run with ``CONCURRENT_MODULES`` and hosts run in parallel each use a process of their own,
+which can't share the SSH connection of the main process.
+"""
+import time
+from fabric import state
+from fabric.network import HostConnectionCache, normalize_to_string
+
+_stats = {}
+
+
+def _host_stats(key):
+    return _stats.setdefault(key, {'connects': 0, 'setup_time': 0.0, 'reuses': 0})
+
+
+class TrackedConnectionCache(HostConnectionCache):
+    """
+    Fabric's connection cache, keeping count of connections made and reused.
+    """
+    def __getitem__(self, key):
+        real_key = normalize_to_string(key)
+        stats = _host_stats(real_key)
+        if dict.__contains__(self, real_key):
+            stats['reuses'] += 1
+            return dict.__getitem__(self, real_key)
+        start = time.time()
+        connection = HostConnectionCache.__getitem__(self, key)
+        stats['connects'] += 1
+        stats['setup_time'] += time.time() - start
+        return connection
+
+
+def install():
+    """
+    Starts keeping count of the connections fabric makes.
+    """
+    #swap the class of the existing cache object rather than replacing it: fabric's
+    #operations hold on to the object itself.
+    state.connections.__class__ = TrackedConnectionCache
+
+def stats():
+    """
+    Returns the numbers kept so far, as a dict of {'user@host:port': {'connects', 'setup_time', 'reuses'}}.
+    """
+    return dict((key, dict(value)) for key, value in _stats.items())
+
+def report(host_stats=None):
+    """
+    Prints the connection numbers (for this process, or the ones given).
+    """
+    if host_stats is None:
+        host_stats = _stats
+    for key in sorted(host_stats):
+        s = host_stats[key]
+        print 'Connections to %s: %d opened (%.2fs setting up), reused %d times' % (key, s['connects'], s['setup_time'], s['reuses'])
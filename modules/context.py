@@ -0,0 +1,137 @@
+"""
+Per-host contexts.
+
+Before the modules run on a host, the fabfile works out everything they have in common once: the environment, the
+project's paths on the host (``www_root``, ``code_root``, ``virtualenv_root``...) and the host's facts (its OS and
+where apache and postgres keep their files, see the facts module).  The result is a ``Context``, which is passed to
+the modules' operating methods (and to the extra commands of ``run_command``) as their first argument, ``ctx``::
+
+    def deploy(ctx):
+        sudo('mkdir -p %(log_dir)s' % ctx, user=ctx.sudo_user)
+
+A context can't be changed.  A module that needs values of its own (e.g. the git branch of the django module)
+derives them in a module level ``extend_context(ctx)`` function, which returns a copy of the context with them
+added (``ctx.replace(...)``); the fabfile calls it before each of the module's methods.  Since nothing is written
+to the global fabric ``env``, modules (and hosts) running at the same time can't step on each other's values.
+
+Modules whose methods take ``deploy_level`` instead of ``ctx`` are still called the old way, and set up ``env``
+themselves.
+
+Values
+------
+::
+
+    host                #the host string
+    environment         #'staging' or 'production'
+    deploy_level        #the same
+    server_name
+    project             #PROJECT_NAME
+    project_user        #PROJECT_USER
+    sudo_user           #SUDO_USER
+    project_root        #PROJECT_ROOT (with its %(environment)s, %(project_user)s and %(os)s filled in)
+    www_root            #project_root/www/<environment>
+    log_dir             #www_root/log
+    code_root           #www_root/code_root
+    project_media       #code_root/media
+    project_static      #project_root/static
+    virtualenv_name     #PYTHON_ENV_NAME
+    virtualenv_root     #www_root/<virtualenv_name>
+    services_root       #project_root/services
+    local_settings_folder   #the folder of settings.py ON THE LOCAL machine
+    os, distro, version, cpus, memory_mb, httpd_service, httpd_conf_root, httpd_user_group, pg_conf_dir,
+    pg_init_name, pg_data_dir   #the host's facts
+"""
+from __future__ import absolute_import
+import os
+import posixpath
+from fabric import utils
+from fabric.api import env
+from modules import facts
+import settings
+
+DEPLOY_LEVELS = ('staging', 'production')
+#facts that are copied into the context (the others can be had from facts.get_facts())
+FACTS = ('os', 'distro', 'version', 'cpus', 'memory_mb', 'httpd_service', 'httpd_conf_root', 'httpd_user_group',
+         'pg_conf_dir', 'pg_init_name', 'pg_data_dir')
+
+_contexts = {} #(host, deploy level) -> Context, resolved during this run
+
+
+class Context(object):
+    """
+    The values the modules work with on one host.  Read them as attributes (``ctx.code_root``) or as keys
+    (``'%(code_root)s' % ctx``).  Contexts can't be changed, ``replace()`` returns a changed copy.
+    """
+    __slots__ = ('_values',)
+
+    def __init__(self, **values):
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError('The context has no "%s"' % name)
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Contexts can\'t be changed, use ctx.replace(%s=...)' % name)
+
+    def __repr__(self):
+        return 'Context(%s)' % ', '.join('%s=%r' % item for item in sorted(self._values.items()))
+
+    def replace(self, **values):
+        """
+        Returns a copy of the context with the given values added or replaced.
+        """
+        return Context(**dict(self._values, **values))
+
+    def as_dict(self):
+        """
+        Returns the values as a (new) dict, e.g. to fill in a template.
+        """
+        return dict(self._values)
+
+
+def _resolve(deploy_level):
+    if deploy_level not in DEPLOY_LEVELS:
+        utils.abort('Unrecognized Deploy Level: %s' % deploy_level)
+    host_facts = facts.get_facts()
+    values = dict((name, host_facts.get(name)) for name in FACTS)
+    values.update(
+        host=env.host_string,
+        environment=deploy_level,
+        deploy_level=deploy_level,
+        server_name=env.get('server_name'),
+        project=settings.PROJECT_NAME,
+        project_user=getattr(settings, 'PROJECT_USER', settings.SUDO_USER),
+        sudo_user=settings.SUDO_USER,
+        virtualenv_name=getattr(settings, 'PYTHON_ENV_NAME', 'python_env'), #not a required setting
+        local_settings_folder=os.path.split(os.path.abspath(settings.__file__))[0],
+    )
+    # using posixpath to ensure unix style slashes. See bug-ticket: http://code.fabfile.org/attachments/61/posixpath.patch
+    values['project_root'] = settings.PROJECT_ROOT % values
+    values['www_root'] = posixpath.join(values['project_root'], 'www', deploy_level)
+    values['log_dir'] = posixpath.join(values['www_root'], 'log')
+    values['code_root'] = posixpath.join(values['www_root'], 'code_root')
+    values['project_media'] = posixpath.join(values['code_root'], 'media')
+    values['project_static'] = posixpath.join(values['project_root'], 'static')
+    values['virtualenv_root'] = posixpath.join(values['www_root'], values['virtualenv_name'])
+    values['services_root'] = posixpath.join(values['project_root'], 'services')
+    return Context(**values)
+
+def resolve(deploy_level=None):
+    """
+    Returns the context of the current host (env.host_string) for the given deploy level (the one of the fab
+    command by default).  It's only worked out once per host and run.
+    """
+    deploy_level = deploy_level or env.get('deploy_level', 'staging')
+    key = (env.host_string, deploy_level)
+    if key not in _contexts:
+        _contexts[key] = _resolve(deploy_level)
+    return _contexts[key]
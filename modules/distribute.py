@@ -0,0 +1,220 @@
+"""
+Fan-out distribution of deploy artifacts.
+
+Normally every host fetches the code from the git server and gets the wheelhouse uploaded from the machine you're
+deploying from, so on a large fleet the same bytes go over the same uplink once per host.  With
+``DISTRIBUTE_FANOUT`` set, ``deploy`` and ``bootstrap`` first build a single artifact on the local machine:
+
+* ``code.bundle`` - a git bundle of the branch being deployed (from a local mirror of ``DJANGO_GIT_REPO_URL``),
+  when modules.django is in ``MODULES``
+* ``wheelhouse-<key>.tar.gz`` - the wheelhouse of the packages module, when ``PACKAGES_USE_WHEELHOUSE`` is on
+
+The artifact is uploaded to the first host only.  From there it spreads in rounds: every host that has it sends it on
+to up to ``DISTRIBUTE_FANOUT`` hosts that don't, at the same time (over ssh, host to host), so the number of hosts
+that have it grows by a factor of ``DISTRIBUTE_FANOUT + 1`` each round.  The modules then use the artifact instead
+of going out to the network: django fetches from the bundle instead of origin, packages unpacks the wheelhouse
+instead of uploading it.  A host that didn't get the artifact (because a relay to it failed) falls back to the
+usual way, as do hosts whose platform doesn't match the wheelhouse.
+
+Config files (localsettings, the apache and supervisor confs) are still uploaded directly: they're small and only
+uploaded when they changed (see the uploads module).  Submodules are still fetched by each host.
+
+The hosts have to be able to ssh into each other (as ``SUDO_USER``) without a password, e.g. with agent
+forwarding (``env.forward_agent = True``) or a key of their own.  Relays run on many hosts at once, so they can't
+answer prompts either.  The key of a host is checked against the ``known_hosts`` of the host relaying to it, and
+a host that isn't in there yet is trusted the first time (``DISTRIBUTE_HOST_KEY_CHECKING``, ``accept-new`` needs
+OpenSSH 7.6 on the hosts).  Set it to ``"yes"`` to only relay to known hosts.
+
+Distribute Settings
+-------------------
+::
+
+    DISTRIBUTE_FANOUT = 0 #How many hosts each host relays the artifact to.  0 (the default) switches distribution off
+    DISTRIBUTE_CACHE = "~/.deploy_tools/distribute" #Where the git mirror and the artifacts are kept ON THE LOCAL machine
+    DISTRIBUTE_PEER_ADDRESSES = {} #host -> address the other hosts should use to reach it (e.g. a private ip)
+    DISTRIBUTE_KEEP = 2 #How many artifacts to keep on each host
+    DISTRIBUTE_HOST_KEY_CHECKING = "accept-new" #(default is "accept-new") ssh StrictHostKeyChecking for the relays, "no" switches it off
+
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import hashlib
+import posixpath
+import tarfile
+from fabric.api import env, execute, local, put, run
+from fabric.colors import green, yellow
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.network import normalize
+import settings
+
+SSH_OPTIONS = '-o BatchMode=yes -o StrictHostKeyChecking=%s'
+
+
+def _cache():
+    return os.path.expanduser(getattr(settings, 'DISTRIBUTE_CACHE', '~/.deploy_tools/distribute'))
+
+def _remote_root():
+    return posixpath.join(settings.PROJECT_ROOT, 'artifacts')
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _build_code_bundle(build_dir, deploy_level):
+    """
+    Brings the local mirror of the repo up to date and bundles the branch being deployed.
+    """
+    mirror = os.path.join(_cache(), 'repo.git')
+    branch = getattr(settings, 'DJANGO_%s_GIT_BRANCH' % deploy_level.upper())
+    if os.path.isdir(mirror):
+        local('git --git-dir="%s" fetch --prune origin "+refs/heads/*:refs/heads/*"' % mirror)
+    else:
+        local('git clone --mirror %s "%s"' % (settings.DJANGO_GIT_REPO_URL, mirror))
+    local('git --git-dir="%s" bundle create "%s" %s' % (mirror, os.path.join(build_dir, 'code.bundle'), branch))
+
+def _build_wheelhouse(build_dir):
+    from modules import packages
+    python = getattr(settings, 'PACKAGES_WHEELHOUSE_PYTHON', 'python')
+    platform = local("%s -c \"%s\"" % (python, packages.PLATFORM_SNIPPET), capture=True).strip()
+    key = '%s-%s' % (packages._requirements_hash(), platform) #the same key the packages module looks for
+    shutil.copy(packages._build_wheelhouse(key), os.path.join(build_dir, 'wheelhouse-%s.tar.gz' % key))
+
+def build_artifact(deploy_level, modules):
+    """
+    Builds the artifact for the given modules on the local machine.  Returns the path of its archive (named after
+    the artifact's key) and the names of the files in it.  The path is None when none of the modules has anything
+    to distribute.
+    """
+    build_dir = os.path.join(_cache(), 'build')
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    if 'modules.django' in modules:
+        _build_code_bundle(build_dir, deploy_level)
+    if 'modules.packages' in modules and getattr(settings, 'PACKAGES_USE_WHEELHOUSE', False):
+        _build_wheelhouse(build_dir)
+    names = sorted(os.listdir(build_dir))
+    if not names:
+        return None, []
+
+    key = hashlib.sha1(''.join('%s %s\n' % (name, _file_hash(os.path.join(build_dir, name))) for name in names)).hexdigest()[:12]
+    archive = os.path.join(_cache(), 'artifact-%s.tar' % key)
+    if not os.path.exists(archive):
+        tar = tarfile.open(archive + '.tmp', 'w')
+        try:
+            for name in names:
+                tar.add(os.path.join(build_dir, name), arcname=posixpath.join(key, name))
+        finally:
+            tar.close()
+        os.rename(archive + '.tmp', archive)
+    print green('Built artifact %s (%s)' % (key, ', '.join(names)))
+    return archive, names
+
+def _address(host_string):
+    user, host, port = normalize(host_string)
+    host = getattr(settings, 'DISTRIBUTE_PEER_ADDRESSES', {}).get(host_string, host)
+    return '-p %s %s@%s' % (port, user, host)
+
+def _receive_cmd(key):
+    """
+    What runs on a host receiving the artifact (as a tar stream on stdin).
+    """
+    root = _remote_root()
+    keep = int(getattr(settings, 'DISTRIBUTE_KEEP', 2))
+    return ('mkdir -p %(root)s && rm -rf %(root)s/%(key)s && tar xf - -C %(root)s && touch %(root)s/%(key)s/.complete'
+            ' && cd %(root)s && ls -1t | grep -v -x %(key)s | tail -n +%(keep)d | xargs -r rm -rf' % locals())
+
+def _seed(archive, key):
+    """
+    Uploads the artifact to the current host (unless it has it already).  Returns whether the host has it.
+    """
+    complete = '%s/%s/.complete' % (_remote_root(), key)
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        if run('test -f %s' % complete).succeeded:
+            return True
+        remote_archive = '/tmp/%s' % os.path.basename(archive)
+        if put(archive, remote_archive).failed:
+            return False
+        return run('(%s) < %s; rm -f %s; test -f %s' % (_receive_cmd(key), remote_archive, remote_archive, complete)).succeeded
+
+def _relay(key, assignments):
+    """
+    Sends the artifact from the current host to its share of the hosts, all at once.  Returns the ones it reached.
+    """
+    receivers = assignments[env.host_string]
+    root = _remote_root()
+    script = []
+    for i, receiver in enumerate(receivers):
+        ssh = 'ssh %s %s' % (SSH_OPTIONS % getattr(settings, 'DISTRIBUTE_HOST_KEY_CHECKING', 'accept-new'), _address(receiver))
+        script.append('( %(ssh)s "test -f %(root)s/%(key)s/.complete" || tar cf - -C %(root)s --exclude=.complete %(key)s | %(ssh)s "%(receive)s" )'
+                      ' && echo "RELAYED %(i)d" &' % dict(ssh=ssh, root=root, key=key, receive=_receive_cmd(key), i=i))
+    script.append('wait')
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run('\n'.join(script))
+    reached = set(int(line.split()[1]) for line in out.replace('\r', '').split('\n') if line.startswith('RELAYED '))
+    return [receiver for i, receiver in enumerate(receivers) if i in reached]
+
+def _assign(have, todo, fanout):
+    """
+    Assigns up to 'fanout' of the hosts still to do to each host that has the artifact.
+    """
+    assignments = {}
+    todo = list(todo)
+    for sender in have:
+        if not todo:
+            break
+        assignments[sender], todo = todo[:fanout], todo[fanout:]
+    return assignments
+
+def distribute(hosts, deploy_level, modules):
+    """
+    Builds the artifact and spreads it over the hosts (see above).  Sets ``env.artifact_root``,
+    ``env.artifact_files`` and ``env.artifact_hosts`` for the modules (see artifact_path()).
+    """
+    fanout = int(getattr(settings, 'DISTRIBUTE_FANOUT', 0) or 0)
+    env.artifact_root, env.artifact_files, env.artifact_hosts = None, [], set()
+    if not fanout or not hosts:
+        return
+    archive, names = build_artifact(deploy_level, modules)
+    if archive is None:
+        return
+    key = os.path.basename(archive)[len('artifact-'):-len('.tar')]
+
+    print green('Seeding artifact %s on %s' % (key, hosts[0]))
+    if execute(_seed, archive, key, hosts=[hosts[0]]).get(hosts[0]) is not True:
+        print yellow('Could not seed the artifact on %s, every host will fetch everything itself.' % hosts[0])
+        return
+    have, todo, round_number = [hosts[0]], list(hosts[1:]), 0
+    while todo:
+        round_number += 1
+        assignments = _assign(have, todo, fanout)
+        print green('Relay round %d: %s' % (round_number, '; '.join('%s -> %s' % (s, ', '.join(r)) for s, r in sorted(assignments.items()))))
+        with fab_settings(parallel=True, pool_size=len(assignments), linewise=True):
+            results = execute(_relay, key, assignments, hosts=sorted(assignments))
+        for sender, receivers in assignments.items():
+            reached = results.get(sender)
+            reached = reached if isinstance(reached, list) else []
+            for receiver in receivers:
+                todo.remove(receiver)
+                if receiver in reached:
+                    have.append(receiver)
+                else:
+                    print yellow('%s could not relay the artifact to %s, it will fetch everything itself.' % (sender, receiver))
+    env.artifact_root = posixpath.join(_remote_root(), key)
+    env.artifact_files = names
+    env.artifact_hosts = set(have)
+    print green('Artifact %s is on %d of %d hosts after %d relay round(s).' % (key, len(have), len(hosts), round_number))
+
+def artifact_path(name):
+    """
+    Returns the remote path of a file of the artifact, if the current host got the artifact and it has that file.
+    """
+    if not env.get('artifact_root') or env.host_string not in env.get('artifact_hosts', ()):
+        return None
+    if name not in env.get('artifact_files', ()):
+        return None
+    return posixpath.join(env.artifact_root, name)
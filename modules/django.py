@@ -31,6 +31,65 @@ Django Module Settings
     DJANGO_LOCALSETTINGS_REMOTE_DESTINATION = "some_folder/localsettings.py" #RELATIVE TO THE CODE_ROOT ON REMOTE MACHINE
     DJANGO_LOCALSETTINGS_NO_TEMPLATE = True #Set to false if you want to treat localsettings.py as a template
 
+    #Optional, for speeding up git (see 'Fetching code' below)
+    DJANGO_GIT_CLONE_DEPTH = None #e.g. 1 to only fetch the latest commit instead of the whole history
+    DJANGO_GIT_PARTIAL_CLONE = False #Set to True for a blobless clone (file contents are fetched when needed)
+    DJANGO_GIT_SUBMODULE_JOBS = None #e.g. 8 to update that many submodules at the same time
+
+    #Optional, see 'Release folders' below
+    DJANGO_RELEASES = False #(default is False) Prepare each deploy in a folder of its own and switch over atomically
+    DJANGO_RELEASES_KEEP = 5 #How many releases (including the live one) to keep around for rollbacks
+
+    #Optional, see 'Static files' below
+    DJANGO_INCREMENTAL_COLLECTSTATIC = True #(default is True) Skip collectstatic when no static file changed
+    DJANGO_STATIC_PATH_PATTERN = "(^|/)static/" #(awk) regex for the paths in the repo that hold static files
+
+Fetching code
+-------------
+``deploy`` brings the code up to date in one go: it fetches the branch from origin, then forcibly checks out
+(resets to) exactly that commit and updates the submodules, all in a single round trip.  Local changes in the
+code_root on the host are thrown away.
+
+On repos with a long history or many submodules, git can be sped up with the settings above.
+``DJANGO_GIT_CLONE_DEPTH`` makes clones, fetches and submodule updates shallow.  ``DJANGO_GIT_PARTIAL_CLONE``
+clones without file contents (git >= 2.19 on the host and a server that supports it).  ``DJANGO_GIT_SUBMODULE_JOBS``
+updates submodules in parallel (git >= 2.9).  On large fleets the branch can be fetched from a git bundle relayed
+from host to host instead of from origin (see the distribute module).
+
+Release folders
+---------------
+Normally the code_root is a single checkout that gets updated in place, so for a while the running site sees a mix
+of old and new files.  With ``DJANGO_RELEASES = True`` every deploy is prepared in a folder of its own,
+``www/<environment>/releases/<commit sha>``: the code is checked out there (from a cached clone in
+``www/<environment>/repo``, so only new commits are fetched), localsettings are uploaded into it, collectstatic is
+run and the python files are compiled.  Only then is the ``code_root`` (which becomes a symlink, playing the part
+of the usual ``current`` link so the apache and supervisor configs don't need to change) switched over to it with an
+atomic rename.  Deploying a commit that already has a complete release just switches back to it.
+``bootstrap`` only clones the cached repo, the first release is built by the first ``deploy`` (once the
+virtualenv is there).
+
+``code_root/media`` is shared between releases (it's a symlink to ``www/<environment>/media``), unless the repo
+has a media folder of its own.  The last ``DJANGO_RELEASES_KEEP`` releases are kept, so going back to the previous
+one is instant::
+
+    $ fab production run_command:rollback_code,module=modules.django
+
+Remember to restart your processes (e.g. through supervisor) to have them pick up the new release.
+
+Static files
+------------
+``collectstatic`` keeps a manifest of the static files in the repo (and its submodules) on the host, in
+``www/<environment>/static_manifest``: the git hash of each file whose path matches ``DJANGO_STATIC_PATH_PATTERN``,
+plus the virtualenv (for the static files of installed apps).  When the manifest didn't change since the last
+collectstatic, collectstatic isn't run at all.  Otherwise, the files whose hash didn't change get an old
+modification time, so that collectstatic only copies the ones that did (which matters for release folders, where
+every file is freshly checked out).  The number of files copied and left alone is printed.  Without release folders,
+the manifest isn't even looked at when the commit, localsettings and pip requirements are the same as for the last
+collectstatic (see the ledger module).
+
+Set ``DJANGO_INCREMENTAL_COLLECTSTATIC = False`` to always run a full collectstatic, or run it by hand with::
+
+    $ fab production run_command:collectstatic,module=modules.django,force=True
 """
 
 from fabric.api import *
@@ -38,161 +97,292 @@ from fabric.colors import green, yellow
 from fabric.contrib import files, console
 from fabric import utils
 import posixpath
-from fabric.contrib.files import upload_template
+import re
+from modules.batch import RemoteBatch
+from modules.uploads import upload_if_changed
+from modules.utils import switch_release, rollback_release
+from modules import distribute, ledger
+from fabric.api import settings as fab_settings
 import settings
 
-def setup_env(deploy_level="staging"):
-    if deploy_level == "staging":
-        _staging()
-    elif deploy_level == "production":
-        _production()
+#see 'Module dependencies' in the fabfile docs.  git comes from the os module, collectstatic and compileall run with
+#the python of the virtualenv (from the packages module).
+REQUIRES = ["os_packages", "virtualenv"]
+PROVIDES = ["code"]
+
+def extend_context(ctx):
+    if ctx.deploy_level == "production":
+        code_branch = settings.DJANGO_PRODUCTION_GIT_BRANCH
     else:
-        raise Exception("Unrecognized Deploy Level: %s" % deploy_level)
-
-    env.user = settings.SUDO_USER
-    env.sudo_user = settings.SUDO_USER
-    env.code_repo = settings.DJANGO_GIT_REPO_URL
-    env.project = settings.PROJECT_NAME
-    env.server_port = settings.DJANGO_GUNICORN_PORT
-    env.settings = '%(project)s.localsettings' % env
-    env.db = '%s_%s' % (env.project, env.environment)
-    _setup_path()
+        code_branch = settings.DJANGO_STAGING_GIT_BRANCH
+    return ctx.replace(
+        code_repo=settings.DJANGO_GIT_REPO_URL,
+        code_branch=code_branch,
+        server_port=settings.DJANGO_GUNICORN_PORT,
+        django_settings='%s.localsettings' % ctx.project,
+        db='%s_%s' % (ctx.project, ctx.environment),
+        releases_root=posixpath.join(ctx.www_root, 'releases'),
+        code_cache=posixpath.join(ctx.www_root, 'repo'), #cached clone the releases are checked out from
+    )
+
+def _sudo_user_warning(ctx):
     print '\t'
     print '\t'
     print yellow('########WARNING###########')
-    print yellow('## REQUIRE USER: "%(sudo_user)s" login password! ##' % env)
+    print yellow('## REQUIRE USER: "%(sudo_user)s" login password! ##' % ctx)
     print '\t'
     print '\t'
-def _setup_path():
-    """
-    Creates all the various paths that will be needed
-    in deploying code, populating config templates, etc.
-    """
-    # using posixpath to ensure unix style slashes. See bug-ticket: http://code.fabfile.org/attachments/61/posixpath.patch
-    env.project_root = settings.PROJECT_ROOT
-    env.www_root = posixpath.join(env.project_root,'www',env.environment)
-    env.log_dir = posixpath.join(env.www_root,'log')
-    env.code_root = posixpath.join(env.www_root,'code_root')
-    env.project_media = posixpath.join(env.code_root, 'media')
-    env.project_static = posixpath.join(env.project_root, 'static')
-    env.virtualenv_name = getattr(settings, 'PYTHON_ENV_NAME', 'python_env') #not a required setting and should be sufficient with default name
-    env.virtualenv_root = posixpath.join(env.www_root, env.virtualenv_name)
-    env.services = posixpath.join(env.project_root, 'services')
-
-def setup_dirs():
+
+def managed_files(ctx):
+    """
+    The config files this module uploads (see the uploads module).  Releases get a fresh localsettings every time.
+    """
+    if _use_releases():
+        return []
+    return [posixpath.join(ctx.code_root, settings.DJANGO_LOCALSETTINGS_REMOTE_DESTINATION)]
+
+def setup_dirs(ctx):
     """ create (if necessary) and make writable uploaded media, log, etc. directories """
-    require('project_root',provided_by=('setup_env'))
-    sudo('mkdir -p %(project_root)s' % env, user=env.sudo_user)
-    sudo('mkdir -p %(www_root)s' % env, user=env.sudo_user)
-    sudo('mkdir -p %(log_dir)s' % env, user=env.sudo_user)
-    sudo('mkdir -p %(virtualenv_root)s' % env, user=env.sudo_user)
-    sudo('mkdir -p %(services)s' % env, user=env.sudo_user)
-    sudo('chmod -R a+w %(log_dir)s' % env, user=env.sudo_user)
-    sudo('chown -R %(sudo_user)s %(project_root)s' % env)
-    sudo('chgrp -R %(sudo_user)s %(project_root)s' % env)
-
-
-
-def _production():
-    """ use production environment on remote host"""
-    env.code_branch = settings.DJANGO_PRODUCTION_GIT_BRANCH
-    env.environment = 'production'
-    env.server_name = 'project-production.dimagi.com'
-    env.hosts = [settings.PRODUCTION_HOST]
-
-def _staging():
-    """ use staging environment on remote host"""
-    env.code_branch = settings.DJANGO_STAGING_GIT_BRANCH
-    env.environment = 'staging'
-    env.server_name = 'project-staging.dimagi.com'
-    env.hosts = [settings.STAGING_HOST]
-
-def collectstatic():
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p %(project_root)s' % ctx, user=ctx.sudo_user)
+        batch.add('mkdir -p %(www_root)s' % ctx, user=ctx.sudo_user)
+        batch.add('mkdir -p %(log_dir)s' % ctx, user=ctx.sudo_user)
+        batch.add('mkdir -p %(virtualenv_root)s' % ctx, user=ctx.sudo_user)
+        batch.add('mkdir -p %(services_root)s' % ctx, user=ctx.sudo_user)
+        batch.add('chmod -R a+w %(log_dir)s' % ctx, user=ctx.sudo_user)
+        batch.add('chown -R %(sudo_user)s %(project_root)s' % ctx)
+        batch.add('chgrp -R %(sudo_user)s %(project_root)s' % ctx)
+
+
+
+#Lists "<git hash>\t<path>" for every static file in the checkout and its submodules, sorted.
+STATIC_MANIFEST_CMD = ("{ git ls-tree -r HEAD; git submodule foreach --quiet --recursive "
+                       "'git ls-tree -r HEAD | sed \"s|\t|\t${displaypath:-$path}/|\"'; } "
+                       "| cut -d' ' -f3- | awk -F'\t' -v re='%s' '$2 ~ re' | LC_ALL=C sort")
+
+_COPIED = re.compile(r'(\d+) static files? copied')
+_UNMODIFIED = re.compile(r'(\d+) unmodified')
+
+def _static_manifest_changed(ctx, code_root, touch=True):
+    """
+    Writes the static manifest for the given checkout next to the last one, gives the static files that didn't
+    change an old modification time (unless 'touch' is False), and returns whether anything changed.
+    """
+    manifest = posixpath.join(ctx.www_root, 'static_manifest')
+    pattern = getattr(settings, 'DJANGO_STATIC_PATH_PATTERN', '(^|/)static/')
+    with cd(code_root):
+        batch = RemoteBatch()
+        batch.add('(%s; echo "virtualenv $(readlink -f %s) $(stat -c %%Y %s/lib/python*/site-packages 2>/dev/null)") > %s.new'
+                  % (STATIC_MANIFEST_CMD % pattern, ctx.virtualenv_root, ctx.virtualenv_root, manifest), user=ctx.sudo_user)
+        if touch:
+            batch.add('[ ! -f %s ] || comm -12 %s %s.new | cut -s -f2 | xargs -d "\\n" -r touch -m -d @1 --' % (manifest, manifest, manifest),
+                      user=ctx.sudo_user)
+        batch.add('cmp -s %s %s.new && echo UNCHANGED; true' % (manifest, manifest), user=ctx.sudo_user)
+        return batch.execute()[-1].strip() != 'UNCHANGED'
+
+def collectstatic(ctx, code_root=None, force=False):
     """ run collectstatic on remote environment. ASSUMES YOU ALREADY HAVE ALL REQUIRED PACKAGES AND VIRTUALENV INSTALLED. """
-    require('project_root', provided_by=('setup_env'))
-    with cd(env.project_root):
-        sudo('%(virtualenv_root)s/bin/python manage.py collectstatic --noinput --settings=%(settings)s' % env, user=env.sudo_user)
+    incremental = getattr(settings, 'DJANGO_INCREMENTAL_COLLECTSTATIC', True)
+    force = force not in (False, 'False', 'false', '0') #a string when given on the command line
+    if incremental and force:
+        _static_manifest_changed(ctx, code_root or ctx.code_root, touch=False) #only to record the manifest for next time
+    elif incremental and not _static_manifest_changed(ctx, code_root or ctx.code_root):
+        print green('No static files changed, skipping collectstatic.')
+        return
+    with cd(code_root or ctx.project_root):
+        out = sudo('%(virtualenv_root)s/bin/python manage.py collectstatic --noinput --settings=%(django_settings)s' % ctx, user=ctx.sudo_user)
+    copied = _COPIED.search(out)
+    unmodified = _UNMODIFIED.search(out)
+    if copied:
+        print green('collectstatic: %s files copied, %s unmodified' % (copied.group(1), unmodified and unmodified.group(1) or 0))
+    if incremental:
+        sudo('mv %(www_root)s/static_manifest.new %(www_root)s/static_manifest' % ctx, user=ctx.sudo_user)
+
+def _collectstatic_step(ctx, sha):
+    """
+    Runs collectstatic for the code_root, unless it already ran for the same commit, localsettings and pip
+    requirements (see the ledger module).
+    """
+    requirements = getattr(settings, 'PACKAGES_PIP_REQUIREMENTS_PATH', None)
+    inputs = {'commit': sha, 'settings': ctx.django_settings, 'virtualenv': ctx.virtualenv_root,
+              'localsettings': ledger.file_hash(settings.DJANGO_LOCALSETTINGS_LOCAL_PATH),
+              'requirements': requirements and ledger.file_hash(requirements)}
+    #a full collectstatic every time was asked for
+    force = not getattr(settings, 'DJANGO_INCREMENTAL_COLLECTSTATIC', True)
+    ledger.step(ctx, 'django.collectstatic', inputs, collectstatic, (ctx,), force=force)
 
-def clone_repo():
+def _git_depth_flag():
+    depth = getattr(settings, 'DJANGO_GIT_CLONE_DEPTH', None)
+    return depth and ' --depth %s' % depth or ''
+
+def _git_clone_flags(ctx):
+    flags = _git_depth_flag() + ' --branch %(code_branch)s' % ctx
+    if getattr(settings, 'DJANGO_GIT_PARTIAL_CLONE', False):
+        flags += ' --filter=blob:none'
+    return flags
+
+def _git_submodule_update_cmd():
+    jobs = getattr(settings, 'DJANGO_GIT_SUBMODULE_JOBS', None)
+    return 'git submodule update --init --recursive' + _git_depth_flag() + (jobs and ' --jobs %s' % jobs or '')
+
+def clone_repo(ctx, code_root=None):
     """ clone a new copy of the git repository """
-    require('code_root', provided_by=('setup_env'))
-    with cd(env.www_root):
-        sudo('git clone %(code_repo)s %(code_root)s' % env, user=env.sudo_user)
-
-def _make_template_dict():
-    """
-    Adds the localsettings template dict to env
-    and populates it with some additional useful things
-    """
-    d = settings.DJANGO_LOCALSETTINGS_TEMPLATE_DICT
-    d["project_root"] = env.project_root
-    d["www_root"] = env.www_root
-    d["log_dir"] = env.log_dir
-    d["code_root"] = env.code_root
-    d["project_media"] = env.project_media
-    d["project_static"] = env.project_static
-    d["virtualenv_root"] = env.virtualenv_root
-    d["services"] = env.services
-    env.localsettings_dict = d
-
-def upload_localsettings():
-    """
-    Uploads your django settings from your local machine to host
-    """
-    require('code_root', provided_by=('setup_env'))
-    env.localsettings_path = settings.DJANGO_LOCALSETTINGS_LOCAL_PATH
-    env.localsettings_destination = posixpath.join(env.code_root, settings.DJANGO_LOCALSETTINGS_REMOTE_DESTINATION) #note: relative to code_root
-    _make_template_dict()
+    with cd(ctx.www_root):
+        sudo('git clone%s %s %s' % (_git_clone_flags(ctx), ctx.code_repo, code_root or ctx.code_root), user=ctx.sudo_user)
+
+def update_code(ctx, code_root=None, submodules=True):
+    """
+    Fetches the branch and resets the code_root (and its submodules) to it, in one round trip.
+    The branch comes from the distributed git bundle when the host has one (see the distribute module).
+    Returns the sha of the commit checked out.
+    """
+    bundle = distribute.artifact_path('code.bundle')
+    with cd(code_root or ctx.code_root):
+        batch = RemoteBatch()
+        if bundle:
+            batch.add('git fetch %s +refs/heads/%s:refs/remotes/origin/%s' % (bundle, ctx.code_branch, ctx.code_branch), user=ctx.sudo_user)
+        else:
+            batch.add('git fetch%s origin +refs/heads/%s:refs/remotes/origin/%s' % (_git_depth_flag(), ctx.code_branch, ctx.code_branch), user=ctx.sudo_user)
+        batch.add('git checkout --force -B %s origin/%s' % (ctx.code_branch, ctx.code_branch), user=ctx.sudo_user)
+        if submodules:
+            batch.add('git submodule sync --recursive', user=ctx.sudo_user)
+            batch.add(_git_submodule_update_cmd(), user=ctx.sudo_user)
+        batch.add('git rev-parse HEAD', user=ctx.sudo_user)
+        return batch.execute()[-1].strip()
+
+def _releases_keep():
+    return int(getattr(settings, 'DJANGO_RELEASES_KEEP', 5))
+
+def _setup_releases(ctx):
+    """
+    Creates the releases folder and the shared media folder, and clones the cached repo the releases are built from.
+    """
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p %(releases_root)s' % ctx, user=ctx.sudo_user)
+        batch.add('[ -d %(code_cache)s/.git ] || git clone%(flags)s %(code_repo)s %(code_cache)s' % dict(ctx.as_dict(), flags=_git_clone_flags(ctx)),
+                  user=ctx.sudo_user)
+        #keep the media uploaded so far when a pre-DJANGO_RELEASES code_root gets replaced
+        batch.add('if [ ! -e %(www_root)s/media ] && [ -d %(code_root)s/media ] && [ ! -L %(code_root)s ]; then cp -a %(code_root)s/media %(www_root)s/media; fi' % ctx,
+                  user=ctx.sudo_user)
+        batch.add('mkdir -p %(www_root)s/media' % ctx, user=ctx.sudo_user)
+
+def build_release(ctx):
+    """
+    Prepares a release folder for the latest commit on the branch (code, localsettings, static files and compiled
+    python files), next to the live one, then switches the code_root over to it.
+    """
+    _setup_releases(ctx)
+    sha = update_code(ctx, ctx.code_cache, submodules=False)
+    target = posixpath.join(ctx.releases_root, sha)
+
+    with fab_settings(hide('running', 'stdout'), warn_only=True):
+        out = run('readlink -f %s; test -f %s/.complete && echo COMPLETE; true' % (ctx.code_root, target))
+    lines = out.replace('\r', '').split('\n')
+    if 'COMPLETE' in lines:
+        print green('Release %s is already built.' % sha)
+        if lines[0].strip() == target:
+            return
+    else:
+        print green('Building release %s...' % target)
+        with RemoteBatch() as batch:
+            batch.add('rm -rf %s' % target, user=ctx.sudo_user) #whatever is left of an earlier, failed build
+            batch.add('git clone --no-checkout %s %s' % (ctx.code_cache, target), user=ctx.sudo_user) #hardlinks, no network
+        with cd(target):
+            with RemoteBatch() as batch:
+                batch.add('git remote set-url origin %s' % ctx.code_repo, user=ctx.sudo_user) #for relative submodule urls
+                batch.add('git checkout --force -B %s %s' % (ctx.code_branch, sha), user=ctx.sudo_user)
+                batch.add('git submodule sync --recursive', user=ctx.sudo_user)
+                batch.add(_git_submodule_update_cmd(), user=ctx.sudo_user)
+                batch.add('[ -e media ] || ln -s %(www_root)s/media media' % ctx, user=ctx.sudo_user)
+        upload_localsettings(ctx, target)
+        collectstatic(ctx, target)
+        sudo('%s/bin/python -m compileall -q %s' % (ctx.virtualenv_root, target), user=ctx.sudo_user)
+        sudo('touch %s/.complete' % target, user=ctx.sudo_user)
+    switch_release(ctx.code_root, ctx.releases_root, sha, _releases_keep(), ctx.sudo_user)
+
+def rollback_code(ctx):
+    """
+    Switches the code_root back to the release that was live before the current one.
+    """
+    rollback_release(ctx.code_root, ctx.releases_root, _releases_keep(), ctx.sudo_user)
+
+def _use_releases():
+    return getattr(settings, 'DJANGO_RELEASES', False)
+
+def _make_template_dict(ctx):
+    """
+    Returns the localsettings template dict,
+    populated with some additional useful things
+    """
+    d = dict(settings.DJANGO_LOCALSETTINGS_TEMPLATE_DICT)
+    d["project_root"] = ctx.project_root
+    d["www_root"] = ctx.www_root
+    d["log_dir"] = ctx.log_dir
+    d["code_root"] = ctx.code_root
+    d["project_media"] = ctx.project_media
+    d["project_static"] = ctx.project_static
+    d["virtualenv_root"] = ctx.virtualenv_root
+    d["services"] = ctx.services_root
+    return d
+
+def upload_localsettings(ctx, code_root=None):
+    """
+    Uploads your django settings from your local machine to host (unless they're already up to date there)
+    """
+    localsettings_path = settings.DJANGO_LOCALSETTINGS_LOCAL_PATH
+    localsettings_destination = posixpath.join(code_root or ctx.code_root, settings.DJANGO_LOCALSETTINGS_REMOTE_DESTINATION) #note: relative to code_root
     with show('debug'):
         if(settings.DJANGO_LOCALSETTINGS_NO_TEMPLATE):
-            put(env.localsettings_path, env.localsettings_destination)
+            upload_if_changed(localsettings_path, localsettings_destination)
         else:
-            upload_template(env.localsettings_path, env.localsettings_destination, context=env.localsettings_dict, use_sudo=True)
+            upload_if_changed(localsettings_path, localsettings_destination, context=_make_template_dict(ctx), use_sudo=True)
 
 
-def deploy(deploy_level="staging"):
+def deploy(ctx):
     """ deploy code to remote host by checking out the latest via git """
-    setup_env(deploy_level)
+    _sudo_user_warning(ctx)
     print green('In Django Module. Running deploy()...')
     sudo('echo ping!') #hack/workaround for delayed console response
-    if env.environment == 'production':
+    if ctx.environment == 'production':
         if not console.confirm('Are you sure you want to deploy production?',
                                default=False):
             utils.abort('Production deployment aborted.')
 
-    with cd(env.code_root):
-        sudo('git checkout %(code_branch)s' % env, user=env.sudo_user)
-        sudo('git pull', user=env.sudo_user)
-        sudo('git submodule init', user=env.sudo_user)
-        sudo('git submodule update', user=env.sudo_user)
-    upload_localsettings()
-    collectstatic()
+    if _use_releases():
+        build_release(ctx)
+    else:
+        sha = update_code(ctx)
+        upload_localsettings(ctx)
+        _collectstatic_step(ctx, sha)
 
-def bootstrap(deploy_level="staging"):
+def bootstrap(ctx):
     """
     Creates initial folders, clones the git repo. DOES NOT DEPLOY()
     """
-    setup_env(deploy_level)
+    _sudo_user_warning(ctx)
     print green('In Django Module. Running bootstrap()...')
     sudo('echo ping!') #hack/workaround for delayed console response
-    if env.environment == 'production':
+    if ctx.environment == 'production':
         if not console.confirm('Are you sure you want to deploy production?',
                                default=False):
             utils.abort('Production deployment aborted.')
 
-    setup_dirs()
-    clone_repo()
-    upload_localsettings()
+    setup_dirs(ctx)
+    if _use_releases():
+        _setup_releases(ctx) #the first release is built by deploy(), once the virtualenv is there
+    else:
+        clone_repo(ctx)
+        upload_localsettings(ctx)
 
 
-def stop():
+def stop(ctx):
     """
         Does nothing in this module
     """
     print green('In Django Module. Doing nothing for command stop().')
 
 
-def start():
+def start(ctx):
     """
         Does nothing in this module
     """
@@ -0,0 +1,306 @@
+"""
+Host facts.
+
+Things deploy tools needs to know about a remote host are probed once and then cached on the LOCAL machine, so that
+the modules don't each have to ask the host again.  A single command (``PROBE_SCRIPT``) finds out, in one round
+trip:
+
+* the OS, distro and version
+* how many CPUs and how much memory the host has, its disks and where they're mounted
+* which versions of postgres, apache, supervisor, couchdb and erlang are installed, and where
+* where postgres and apache keep their files: e.g. the postgres paths follow the cluster that's on the host (or, before
+  postgres is installed, the version the package manager would install), and the apache group is read from its
+  config.  Only when the host gives no answer are the usual paths of the OS (``OS_PATHS``) used.
+
+To see what deploy tools knows about your hosts (as JSON)::
+
+    $ fab production run_command:show_facts,module=modules.facts
+
+The cache is a JSON file keyed by host string.  Entries are trusted for ``FACTS_CACHE_TTL`` seconds, after
+that the host is probed again.  To throw away what's cached for your hosts (e.g. after an OS upgrade), run::
+
+    $ fab production run_command:clear_facts,module=modules.facts
+
+Modules get at the facts with ``get_facts()`` (``what_os()`` in the utils module reads from it too).
+
+Facts Module Settings
+---------------------
+::
+
+    FACTS_CACHE_PATH = "~/.deploy_tools/facts.json" #Path to the cache file ON THE LOCAL machine
+    FACTS_CACHE_TTL = 86400 #How long (in seconds) cached facts are trusted. 0 means always probe (once per run).
+
+"""
+from __future__ import absolute_import
+import os
+import re
+import time
+import json
+import posixpath
+from fabric import utils
+from fabric.api import env
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run
+from modules import recorder
+import settings
+
+#Paths used when the probe can't tell (e.g. a package manager we don't know).
+OS_PATHS = {
+    'ubuntu': {
+        'httpd_service': 'apache2',
+        'httpd_conf_root': '/etc/apache2/sites-enabled',
+        'httpd_user_group': 'www-data',
+        'pg_conf_dir': '/etc/postgresql/8.4/main',
+        'pg_init_name': 'postgresql-8.4',
+        'pg_data_dir': '/var/lib/postgresql/8.4/main',
+    },
+    'redhat': {
+        'httpd_service': 'httpd',
+        'httpd_conf_root': '/etc/httpd/conf.d',
+        'httpd_user_group': 'apache',
+        'pg_conf_dir': '/var/lib/pgsql/data',
+        'pg_init_name': 'postgresql',
+        'pg_data_dir': '/var/lib/pgsql/data',
+    },
+}
+
+#Prints "<key>=<value>" lines (keys can repeat, see _parse()).  Only reads what any user can read, and has no
+#backslashes in it (fabric doesn't escape those when it wraps the command in double quotes).
+PROBE_SCRIPT = '''test -f /etc/lsb-release && sed -n -e 's/^DISTRIB_ID=/lsb_id=/p' -e 's/^DISTRIB_RELEASE=/lsb_release=/p' /etc/lsb-release
+test -f /etc/redhat-release && echo "redhat_release=$(head -n 1 /etc/redhat-release)"
+PATH=$PATH:/usr/sbin:/sbin:/usr/local/bin:/usr/local/sbin; export PATH
+echo "cpus=$(grep -c ^processor /proc/cpuinfo)"
+awk '$1 == "MemTotal:" { print "memory_kb=" $2 }' /proc/meminfo
+df -P -k 2>/dev/null | awk 'NR > 1 && $1 ~ /^[/]dev[/]/ { print "mount=" $6 " " $1 " " $2 " " $4 }'
+echo "postgres_version=$(psql --version 2>/dev/null | head -n 1)"
+echo "postgres_path=$(command -v psql)"
+echo "postgres_clusters="$(ls -d /etc/postgresql/*/main 2>/dev/null)
+echo "postgres_candidate=$(apt-cache depends postgresql 2>/dev/null | sed -n 's/.*Depends: postgresql-//p' | head -n 1)"
+echo "postgres_init_scripts="$(ls /etc/init.d 2>/dev/null | grep '^postgresql')
+echo "apache_version=$( (apache2ctl -v || httpd -v) 2>/dev/null | sed -n 's/^Server version: //p')"
+echo "apache_path=$(command -v apache2 || command -v httpd)"
+echo "apache_conf_roots="$(ls -d /etc/apache2/sites-enabled /etc/httpd/conf.d 2>/dev/null)
+echo "apache_group=$( (sed -n 's/^export APACHE_RUN_GROUP=//p' /etc/apache2/envvars; sed -n 's/^Group //p' /etc/httpd/conf/httpd.conf) 2>/dev/null | head -n 1)"
+echo "supervisor_version=$(supervisord --version 2>/dev/null | head -n 1)"
+echo "supervisor_path=$(command -v supervisord)"
+echo "couchdb_version=$(couchdb -V 2>/dev/null | head -n 1)"
+echo "couchdb_path=$(command -v couchdb)"
+erl=$(command -v erl); echo "erlang_path=$erl"
+test -n "$erl" && echo "erlang_version="$(ls "$(sed -n 's/^ROOTDIR=//p' "$erl" | tr -d '"')/releases" 2>/dev/null | grep -v RELEASES | tail -n 1)
+true'''
+
+SERVICES = ('postgres', 'apache', 'supervisor', 'couchdb', 'erlang')
+FORMAT = 2 #bumped whenever the facts change shape, so older cache entries get probed again
+
+_cache = None #the cache file's contents, loaded on first use
+_probed = {} #facts probed during this run, by host
+
+
+def _cache_path():
+    return os.path.expanduser(getattr(settings, 'FACTS_CACHE_PATH', '~/.deploy_tools/facts.json'))
+
+def _cache_ttl():
+    return getattr(settings, 'FACTS_CACHE_TTL', 86400)
+
+def _load_cache():
+    try:
+        with open(_cache_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _save_cache(host, facts):
+    """
+    Writes the facts for one host to the cache file.
+
+    The file is read again right before writing, so that other fab processes (e.g. other hosts in a parallel run)
+    don't lose their entries.
+    """
+    path = _cache_path()
+    cache = _load_cache()
+    if facts is None:
+        cache.pop(host, None)
+    else:
+        cache[host] = facts
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path) #atomic, readers never see half a file
+
+def _parse(out):
+    r"""
+    Turns the probe's output into a dict.  'mount' lines are collected in a list, the other keys are set once.
+
+    >>> raw = _parse('lsb_id=Ubuntu\nmount=/ /dev/sda1 100 50\nmount=/opt /dev/sdb1 200 150\napache_path=\n')
+    >>> raw['lsb_id'], raw['mount'], raw['apache_path']
+    ('Ubuntu', ['/ /dev/sda1 100 50', '/opt /dev/sdb1 200 150'], '')
+    """
+    raw = {'mount': []}
+    for line in out.replace('\r', '').split('\n'):
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        if key == 'mount':
+            raw['mount'].append(value.strip())
+        else:
+            raw[key] = value.strip()
+    return raw
+
+def _version(text):
+    """
+    >>> _version('psql (PostgreSQL) 8.4.20'), _version('Apache/2.2.14 (Ubuntu)'), _version('')
+    ('8.4.20', '2.2.14', None)
+    """
+    match = re.search(r'\d+(\.\d+)*', text or '')
+    return match and match.group(0) or None
+
+def _pg_major(version):
+    """
+    The part of a postgres version its paths are named after ('8.4' up to 9.6, '10' from 10 on).
+
+    >>> _pg_major('8.4.20'), _pg_major('9.1'), _pg_major('10.5')
+    ('8.4', '9.1', '10')
+    """
+    parts = version.split('.')
+    return int(parts[0]) >= 10 and parts[0] or '.'.join(parts[:2])
+
+def _postgres_paths(facts, raw):
+    """
+    Where postgres keeps its files on this host: the cluster that's there, or else the one the package manager
+    would install.
+    """
+    paths = {}
+    init_scripts = raw.get('postgres_init_scripts', '').split()
+    clusters = sorted(raw.get('postgres_clusters', '').split(), key=lambda p: [int(x) for x in re.findall(r'\d+', p)])
+    if facts['os'] == 'ubuntu':
+        if clusters:
+            major = posixpath.basename(posixpath.dirname(clusters[-1])) #/etc/postgresql/<major>/main
+        else:
+            version = _version(raw.get('postgres_candidate')) or facts['services']['postgres']['version']
+            major = version and _pg_major(version)
+        if not major:
+            return paths
+        paths['pg_conf_dir'] = '/etc/postgresql/%s/main' % major
+        paths['pg_data_dir'] = '/var/lib/postgresql/%s/main' % major
+        if 'postgresql-%s' % major in init_scripts or (not init_scripts and float(major) < 9):
+            paths['pg_init_name'] = 'postgresql-%s' % major #the init script was per version up to 8.4
+        else:
+            paths['pg_init_name'] = 'postgresql'
+    else:
+        versioned = [name for name in init_scripts if name.startswith('postgresql-')]
+        if versioned: #postgres from the PGDG repos, e.g. postgresql-9.2 with its data in /var/lib/pgsql/9.2/data
+            major = versioned[-1][len('postgresql-'):]
+            paths['pg_init_name'] = versioned[-1]
+            paths['pg_conf_dir'] = paths['pg_data_dir'] = '/var/lib/pgsql/%s/data' % major
+    return paths
+
+def _apache_paths(facts, raw):
+    paths = {}
+    conf_roots = raw.get('apache_conf_roots', '').split()
+    if conf_roots:
+        paths['httpd_conf_root'] = conf_roots[0]
+        paths['httpd_service'] = 'apache2' in conf_roots[0] and 'apache2' or 'httpd'
+    if raw.get('apache_group') and not raw['apache_group'].startswith('$'):
+        paths['httpd_user_group'] = raw['apache_group']
+    return paths
+
+def _facts(raw):
+    """
+    Makes the facts out of what the probe found (see get_facts() for the keys).
+    """
+    facts = {}
+    if raw.get('lsb_id') == 'Ubuntu':
+        print 'Found lsb-release and contains "DISTRIB_ID=Ubuntu", this is an Ubuntu System.'
+        facts['os'] = 'ubuntu'
+        facts['distro'] = 'Ubuntu'
+        facts['version'] = raw.get('lsb_release') or 'unknown'
+    elif raw.get('redhat_release'):
+        print 'Found /etc/redhat-release, this is a RedHat system.'
+        facts['os'] = 'redhat'
+        facts['distro'] = raw['redhat_release'].split(' release')[0]
+        match = re.search(r'release (\S+)', raw['redhat_release'])
+        facts['version'] = match and match.group(1) or 'unknown'
+    else:
+        utils.abort('System OS not recognized! Aborting.')
+
+    facts['cpus'] = int(raw.get('cpus') or 0)
+    facts['memory_mb'] = int(raw.get('memory_kb') or 0) // 1024
+    facts['mounts'] = []
+    for line in raw['mount']:
+        fields = line.split()
+        if len(fields) == 4:
+            facts['mounts'].append({'mount': fields[0], 'device': fields[1],
+                                    'size_mb': int(fields[2]) // 1024, 'free_mb': int(fields[3]) // 1024})
+    facts['services'] = {}
+    for service in SERVICES:
+        version = raw.get('%s_version' % service)
+        facts['services'][service] = {
+            'version': service == 'erlang' and version or _version(version), #erlang releases look like R13B03
+            'path': raw.get('%s_path' % service) or None,
+        }
+
+    facts.update(OS_PATHS[facts['os']])
+    facts.update(_postgres_paths(facts, raw))
+    facts.update(_apache_paths(facts, raw))
+    return facts
+
+def _probe():
+    """
+    Asks the host what it is, in a single round trip.
+    """
+    print 'Probing host facts...'
+    with fab_settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
+        out = run(PROBE_SCRIPT)
+    return _facts(_parse(out))
+
+def get_facts(refresh=False):
+    """
+    Returns a dict of facts about the current host (env.host_string), probing the host only if nothing
+    (fresh) is cached for it.
+
+    Keys:
+
+    * os ('ubuntu' or 'redhat'), distro, version
+    * cpus, memory_mb
+    * mounts: a list of {'mount', 'device', 'size_mb', 'free_mb'}
+    * services: {'postgres', 'apache', 'supervisor', 'couchdb', 'erlang'} -> {'version', 'path'} (both None when
+      the service isn't installed)
+    * the paths in OS_PATHS, as found on the host
+    """
+    global _cache
+    if _cache is None:
+        _cache = _load_cache()
+    host = env.host_string
+    if not refresh and host in _probed:
+        return _probed[host]
+    entry = _cache.get(host)
+    if not refresh and entry is not None and entry.get('format') == FORMAT and time.time() - entry['probed_at'] < _cache_ttl():
+        return entry['facts']
+
+    facts = _probed[host] = _probe()
+    entry = {'probed_at': time.time(), 'format': FORMAT, 'facts': facts}
+    _cache[host] = entry
+    planning = recorder.active() and recorder.active().fake
+    if _cache_ttl() > 0 and not planning: #made up facts don't go in the cache
+        _save_cache(host, entry)
+    return facts
+
+def clear_facts():
+    """
+    Removes the current host from the facts cache, so that it gets probed again next time.
+    """
+    global _cache
+    _probed.pop(env.host_string, None)
+    if _cache is not None:
+        _cache.pop(env.host_string, None)
+    _save_cache(env.host_string, None)
+    print 'Cleared cached facts for %s' % env.host_string
+
+def show_facts(refresh=False):
+    """
+    Prints the facts about the current host, as JSON.
+    """
+    print json.dumps(get_facts(refresh=refresh not in (False, 'False', 'false', '0')), indent=2, sort_keys=True)
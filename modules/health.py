@@ -0,0 +1,122 @@
+"""
+Health checks of the app servers, used to gate rolling deploys (see 'Rolling deploys' in the fabfile docs).
+
+A deploy doesn't restart the app by itself, so before each batch is checked the app is restarted on its hosts with
+``ROLLING_RESTART_COMMAND``, so the check sees the new code.  Set it to None if your deploy restarts the app some
+other way (the check then warns that it may be looking at the old code).
+
+The check runs on the host itself, in one round trip: it waits (up to ``ROLLING_HEALTH_WAIT`` seconds) for gunicorn
+to answer on ``DJANGO_GUNICORN_PORT`` at all, then requests ``ROLLING_HEALTH_PATH`` ``ROLLING_HEALTH_SAMPLES`` times
+with curl, noting the status code and the time each request took.  A host is healthy when the share of failed
+requests (no answer, or a status of 400 and up) and the 90th percentile of the request times stay within
+``ROLLING_MAX_ERROR_RATE`` and ``ROLLING_MAX_LATENCY``.
+
+Health Settings
+---------------
+::
+
+    ROLLING_MIN_CAPACITY = 0.5 #Share of the hosts that must keep serving while a batch is deployed
+    ROLLING_RESTART_COMMAND = "supervisorctl restart all" #Run (with sudo) on each host of a batch before checking it
+    ROLLING_HEALTH_PORT = DJANGO_GUNICORN_PORT #Port the app answers on (on the host)
+    ROLLING_HEALTH_PATH = "/" #URL path requested by the health check
+    ROLLING_HEALTH_WAIT = 60 #Seconds to wait for the app to answer after a deploy before giving up
+    ROLLING_HEALTH_SAMPLES = 10 #Requests made per health check
+    ROLLING_HEALTH_INTERVAL = 0.5 #Seconds between two requests
+    ROLLING_MAX_ERROR_RATE = 0.1 #Share of failed requests above which the deploy halts
+    ROLLING_MAX_LATENCY = 2.0 #90th percentile of the request times (seconds) above which the deploy halts
+
+"""
+from __future__ import absolute_import
+import re
+import math
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run, sudo
+import settings
+
+_SAMPLE = re.compile(r'^(\d{3}) ([\d.]+)$')
+
+_CHECK = ('url="http://127.0.0.1:%(port)s%(path)s"; end=$(( $(date +%%s) + %(wait)d )); '
+          'until curl -s -o /dev/null --max-time 5 "$url"; do [ $(date +%%s) -ge $end ] && break; sleep 1; done; '
+          'for i in $(seq %(samples)d); do '
+          'curl -s -o /dev/null --max-time %(timeout)d -w "%%{http_code} %%{time_total}\\n" "$url"; sleep %(interval)s; '
+          'done; true')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+def percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of the values fall (nearest rank).
+
+    >>> percentile(range(1, 11), 0.9)
+    9
+    >>> percentile([3, 1, 2], 0.5)
+    2
+    >>> percentile([5], 0.9)
+    5
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+def parse(out):
+    """
+    Returns the (status code, seconds) of each request in the output of the check.
+    """
+    samples = []
+    for line in out.replace('\r', '').split('\n'):
+        match = _SAMPLE.match(line.strip())
+        if match:
+            samples.append((int(match.group(1)), float(match.group(2))))
+    return samples
+
+def evaluate(samples):
+    """
+    Returns {'samples', 'errors', 'error_rate', 'latency', 'ok', 'reason'} for the given samples.
+    """
+    max_error_rate = _setting('ROLLING_MAX_ERROR_RATE', 0.1)
+    max_latency = _setting('ROLLING_MAX_LATENCY', 2.0)
+    errors = len([code for code, seconds in samples if code == 0 or code >= 400])
+    result = {
+        'samples': len(samples),
+        'errors': errors,
+        'error_rate': float(errors) / len(samples) if samples else 1.0,
+        'latency': percentile([seconds for code, seconds in samples], 0.9),
+        'ok': True,
+        'reason': None,
+    }
+    if not samples:
+        result['ok'], result['reason'] = False, 'no answer from the health check'
+    elif result['error_rate'] > max_error_rate:
+        result['ok'], result['reason'] = False, 'error rate %.0f%% > %.0f%%' % (result['error_rate'] * 100, max_error_rate * 100)
+    elif result['latency'] > max_latency:
+        result['ok'], result['reason'] = False, 'p90 latency %.2fs > %.2fs' % (result['latency'], max_latency)
+    return result
+
+def restart_app():
+    """
+    Restarts the app on the current host with ROLLING_RESTART_COMMAND.  Returns False if there's no such command.
+    """
+    command = _setting('ROLLING_RESTART_COMMAND', 'supervisorctl restart all')
+    if not command:
+        return False
+    sudo(command)
+    return True
+
+def check_health():
+    """
+    Checks the app on the current host.  Returns the result of evaluate().
+    """
+    params = {
+        'port': _setting('ROLLING_HEALTH_PORT', getattr(settings, 'DJANGO_GUNICORN_PORT', '80')),
+        'path': _setting('ROLLING_HEALTH_PATH', '/'),
+        'wait': _setting('ROLLING_HEALTH_WAIT', 60),
+        'samples': _setting('ROLLING_HEALTH_SAMPLES', 10),
+        'interval': _setting('ROLLING_HEALTH_INTERVAL', 0.5),
+        'timeout': max(5, int(_setting('ROLLING_MAX_LATENCY', 2.0) * 2)),
+    }
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run(_CHECK % params)
+    return evaluate(parse(out))
@@ -0,0 +1,181 @@
+"""
+Step ledger.
+
+Some steps are slow and give the same result as long as their inputs don't change: installing the pip requirements,
+the OS packages, supervisor, running collectstatic.  A module can run such a step through ``step()``, declaring what
+it depends on (hashes of local files, settings values, the git commit...)::
+
+    ledger.step(ctx, 'packages.pip_install', {'requirements': _requirements_hash(), 'virtualenv': ctx.virtualenv_root},
+                install_packages, (ctx,))
+
+The inputs are hashed into a fingerprint.  Each host keeps a ledger (``PROJECT_ROOT/ledger/<environment>/``, one
+small file per step) of the fingerprint of the last successful run of each step and how long it took.  A step whose
+fingerprint matches the one in the ledger is skipped.  The ledger is read once per host (on the first step), and the
+steps that ran are written to it in one go when the host is done, so it costs two round trips per host at most.
+A step that fails isn't written, so it runs again next time.
+
+At the end of the run, the steps that were skipped are listed along with the time they took the last time they ran
+(the time saved).
+
+The ledger only knows about the inputs it was given, so a step is not rerun when something else changed on the host
+(e.g. a package removed by hand).  Put ``force`` in front of a command to run some (or all) steps anyway::
+
+    $ fab production force:packages.pip_install deploy
+    $ fab production force:packages.pip_install,django.collectstatic deploy
+    $ fab production force deploy
+
+Ledger Settings
+---------------
+::
+
+    LEDGER_ENABLED = True #(default is True) Skip steps whose inputs didn't change since their last successful run
+
+"""
+from __future__ import absolute_import
+import os
+import re
+import time
+import hashlib
+import posixpath
+from fabric import utils
+from fabric.api import env
+from fabric.colors import green
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run
+import settings
+
+_STEP_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+_ledgers = {} #(host, environment) -> {step: (fingerprint, seconds)}, read from the host
+_pending = {} #(host, environment) -> {step: (fingerprint, seconds)}, to be written to the host
+_skipped = [] #(host, step, seconds) of the steps skipped during this run
+
+
+def enabled():
+    return getattr(settings, 'LEDGER_ENABLED', True)
+
+def fingerprint(inputs):
+    """
+    Hashes a dict of inputs (of strings, numbers, lists...).
+
+    >>> fingerprint({'a': 1, 'b': ['x', 'y']}) == fingerprint({'b': ['x', 'y'], 'a': 1})
+    True
+    >>> fingerprint({'a': 1}) == fingerprint({'a': 2})
+    False
+    """
+    return hashlib.sha1(repr(sorted(inputs.items()))).hexdigest()
+
+def file_hash(path):
+    """
+    The sha1 of a local file, for use as an input (None if there's no such file).
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _root(ctx):
+    return posixpath.join(ctx.project_root, 'ledger', ctx.environment)
+
+def _parse(out):
+    """
+    Turns the output of the ledger read (``<path>:<fingerprint> <seconds> <time>`` lines) into a dict.
+
+    >>> _parse('/x/ledger/staging/os.packages:ab12 3.5 1700000000\\ngarbage\\n')
+    {'os.packages': ('ab12', 3.5)}
+    """
+    entries = {}
+    for line in out.replace('\r', '').split('\n'):
+        path, _, entry = line.strip().partition(':')
+        fields = entry.split()
+        if len(fields) >= 2:
+            try:
+                entries[posixpath.basename(path)] = (fields[0], float(fields[1]))
+            except ValueError:
+                continue
+    return entries
+
+def load(ctx):
+    """
+    Returns the ledger of the current host, read from the host once per run.
+    """
+    key = (env.host_string, ctx.environment)
+    if key not in _ledgers:
+        with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            out = run('grep -s -H "" %s/*; true' % _root(ctx))
+        _ledgers[key] = _parse(out)
+    return _ledgers[key]
+
+def _forced(name):
+    steps = env.get('force_steps')
+    return steps is not None and (not steps or name in steps)
+
+def step(ctx, name, inputs, function, args=(), force=False):
+    """
+    Calls function(*args) unless the ledger of the current host shows it was already run with the same inputs.
+    Returns what the function returned (None when it was skipped).  With 'force' (or when the step is named in
+    ``fab force:...``), the function is always called, and the ledger updated.
+    """
+    if not _STEP_NAME.match(name):
+        utils.abort('Invalid ledger step name: %s' % name)
+    if not enabled():
+        return function(*args)
+    fp = fingerprint(inputs)
+    if not force and not _forced(name):
+        entry = load(ctx).get(name)
+        if entry and entry[0] == fp:
+            print green('Skipping %s, its inputs didn\'t change since it last ran (%.1fs).' % (name, entry[1]))
+            _skipped.append((env.host_string, name, entry[1]))
+            return None
+    start = time.time()
+    result = function(*args)
+    _pending.setdefault((env.host_string, ctx.environment), {})[name] = (fp, time.time() - start)
+    return result
+
+def flush(ctx):
+    """
+    Writes the steps that ran on the current host to its ledger, in one round trip.
+    """
+    key = (env.host_string, ctx.environment)
+    entries = _pending.pop(key, {})
+    if not entries:
+        return
+    root = _root(ctx)
+    commands = ['mkdir -p %s' % root]
+    now = int(time.time())
+    for name, (fp, seconds) in sorted(entries.items()):
+        path = posixpath.join(root, name)
+        commands.append('echo %s %.1f %d > %s.new && mv -f %s.new %s' % (fp, seconds, now, path, path, path))
+    with fab_settings(hide('running', 'stdout')):
+        run(' && '.join(commands))
+    _ledgers.setdefault(key, {}).update(entries)
+
+def take_skipped():
+    """
+    Returns (and forgets) the steps skipped so far, e.g. to send them from a child process to its parent.
+    """
+    skipped = list(_skipped)
+    del _skipped[:]
+    return skipped
+
+def add_skipped(skipped):
+    _skipped.extend(skipped)
+
+def report():
+    """
+    Prints the steps that were skipped in this run, and the time that saved (going by their last run).
+    """
+    skipped = take_skipped()
+    if not skipped:
+        return
+    steps = {}
+    for host, name, seconds in skipped:
+        s = steps.setdefault(name, {'hosts': 0, 'seconds': 0.0})
+        s['hosts'] += 1
+        s['seconds'] += seconds
+    print green('========== Steps skipped (inputs unchanged, see the ledger module) ==========')
+    print '%-40s %6s %12s' % ('step', 'hosts', 'time saved')
+    for name, s in sorted(steps.items(), key=lambda item: -item[1]['seconds']):
+        print '%-40s %6d %11.1fs' % (name, s['hosts'], s['seconds'])
+    print '%-40s %6s %11.1fs' % ('total', '', sum(s['seconds'] for s in steps.values()))
+    print 'Put "force:<step>" in front of the command to run a step anyway.'
@@ -0,0 +1,111 @@
+"""
+Deploy locks.
+
+Every fabfile command that changes a host (``deploy``, ``bootstrap``, ``start``, ``stop`` and ``run_command``) takes
+a lock on the host for its environment first, so two people (or CI jobs) deploying at once don't run git, pip and
+collectstatic on top of each other.  The lock is a folder (``PROJECT_ROOT/locks/<environment>.lock``, created with
+``mkdir``, which either succeeds or fails at once) holding who took it and when.
+
+A command that finds the host locked waits for it.  Deploys are coalesced: only one deploy waits per host, the
+newest one.  Each waiting deploy leaves its name in ``<environment>.deploy.queue``, replacing the name of the one
+that was waiting before it, which then gives up on that host ("superseded").  Once the lock is released, the newest
+waiting deploy runs, once.  Since a deploy always deploys the latest commit of the branch, a burst of deploys ends up
+as the running deploy plus one more, instead of one after the other.  Other commands (``stop``, ``run_command``...)
+are never superseded, they just wait their turn.
+
+With ``DISTRIBUTE_FANOUT`` set, ``deploy`` and ``bootstrap`` take the lock of every host before the artifact is
+built, and keep it until they're done with all the hosts, so a waiting deploy doesn't replace the artifact of the one
+running (see the distribute module).
+
+Waiting happens on the host (in one command), it is given up after ``LOCK_WAIT`` seconds.  A lock that's older than
+``LOCK_STALE_AFTER`` seconds is assumed to be left over from a deploy that died, and is broken.  To break a lock by
+hand::
+
+    $ fab production unlock
+
+Lock Settings
+-------------
+::
+
+    LOCK_WAIT = 1800 #Seconds to wait for a locked host before giving up
+    LOCK_STALE_AFTER = 7200 #Seconds after which a lock is assumed to be left over, and broken
+
+"""
+from __future__ import absolute_import
+import os
+import time
+import socket
+import getpass
+import posixpath
+from fabric import utils
+from fabric.api import env
+from fabric.colors import yellow
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run
+import settings
+
+#the name of this run (the same on every host)
+TOKEN = '%s@%s-%d-%d' % (getpass.getuser(), socket.gethostname(), os.getpid(), int(time.time()))
+
+_ACQUIRE = '''mkdir -p %(root)s; cd %(root)s
+take() { mkdir %(name)s.lock 2>/dev/null && echo "%(token)s $(date '+%%Y-%%m-%%d %%H:%%M:%%S') %(command)s" > %(name)s.lock/owner; }
+take && { echo ACQUIRED; exit 0; }
+coalesce=%(coalesce)d
+[ $coalesce = 0 ] || { echo "%(token)s" > %(queue)s.$$ && mv -f %(queue)s.$$ %(queue)s; }
+echo "WAITING $(cat %(name)s.lock/owner 2>/dev/null)"
+end=$(( $(date +%%s) + %(wait)d ))
+while true; do
+    [ $coalesce = 0 ] || [ "$(cat %(queue)s 2>/dev/null)" = "%(token)s" ] || { echo "SUPERSEDED $(cat %(queue)s 2>/dev/null)"; exit 0; }
+    if take; then
+        [ $coalesce = 0 ] || [ "$(cat %(queue)s 2>/dev/null)" != "%(token)s" ] || rm -f %(queue)s
+        echo ACQUIRED; exit 0
+    fi
+    if [ -d %(name)s.lock ] && [ $(( $(date +%%s) - $(stat -c %%Y %(name)s.lock) )) -gt %(stale)d ]; then
+        echo "BROKE $(cat %(name)s.lock/owner 2>/dev/null)"; rm -rf %(name)s.lock; continue
+    fi
+    [ $(date +%%s) -ge $end ] && { echo TIMEOUT; exit 0; }
+    sleep 2
+done'''
+
+#commands of which only the newest waiting one runs (see above)
+COALESCED_COMMANDS = ('deploy',)
+
+def _root():
+    return posixpath.join(settings.PROJECT_ROOT, 'locks')
+
+def acquire(command):
+    """
+    Takes the lock of the current host (waiting for it if needed).  Returns True once it's taken, False if this run
+    was superseded by a newer one.  Aborts when the wait times out.
+    """
+    script = _ACQUIRE % dict(root=_root(), name=env.environment, token=TOKEN, command=command,
+                             coalesce=command in COALESCED_COMMANDS, queue='%s.%s.queue' % (env.environment, command),
+                             wait=int(getattr(settings, 'LOCK_WAIT', 1800)),
+                             stale=int(getattr(settings, 'LOCK_STALE_AFTER', 7200)))
+    with fab_settings(hide('running', 'stdout')):
+        out = run(script)
+    for line in out.replace('\r', '').split('\n'):
+        if line.startswith('WAITING'):
+            print yellow('%s is locked (%s), waiting...' % (env.host_string, line[len('WAITING '):] or 'by someone'))
+        elif line.startswith('BROKE'):
+            print yellow('Broke the stale lock of %s (%s)' % (env.host_string, line[len('BROKE '):]))
+        elif line.startswith('SUPERSEDED'):
+            print yellow('A newer command (%s) is waiting for %s, leaving it to that one.'
+                         % (line[len('SUPERSEDED '):].strip() or 'already running', env.host_string))
+            return False
+        elif line == 'TIMEOUT':
+            utils.abort('Gave up waiting for the lock of %s after %s seconds.' % (env.host_string, getattr(settings, 'LOCK_WAIT', 1800)))
+        elif line == 'ACQUIRED':
+            return True
+    utils.abort('Could not take the lock of %s: %s' % (env.host_string, out))
+
+def release(force=False):
+    """
+    Releases the lock of the current host (only if this run holds it, unless 'force' is given).
+    """
+    lock = posixpath.join(_root(), '%s.lock' % env.environment)
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        if force:
+            run('cat %s/owner 2>/dev/null; rm -rf %s' % (lock, lock))
+        else:
+            run('grep -q "^%s " %s/owner 2>/dev/null && rm -rf %s; true' % (TOKEN, lock, lock))
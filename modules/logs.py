@@ -0,0 +1,151 @@
+"""
+Log collection.
+
+Gets the logs of every host (the app logs in ``ctx.log_dir`` and the apache and supervisor logs) and merges them into
+one stream, in time order::
+
+    $ fab production collect_logs:since=2h,parallel=8
+    $ fab production collect_logs:since="2026-10-18 09:30"
+
+``since`` is either a time (``YYYY-MM-DD HH:MM[:SS]``, in the hosts' time zone) or a duration back from now on the
+host (``90s``, ``30m``, ``2h``, ``1d``).  Without it, whole logs are collected.
+
+On each host, the log files (plain or gzipped) are read once: every line gets the time it was logged (lines without
+a time of their own, like tracebacks, get the time of the line before them), lines from before ``since`` are
+dropped, and what's left is sorted by time and gzipped, all without leaving the host.  Files that weren't modified
+since ``since`` aren't read at all.  The archives come back at the same time when ``parallel`` is given.  They're
+then merged into ``merged.log``, one line at a time, so logs of any size can be merged on the deploy machine.  Each
+line of the merged log is prefixed with the host and file it came from.
+
+Times are recognized in the usual formats (``2026-10-18 09:30:00`` as written by python's logging and supervisor,
+``[18/Oct/2026:09:30:00 +0000]`` in apache access logs, ``[Sun Oct 18 09:30:00 2026]`` in apache error logs).  Time
+zone offsets are ignored.
+
+To only fetch the logs of each host (without merging them)::
+
+    $ fab production run_command:collect_logs,module=modules.logs,since=2h
+
+Logs Settings
+-------------
+::
+
+    LOGS_PATHS = ["%(log_dir)s/*.log*", "/var/log/apache2/*.log*", "/var/log/httpd/*log*", "/var/log/supervisor/*.log*"]
+    LOGS_LOCAL_DIR = "logs" #Where the logs are put ON THE LOCAL machine (in a folder per run)
+
+"""
+from __future__ import absolute_import
+import os
+import re
+import gzip
+import time
+import heapq
+import posixpath
+from fabric.api import env
+from fabric.colors import green
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import sudo, get
+import settings
+
+DEFAULT_PATHS = ["%(log_dir)s/*.log*", "/var/log/apache2/*.log*", "/var/log/httpd/*log*", "/var/log/supervisor/*.log*"]
+
+#Prints "<time>\t<file>\t<line>" for the lines logged at or after 'since' ("YYYY-MM-DD HH:MM:SS").
+#Plain POSIX awk (no interval expressions), so it works with mawk too.
+TIMESTAMP_AWK = r'''
+BEGIN { M = "JanFebMarAprMayJunJulAugSepOctNovDec" }
+function mon(m) { return sprintf("%02d", (index(M, m) + 2) / 3) }
+{
+    t = ""
+    if (match($0, /[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9][ T][0-9][0-9]:[0-9][0-9]:[0-9][0-9]/)) {
+        s = substr($0, RSTART, RLENGTH); t = substr(s, 1, 10) " " substr(s, 12, 8)
+    } else if (match($0, /[0-9][0-9]\/[A-Z][a-z][a-z]\/[0-9][0-9][0-9][0-9]:[0-9][0-9]:[0-9][0-9]:[0-9][0-9]/)) {
+        s = substr($0, RSTART, RLENGTH); t = substr(s, 8, 4) "-" mon(substr(s, 4, 3)) "-" substr(s, 1, 2) " " substr(s, 13, 8)
+    } else if (match($0, /[A-Z][a-z][a-z] [ 0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9](\.[0-9]+)? [0-9][0-9][0-9][0-9]/)) {
+        s = substr($0, RSTART, RLENGTH); t = substr(s, RLENGTH - 3, 4) "-" mon(substr(s, 1, 3)) "-" sprintf("%02d", substr(s, 5, 2)) " " substr(s, 8, 8)
+    }
+    if (t != "") last = t; else t = last
+    if (t == "") t = "0000-00-00 00:00:00"
+    if (t >= since) print t "\t" file "\t" $0
+}
+'''
+
+_DURATION = re.compile(r'^(\d+)([smhd])$')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _since_cmd(since):
+    """
+    Returns a shell expression for the start of the time window ("YYYY-MM-DD HH:MM:SS", worked out on the host).
+    """
+    if not since:
+        return '""'
+    duration = _DURATION.match(str(since).strip())
+    if duration:
+        seconds = int(duration.group(1)) * _UNITS[duration.group(2)]
+        return '"$(date -d @$(( $(date +%%s) - %d )) \'+%%Y-%%m-%%d %%H:%%M:%%S\')"' % seconds
+    since = str(since).strip().replace('T', ' ')
+    if len(since) == len('YYYY-MM-DD HH:MM'):
+        since += ':00'
+    return '"%s"' % since
+
+def _paths(ctx):
+    return ' '.join(path % ctx for path in getattr(settings, 'LOGS_PATHS', DEFAULT_PATHS))
+
+def local_dir(name=None):
+    """
+    Returns (and creates) a local folder for collected logs: one per run when the fabfile collects them, one per
+    environment otherwise.
+    """
+    directory = os.path.join(getattr(settings, 'LOGS_LOCAL_DIR', 'logs'), name or env.get('environment', 'logs'))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+def run_dir():
+    return local_dir('%s-%s' % (env.get('environment', 'logs'), time.strftime('%Y%m%d-%H%M%S')))
+
+def collect_logs(ctx, since=None, directory=None):
+    """
+    Filters, sorts and compresses the logs of the current host on the host, then gets them (see above).
+    """
+    directory = directory or local_dir()
+    remote_archive = '/tmp/deploy_tools-logs-%s-%d.gz' % (env.host_string.replace('@', '_').replace(':', '_'), os.getpid())
+    script = ("since=%(since)s; for f in %(paths)s; do [ -f \"$f\" ] || continue; "
+              "[ -z \"$since\" ] || [ \"$(date -r \"$f\" '+%%Y-%%m-%%d %%H:%%M:%%S')\" \\> \"$since\" ] || continue; "
+              "case \"$f\" in *.gz) zcat \"$f\";; *) cat \"$f\";; esac | awk -v file=\"$f\" -v since=\"$since\" '%(awk)s'; "
+              "done | LC_ALL=C sort -s -t \"$(printf '\\t')\" -k1,1 | gzip -c > %(archive)s; chmod a+r %(archive)s"
+              % dict(since=_since_cmd(since), paths=_paths(ctx), awk=TIMESTAMP_AWK.strip(), archive=remote_archive))
+    print green('Collecting the logs of %s...' % env.host_string)
+    with fab_settings(hide('running')):
+        sudo(script)
+        local_archive = os.path.join(directory, '%s.log.gz' % env.host_string.replace(':', '_'))
+        get(remote_archive, local_archive)
+        sudo('rm -f %s' % remote_archive)
+    return local_archive
+
+def _lines(host, path):
+    f = gzip.open(path)
+    try:
+        for line in f:
+            t, _, rest = line.partition('\t')
+            yield t, host, rest
+    finally:
+        f.close()
+
+def merge_logs(directory, output=None):
+    """
+    Merges the collected logs in the directory (one <host>.log.gz each) into one file, in time order, one line at a
+    time.  Returns the path of the merged log.
+    """
+    output = output or os.path.join(directory, 'merged.log')
+    streams = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.log.gz'):
+            streams.append(_lines(name[:-len('.log.gz')], os.path.join(directory, name)))
+    count = 0
+    with open(output, 'w') as out:
+        for t, host, rest in heapq.merge(*streams):
+            filename, _, line = rest.partition('\t')
+            out.write('[%s] %s: %s' % (host, posixpath.basename(filename), line))
+            count += 1
+    print green('Merged %d lines from %d hosts into %s' % (count, len(streams), output))
+    return output
@@ -7,7 +7,7 @@ Installs base packages
 
 Misc OS level config
 
-This module set env.user to your settings.SUDO_USER, be sure to have that set to a good value in your settings file!
+The fabfile logs in to your hosts as settings.SUDO_USER, be sure to have that set to a good value in your settings file!
 
 OS MODULE SPECIFIC SETTINGS
 ---------------------------
@@ -20,74 +20,55 @@ OS MODULE SPECIFIC SETTINGS
 from fabric.api import *
 from fabric.colors import green
 from fabric import utils
-from modules.utils import what_os
+from modules.utils import install_missing_packages
+from modules import ledger
 import settings
 
-def setup_env(deploy_level="staging"):
-    if deploy_level == "staging":
-        _staging()
-    elif deploy_level == "production":
-        _production()
-    else:
-        utils.abort("Unrecognized Deploy Level: %s" % deploy_level)
-    env.os = what_os()
-    if env.os == 'ubuntu':
-        env.package_list = settings.OS_PACKAGE_LIST_PATH_UBUNTU
-        env.package_install_cmd = 'apt_get install -y'
-    elif env.os == 'redhat':
-        env.package_install_cmd = 'yum install -y'
-        env.package_list = settings.OS_PACKAGE_LIST_PATH_REDHAT
-    else:
-        utils.abort('Unrecognized OS: %s. Aborting.' % env.os)
-    env.project = settings.PROJECT_NAME
-    
-def _production():
-    """ use production environment on remote host"""
-    env.user = settings.SUDO_USER
-    env.environment = 'production'
-    env.server_name = 'project-production.dimagi.com'
-    env.hosts = settings.PRODUCTION_HOST
+#see 'Module dependencies' in the fabfile docs
+REQUIRES = []
+PROVIDES = ["os_packages"]
 
+def extend_context(ctx):
+    if ctx.os == 'ubuntu':
+        return ctx.replace(package_list=settings.OS_PACKAGE_LIST_PATH_UBUNTU)
+    elif ctx.os == 'redhat':
+        return ctx.replace(package_list=settings.OS_PACKAGE_LIST_PATH_REDHAT)
+    utils.abort('Unrecognized OS: %s. Aborting.' % ctx.os)
 
-def _staging():
-    """ use staging environment on remote host"""
-    env.user = settings.SUDO_USER
-    env.environment = 'staging'
-    env.server_name = 'project-staging.dimagi.com'
-    env.hosts = settings.STAGING_HOST
-
-def install_packages():
-    """Install packages, given a list of package names"""
-    require('package_install_cmd', 'package_list', provided_by=('setup_env'))
-    with open(env.package_list) as f:
-        packages = f.readlines()
-    env.packages_to_install = " ".join(map(lambda x: x.strip('\n\r'), packages))
-    sudo('%(package_install_cmd)s %(packages_to_install)s' % env)
+def install_packages(ctx):
+    """
+    Install the packages in the package list file that aren't installed yet (the package manager isn't
+    run at all if they're all there already).  Nothing is checked if the list didn't change since the last
+    time (see the ledger module).
+    """
+    with open(ctx.package_list) as f:
+        packages = [line.strip() for line in f]
+    packages = [p for p in packages if p and not p.startswith('#')]
+    ledger.step(ctx, 'os.packages', {'packages': sorted(packages), 'os': ctx.os}, install_missing_packages, (packages,))
 
-def bootstrap(deploy_level='staging'):
+def bootstrap(ctx):
     """
-    Installs all packages listed in the OS packages list file(s) specified in settings.
+    Installs the packages listed in the OS packages list file(s) specified in settings (that aren't installed yet).
     """
     print green(' IN OS MODULE. RUNNING BOOTSTRAP()...')
-    setup_env(deploy_level)
-    install_packages()
+    install_packages(ctx)
 
-def deploy(deploy_level='staging'):
+def deploy(ctx):
     """
-    Does the same thing as bootstrap.  Installs all packages listed in the OS packages list file(s) specified in settings.
+    Does the same thing as bootstrap.  Installs the packages listed in the OS packages list file(s) specified in settings
+    that aren't installed yet.
     """
     print green('In OS Module. Running deploy()...')
-    setup_env(deploy_level)
-    install_packages()
+    install_packages(ctx)
 
-def stop():
+def stop(ctx):
     """
         Does nothing in this module
     """
     print green('In OS Module. Doing nothing for command stop()')
 
 
-def start():
+def start(ctx):
     """
         Does nothing in this module
     """
@@ -0,0 +1,91 @@
+"""
+Per-host output files.
+
+When hosts are worked on in parallel (``parallel=N``), everything a host prints (the commands run, and the output of
+pip, yum, git...) goes to a log file of its own instead of the terminal: ``OUTPUT_LOG_DIR/<host>.log``.  The files
+are rotated once they grow past ``OUTPUT_LOG_MAX_BYTES``, and only the last ``OUTPUT_TAIL_LINES`` lines of each
+host are kept in memory.  The terminal only gets a short status line per host whenever it moves on to another
+module, and at the end a summary line per host, with the last lines of the output of the hosts that failed.
+
+This keeps the terminal from slowing the run down on large fleets, and keeps each host's output readable.
+
+Output Settings
+---------------
+::
+
+    OUTPUT_LOG_DIR = "logs/output" #Where the per-host output files go ON THE LOCAL machine
+    OUTPUT_LOG_MAX_BYTES = 10485760 #Size at which a host's output file is rotated
+    OUTPUT_LOG_BACKUPS = 3 #How many rotated files to keep per host
+    OUTPUT_TAIL_LINES = 40 #How many of the last lines of a failed host are shown
+
+"""
+from __future__ import absolute_import
+import os
+import time
+from collections import deque
+import settings
+
+_status = {'stream': None, 'host': None}
+
+
+class HostOutput(object):
+    """
+    A file-like object that writes to a host's (rotating) output file, and remembers the last lines written.
+    """
+    def __init__(self, host):
+        directory = getattr(settings, 'OUTPUT_LOG_DIR', 'logs/output')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '%s.log' % host.replace('@', '_').replace(':', '_'))
+        self.max_bytes = int(getattr(settings, 'OUTPUT_LOG_MAX_BYTES', 10 * 1024 * 1024))
+        self.backups = int(getattr(settings, 'OUTPUT_LOG_BACKUPS', 3))
+        self.tail = deque(maxlen=int(getattr(settings, 'OUTPUT_TAIL_LINES', 40)))
+        self._partial = ''
+        self._file = open(self.path, 'a')
+        self._file.write('===== %s =====\n' % time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def write(self, data):
+        self._file.write(data)
+        lines = (self._partial + data).replace('\r', '\n').split('\n')
+        self._partial = lines.pop()
+        self.tail.extend(line for line in lines if line.strip())
+        if self._file.tell() > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, '%s.1' % self.path)
+        self._file = open(self.path, 'w')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._partial.strip():
+            self.tail.append(self._partial)
+        self._file.close()
+
+    def last_lines(self):
+        return list(self.tail)
+
+
+def start_status(host, stream):
+    """
+    Sends the status lines of this process (see status()) to the given stream, for the given host.
+    """
+    _status['stream'], _status['host'] = stream, host
+
+def stop_status():
+    _status['stream'] = _status['host'] = None
+
+def status(text):
+    """
+    Prints a status line for the current host to the terminal, when its output goes to a file.
+    """
+    if _status['stream'] is not None:
+        _status['stream'].write('%-30s %s\n' % (_status['host'], text))
+        _status['stream'].flush()
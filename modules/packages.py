@@ -7,6 +7,38 @@ Packages Module Settings
 ::
 
     PACKAGES_PIP_REQUIREMENTS_PATH = "pip_requires.txt" #The path to pip_requires file ON THE LOCAL Machine, relative to this settings.py file.
+    PACKAGES_USE_WHEELHOUSE = False #(default is False) Build wheels once on the LOCAL machine and ship them to the hosts
+    PACKAGES_WHEELHOUSE_CACHE = "~/.deploy_tools/wheelhouse" #Where built wheelhouses are kept ON THE LOCAL machine
+    PACKAGES_WHEELHOUSE_PYTHON = "python" #LOCAL python (with pip and wheel installed) used to build the wheels
+    PACKAGES_VIRTUALENV_RELEASES = False #(default is False) Build each virtualenv side by side and switch over atomically
+    PACKAGES_VIRTUALENV_KEEP = 3 #How many virtualenvs (including the live one) to keep around for rollbacks
+
+Wheelhouse mode
+---------------
+Normally every host downloads (and compiles) every package in the requirements file itself.  With
+``PACKAGES_USE_WHEELHOUSE = True`` the wheels are built once, on the machine you're deploying from, and cached
+there (keyed by a hash of the requirements file and the hosts' platform/python version).  The wheelhouse is then
+uploaded to each host as a single archive (unless the host already has it) and installed with
+``pip install --no-index --find-links``.
+
+Wheels with compiled code only work on the platform they were built on, so the wheelhouse is only used when the
+local platform and python version match the host's virtualenv; otherwise the module falls back to a normal pip
+install.  The virtualenv's pip must be recent enough to install wheels.  On large fleets the wheelhouse can be
+relayed from host to host instead of being uploaded to each of them (see the distribute module).
+
+Side by side virtualenvs
+------------------------
+Normally the virtualenv (``python_env``) is cleared and reinstalled in place, so for a while the running site sees
+a half installed environment.  With ``PACKAGES_VIRTUALENV_RELEASES = True`` each virtualenv is built in a folder of
+its own (``www/<environment>/python_envs/<requirements hash>``) and ``python_env`` becomes a symlink that is
+switched over to the new virtualenv with an atomic rename, once it's completely built.  If the requirements didn't
+change, the existing virtualenv for them is reused and nothing gets installed.
+
+The last ``PACKAGES_VIRTUALENV_KEEP`` virtualenvs are kept, so going back to the previous one is instant::
+
+    $ fab production run_command:rollback_virtualenv,module=modules.packages
+
+Remember to restart your processes (e.g. through supervisor) to have them pick up the new virtualenv.
 """
 
 #Importing the standard OS package conflicts with the 'os' module in the modules folder.
@@ -18,120 +50,246 @@ from fabric.colors import green, yellow
 from fabric import utils
 from fabric.main import files
 import posixpath
-from modules.utils import what_os
+from modules.utils import package_lock, switch_release, rollback_release
+from modules.batch import RemoteBatch
+from modules import distribute, ledger
 
 
 import os
+import hashlib
+import tarfile
 import settings
 from fabric.api import settings as fab_settings
 
-def setup_env(deploy_level="staging"):
-    if deploy_level == "staging":
-        _staging()
-    elif deploy_level == "production":
-        _production()
-    else:
-        utils.abort("Unrecognized Deploy Level: %s" % deploy_level)
-    env.pip_requirements_local_path = settings.PACKAGES_PIP_REQUIREMENTS_PATH  #this is the local machine requires file path
-    env.project_user = settings.PROJECT_USER
-    env.sudo_user = settings.SUDO_USER
-    env.os = what_os()
-
-def _production():
-    """ use production environment on remote host"""
-    env.environment = 'production'
-    env.server_name = 'project-production.dimagi.com'
-    env.hosts = settings.PRODUCTION_HOST
-
+#see 'Module dependencies' in the fabfile docs.  Building the pip packages needs the compilers/headers from the os module.
+REQUIRES = ["os_packages"]
+PROVIDES = ["virtualenv"]
 
-def _staging():
-    """ use staging environment on remote host"""
-    env.environment = 'staging'
-    env.server_name = 'project-staging.dimagi.com'
-    env.hosts = settings.STAGING_HOST
+def _pip_requirements_local_path():
+    return settings.PACKAGES_PIP_REQUIREMENTS_PATH #this is the local machine requires file path
 
 def upload_pip_requires():
     """
-    Uploads the pip requirements file to the host machine and sets
-    the relevant env variables
+    Uploads the pip requirements file to the host machine and returns its path there
     """
-    require('pip_requirements_local_path', provided_by=('setup_env'))
-    (head, pip_filename) = os.path.split(env.pip_requirements_local_path)
+    (head, pip_filename) = os.path.split(_pip_requirements_local_path())
     print 'PIP FILENAME: %s' % pip_filename
     with show('debug'):
         with cd('/tmp'):
-            put(env.pip_requirements_local_path,'/tmp/')
-    env.pip_requirements_remote_path = posixpath.join('/tmp', pip_filename)
+            put(_pip_requirements_local_path(),'/tmp/')
+    return posixpath.join('/tmp', pip_filename)
 
-def install_packages():
-    """Install packages, given a list of package names"""
-    upload_pip_requires()
-    with cd(env.project_root):
-        with fab_settings(user=env.sudo_user):
-            sudo('pip install -E %(virtualenv_root)s --requirement %(pip_requirements_remote_path)s' % env, user=env.sudo_user, pty=True, shell=True)
+#Prints e.g. 'linux-x86_64-py2.7'.  Run on both ends to make sure wheels built locally will work on the host.
+PLATFORM_SNIPPET = ("import sys, distutils.util; "
+                    "print(distutils.util.get_platform() + '-py%d.%d' % sys.version_info[:2])")
 
-def create_directories():
-    require('environment', provided_by=('setup_env'))
-    require('project_root',provided_by=('setup_env'))
-    sudo('mkdir -p %(project_root)s' % env, user=env.sudo_user)
+def _requirements_hash():
+    with open(_pip_requirements_local_path(), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
 
+def _build_wheelhouse(key):
+    """
+    Builds the wheels for the requirements file on the local machine (unless they're cached already) and
+    returns the path of the wheelhouse archive.
+    """
+    cache = os.path.expanduser(getattr(settings, 'PACKAGES_WHEELHOUSE_CACHE', '~/.deploy_tools/wheelhouse'))
+    archive = os.path.join(cache, '%s.tar.gz' % key)
+    if os.path.exists(archive):
+        print green('Using cached wheelhouse %s' % archive)
+        return archive
+    wheel_dir = os.path.join(cache, key)
+    python = getattr(settings, 'PACKAGES_WHEELHOUSE_PYTHON', 'python')
+    print green('Building wheelhouse %s...' % wheel_dir)
+    local('%s -m pip wheel --wheel-dir "%s" --requirement "%s"' % (python, wheel_dir, _pip_requirements_local_path()))
+    tmp_archive = '%s.%d.tmp' % (archive, os.getpid())
+    tar = tarfile.open(tmp_archive, 'w:gz')
+    try:
+        for name in os.listdir(wheel_dir):
+            tar.add(os.path.join(wheel_dir, name), arcname=name)
+    finally:
+        tar.close()
+    os.rename(tmp_archive, archive)
+    return archive
 
-def setup_virtualenv():
+def _ship_wheelhouse(ctx, virtualenv_root):
+    """
+    Makes sure the host has the wheelhouse for the current requirements file.  Returns its remote path, or None
+    if a wheelhouse can't be used for this host.
+    """
+    remote_root = posixpath.join(ctx.project_root, 'wheelhouse')
+    with fab_settings(hide('running', 'stdout'), warn_only=True):
+        out = run("%s/bin/python -c \"%s\"; ls -1 %s 2>/dev/null; true" % (virtualenv_root, PLATFORM_SNIPPET, remote_root))
+    lines = out.replace('\r', '').split('\n')
+    remote_platform, shipped = lines[0].strip(), set(l.strip() for l in lines[1:])
+    python = getattr(settings, 'PACKAGES_WHEELHOUSE_PYTHON', 'python')
+    local_platform = local("%s -c \"%s\"" % (python, PLATFORM_SNIPPET), capture=True).strip()
+    if not remote_platform or not local_platform:
+        #e.g. no python in the virtualenv yet, or plan mode: nothing to match the wheels against
+        print yellow('Not using the wheelhouse: could not tell the platform of the host virtualenv ("%s") or the local python ("%s").'
+                     % (remote_platform, local_platform))
+        return None
+    if remote_platform != local_platform:
+        print yellow('Not using the wheelhouse: host virtualenv is "%s", local python is "%s".' % (remote_platform, local_platform))
+        return None
+
+    key = '%s-%s' % (_requirements_hash(), remote_platform)
+    remote_dir = posixpath.join(remote_root, key)
+    if key in shipped:
+        print green('Host already has wheelhouse %s' % key)
+        return remote_dir
+
+    remote_archive = distribute.artifact_path('wheelhouse-%s.tar.gz' % key)
+    if remote_archive is not None:
+        print green('Using the distributed wheelhouse %s' % key)
+    else:
+        archive = _build_wheelhouse(key)
+        remote_archive = posixpath.join('/tmp', os.path.basename(archive))
+        put(archive, remote_archive)
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p %s.tmp' % remote_dir, user=ctx.sudo_user)
+        batch.add('tar xzf %s -C %s.tmp' % (remote_archive, remote_dir), user=ctx.sudo_user)
+        batch.add('mv %s.tmp %s' % (remote_dir, remote_dir), user=ctx.sudo_user) #only complete wheelhouses get the real name
+        if remote_archive.startswith('/tmp/'):
+            batch.add('rm -f %s' % remote_archive)
+    return remote_dir
+
+def install_packages(ctx, virtualenv_root=None):
+    """Install packages, given a list of package names (into the live virtualenv, unless another one is given)"""
+    if virtualenv_root is None:
+        virtualenv_root = ctx.virtualenv_root
+    pip_requirements_remote_path = upload_pip_requires()
+    if getattr(settings, 'PACKAGES_USE_WHEELHOUSE', False):
+        wheelhouse = _ship_wheelhouse(ctx, virtualenv_root)
+        if wheelhouse is not None:
+            with cd(ctx.project_root):
+                sudo('%s/bin/pip install --no-index --find-links=%s --requirement %s' % (virtualenv_root, wheelhouse, pip_requirements_remote_path), user=ctx.sudo_user)
+            return
+    with cd(ctx.project_root):
+        with fab_settings(user=ctx.sudo_user):
+            sudo('pip install -E %s --requirement %s' % (virtualenv_root, pip_requirements_remote_path), user=ctx.sudo_user, pty=True, shell=True)
+
+def _install_packages_step(ctx, force=False):
+    """
+    Installs the packages into the live virtualenv, unless they were installed from the same requirements already
+    (see the ledger module).
+    """
+    inputs = {'requirements': _requirements_hash(), 'virtualenv': ctx.virtualenv_root,
+              'wheelhouse': getattr(settings, 'PACKAGES_USE_WHEELHOUSE', False)}
+    ledger.step(ctx, 'packages.pip_install', inputs, install_packages, (ctx,), force=force)
+
+def create_directories(ctx):
+    sudo('mkdir -p %(project_root)s' % ctx, user=ctx.sudo_user)
+
+
+def install_virtualenv_tools(ctx):
+    """
+    Installs setup_tools, then pip, then virtualenv (packages) system wide.
+    """
+    with cd('/tmp'):
+        batch = RemoteBatch()
+        if ctx.os == 'ubuntu':
+            batch.add(package_lock('apt-get install -y python-setuptools python-setuptools-devel'))
+        elif ctx.os == 'redhat':
+            batch.add(package_lock('yum install -y python-setuptools python-setuptools-devel'))
+        else:
+            utils.abort('Unrecognized OS %s!' % ctx.os)
+        batch.add('easy_install pip')
+        batch.add('pip install virtualenv')
+        batch.execute()
+
+def setup_virtualenv(ctx):
     """
     Initially creates the virtualenv in the correct places (creating directory structures as necessary) on the
     remote host.
     If necessary, installs setup_tools, then pip, then virtualenv (packages)
     """
     print green('In packages module.  Installing VirtualEnv on host machine...')
-    require('virtualenv_root', provided_by=('setup_env'))
 
+    install_virtualenv_tools(ctx)
     with cd('/tmp'):
-        if env.os == 'ubuntu':
-            sudo('apt-get install -y python-setuptools python-setuptools-devel')
-        elif env.os == 'redhat':
-            sudo('yum install -y python-setuptools python-setuptools-devel')
-        else:
-            utils.abort('Unrecognized OS %s!' % env.os)
-        sudo('easy_install pip')
-        sudo('pip install virtualenv', pty=True, shell=True)
-
-        print yellow('Require user:%(sudo_user)s password!' % env)
-        with fab_settings(user=env.sudo_user, sudo_prompt='ARemind sudo password: ', warn_only=True):
-            sudo('mkdir -p %(www_root)s' % env)
-            sudo('chown -R %(www_root)s %(virtualenv_root)s' % env)
-            sudo('chgrp -R %(www_root)s %(virtualenv_root)s' % env)
+        print yellow('Require user:%(sudo_user)s password!' % ctx)
+        with fab_settings(user=ctx.sudo_user, sudo_prompt='ARemind sudo password: ', warn_only=True):
+            batch = RemoteBatch()
+            batch.add('mkdir -p %(www_root)s' % ctx)
+            batch.add('chown -R %(www_root)s %(virtualenv_root)s' % ctx)
+            batch.add('chgrp -R %(www_root)s %(virtualenv_root)s' % ctx)
             args = '--clear --distribute'
-            sudo('virtualenv %s %s' % (args, env.virtualenv_root), user=env.sudo_user)
+            batch.add('virtualenv %s %s' % (args, ctx.virtualenv_root), user=ctx.sudo_user)
+            batch.execute()
     print green('In packages module. Done installing VirtualEnv...')
 
-def bootstrap(deploy_level='staging'):
+def _virtualenvs_root(ctx):
+    return posixpath.join(ctx.www_root, 'python_envs')
+
+def _virtualenvs_keep():
+    return int(getattr(settings, 'PACKAGES_VIRTUALENV_KEEP', 3))
+
+def build_virtualenv_release(ctx):
+    """
+    Builds a virtualenv for the current requirements next to the live one (unless it exists already), then switches
+    python_env over to it.
+    """
+    name = _requirements_hash()
+    target = posixpath.join(_virtualenvs_root(ctx), name)
+    with fab_settings(hide('running', 'stdout'), warn_only=True):
+        out = run('readlink -f %s; test -f %s/.complete && echo COMPLETE; true' % (ctx.virtualenv_root, target))
+    lines = out.replace('\r', '').split('\n')
+    if 'COMPLETE' in lines:
+        print green('Virtualenv for these requirements (%s) is already built.' % name)
+        if lines[0].strip() == target:
+            return
+    else:
+        print green('Building virtualenv %s...' % target)
+        with RemoteBatch() as batch:
+            batch.add('mkdir -p %s' % _virtualenvs_root(ctx), user=ctx.sudo_user)
+            batch.add('rm -rf %s' % target, user=ctx.sudo_user) #whatever is left of an earlier, failed build
+            batch.add('virtualenv --distribute %s' % target, user=ctx.sudo_user)
+        install_packages(ctx, target)
+        sudo('touch %s/.complete' % target, user=ctx.sudo_user)
+    switch_release(ctx.virtualenv_root, _virtualenvs_root(ctx), name, _virtualenvs_keep(), ctx.sudo_user)
+
+def rollback_virtualenv(ctx):
+    """
+    Switches python_env back to the virtualenv that was live before the current one.
+    """
+    rollback_release(ctx.virtualenv_root, _virtualenvs_root(ctx), _virtualenvs_keep(), ctx.sudo_user)
+
+def _use_virtualenv_releases():
+    return getattr(settings, 'PACKAGES_VIRTUALENV_RELEASES', False)
+
+def bootstrap(ctx):
     """
     Performs initial install of virtualenv, then installs listed pip packages specified in settings file
     """
     print green('In Packages Module. Running bootstrap()...')
-    setup_env(deploy_level)
-    create_directories()
-    setup_virtualenv()
-    install_packages()
+    create_directories(ctx)
+    if _use_virtualenv_releases():
+        install_virtualenv_tools(ctx)
+        build_virtualenv_release(ctx)
+    else:
+        setup_virtualenv(ctx)
+        _install_packages_step(ctx, force=True) #setup_virtualenv() just cleared the virtualenv
     print green('In Packages Module. Done running bootstrap()...')
 
-def deploy(deploy_level='staging'):
+def deploy(ctx):
     """
     Installs all packages listed in the pip packages list file(s) specified in settings.
     """
     print green('In Packages Module. Running deploy()...')
-    setup_env(deploy_level)
-    install_packages()
+    if _use_virtualenv_releases():
+        build_virtualenv_release(ctx)
+    else:
+        _install_packages_step(ctx)
     print green('In Packages Module. Done running deploy()...')
 
-def stop():
+def stop(ctx):
     """
     Does nothing in this module
     """
     print green('In Packages Module. Doing nothing for command stop()')
 
 
-def start():
+def start(ctx):
     """
     Does nothing in this module
     """
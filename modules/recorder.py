@@ -0,0 +1,286 @@
+"""
+Recording of remote operations, and plan mode.
+
+A ``Recorder`` keeps an ordered list of every remote operation (``run``, ``sudo``, ``put``, ``get``, as well as
+``local`` commands and prompts) the modules issue, per host and module.  It works in two ways:
+
+* **plan mode** (``fake=True``): nothing is sent to the hosts (or run locally).  Commands get a canned answer (see
+  ``RESPONSES``: an Ubuntu host with nothing installed yet) and succeed, prompts are answered with yes.  This
+  shows what a command *would* do, and how many round trips it would take::
+
+      $ fab staging plan deploy
+      $ fab production plan bootstrap:django
+
+* **live mode**: the operations are sent to the hosts as usual and only recorded::
+
+      $ fab staging record deploy
+
+Either way, a list of the operations of each module is printed at the end, along with how many commands, probes
+(commands that only look at the host, like ``test -e`` or ``cat``) and uploads each module made.  Calls that look
+redundant are annotated: probes repeated with nothing changed on the host in between, ``files.exists()`` on a path
+that was created earlier in the run, and commands sent twice.
+
+The benchmarks (benchmarks/run.py) use a plan mode recorder as their stand-in host.
+"""
+from __future__ import absolute_import
+import re
+import sys
+import time
+from fabric import operations
+from fabric.api import env
+from fabric.colors import green, yellow
+from fabric.contrib import console
+from modules import trace
+
+#(substring of the command, output).  The first match wins, commands that match nothing print nothing.
+RESPONSES = [
+    ('s/^DISTRIB_ID=/lsb_id=/p', 'lsb_id=Ubuntu\nlsb_release=10.04\ncpus=1\nmemory_kb=1048576\nmount=/ /dev/sda1 20971520 18874368\n'
+                                 'postgres_candidate=8.4\n'),
+    ('git rev-parse HEAD', '0123456789abcdef0123456789abcdef01234567'),
+    ('echo "Will you echo quotation marks"', 'Will you echo quotation marks'),
+]
+
+#commands that only look at the host
+PROBE = re.compile(r'^(\(as \S+\) )?(test |\[ |cat |readlink |ls |which |sha1sum |stat |dpkg-query |rpm -q'
+                   r'|echo "Will you echo quotation marks"|git rev-parse |grep )')
+_EXISTS = re.compile(r'^(?:stat|test -[edf]) "\$\(echo (.+)\)"$') #what files.exists() and friends send
+_MKDIR = re.compile(r'mkdir -p (\S+)')
+_BATCH_BEGIN = re.compile(r'^echo "@@DT_BEGIN (\d+)@@"$')
+_BATCHED_AS_USER = re.compile(r"^sudo -H -u (\S+) sh -c '(.*)' 2>&1$", re.DOTALL)
+_BATCHED = re.compile(r'^\((.*)\) 2>&1$', re.DOTALL)
+_AS_USER = re.compile(r'^\(as \S+\) ')
+
+_active = [] #the installed recorder, if any
+
+
+def active():
+    """
+    Returns the recorder that is installed (None if there's none).
+    """
+    return _active and _active[0] or None
+
+def batched_commands(command):
+    """
+    Returns the commands of a RemoteBatch script (or None if the command isn't one), as they were added to the batch.
+    Commands run as another user are prefixed with ``(as <user>)``.
+    """
+    if '@@DT_BEGIN' not in command:
+        return None
+    lines = command.split('\n')
+    commands = []
+    for i, line in enumerate(lines):
+        if not _BATCH_BEGIN.match(line):
+            continue
+        as_user = _BATCHED_AS_USER.match(lines[i + 1])
+        plain = _BATCHED.match(lines[i + 1])
+        if as_user:
+            commands.append('(as %s) %s' % (as_user.group(1), as_user.group(2).replace("'\\''", "'")))
+        else:
+            commands.append(plain and plain.group(1) or lines[i + 1])
+    return commands
+
+
+class _Output(str):
+    pass
+
+
+class Recorder(object):
+    """
+    Records the remote operations made while it's installed (and, with ``fake=True``, answers them itself).
+    """
+    def __init__(self, fake=False, rtt=0.0, responses=None):
+        self.fake = fake
+        self.rtt = rtt #seconds each faked operation takes
+        self.responses = responses or RESPONSES
+        self.module = None #used when the fabfile isn't running the modules (see trace.module_span)
+        self.calls = []
+        self._originals = {}
+
+    def _record(self, kind, target, sent=0, received=0):
+        call = {
+            'number': len(self.calls) + 1,
+            'host': env.host_string,
+            'module': trace.current_module() or self.module or 'fabfile',
+            'kind': kind,
+            'target': target,
+            'bytes': sent + received,
+            'notes': [],
+        }
+        self.calls.append(call)
+        if self.fake and self.rtt:
+            time.sleep(self.rtt)
+        return call
+
+    def respond(self, command):
+        for substring, out in self.responses:
+            if substring in command:
+                return out
+        return ''
+
+    def _fake_output(self, command):
+        commands = batched_commands(command)
+        if commands is None:
+            out = self.respond(command)
+        else:
+            lines = []
+            for i, batched in enumerate(commands):
+                lines.append('@@DT_BEGIN %d@@' % i)
+                if self.respond(batched):
+                    lines.append(self.respond(batched))
+                lines.append('@@DT_END %d 0@@' % i)
+            out = '\n'.join(lines)
+        result = _Output(out)
+        result.command = result.real_command = command
+        result.return_code = 0
+        result.succeeded, result.failed = True, False
+        result.stderr = ''
+        return result
+
+    def _run_command(self, command, *args, **kwargs):
+        if self.fake:
+            out = self._fake_output(command)
+        else:
+            out = self._originals['_run_command'](command, *args, **kwargs)
+        self._record(kwargs.get('sudo') and 'sudo' or 'run', command, len(command), len(out))
+        return out
+
+    def _put(self, local_path=None, remote_path=None, *args, **kwargs):
+        if hasattr(local_path, 'getvalue'):
+            size = len(local_path.getvalue())
+        else:
+            with open(local_path) as f:
+                size = len(f.read())
+        result = [remote_path] if self.fake else self._originals['put'](local_path, remote_path, *args, **kwargs)
+        self._record('put', remote_path, sent=size)
+        return result
+
+    def _get(self, remote_path, local_path=None, *args, **kwargs):
+        result = [] if self.fake else self._originals['get'](remote_path, local_path, *args, **kwargs)
+        self._record('get', remote_path)
+        return result
+
+    def _local(self, command, *args, **kwargs):
+        if self.fake:
+            result = self._fake_output(command)
+        else:
+            result = self._originals['local'](command, *args, **kwargs)
+        self._record('local', command)
+        return result
+
+    def _confirm(self, question, *args, **kwargs):
+        if not self.fake:
+            return self._originals['confirm'](question, *args, **kwargs)
+        self._record('prompt', question)
+        return True
+
+    def install(self):
+        """
+        Starts recording (and, with fake=True, stops anything from being sent to the hosts), until ``uninstall()``.
+        """
+        self._originals['_run_command'] = operations._run_command
+        operations._run_command = self._run_command #run() and sudo() both go through this one
+        for name, module, fake in (('put', operations, self._put), ('get', operations, self._get),
+                                   ('local', operations, self._local), ('confirm', console, self._confirm)):
+            original = self._originals[name] = getattr(module, name)
+            #replace every reference to the function, including the ones made with 'from fabric.api import *'
+            for loaded in sys.modules.values():
+                if loaded is not None and getattr(loaded, name, None) is original:
+                    setattr(loaded, name, fake)
+        _active[:] = [self]
+
+    def uninstall(self):
+        operations._run_command = self._originals.pop('_run_command')
+        for name in self._originals.keys():
+            original = self._originals.pop(name)
+            fake = getattr(self, '_' + name)
+            for loaded in sys.modules.values():
+                if loaded is not None and getattr(loaded, name, None) == fake:
+                    setattr(loaded, name, original)
+        _active[:] = []
+
+    def stats(self):
+        """
+        Returns {module: {'round_trips', 'bytes', 'commands', 'probes', 'uploads'}}.  Local commands and prompts
+        aren't round trips.
+        """
+        stats = {}
+        for call in self.calls:
+            s = stats.setdefault(call['module'], {'round_trips': 0, 'bytes': 0, 'commands': 0, 'probes': 0, 'uploads': 0})
+            if call['kind'] in ('local', 'prompt'):
+                continue
+            s['round_trips'] += 1
+            s['bytes'] += call['bytes']
+            if call['kind'] in ('put', 'get'):
+                s['uploads'] += 1
+            elif PROBE.match(call['target']):
+                s['probes'] += 1
+            else:
+                s['commands'] += 1
+        return stats
+
+    def annotate(self):
+        """
+        Adds notes to the calls that look redundant (looking at each command of a batch on its own).
+        """
+        seen = {} #(host, command) -> call, cleared for probes whenever something changes on the host
+        created = {} #(host, path) -> the call that created it
+        for call in self.calls:
+            host = call['host']
+            if call['kind'] in ('local', 'prompt'):
+                continue
+            if call['kind'] in ('put', 'get'):
+                commands = []
+            else:
+                commands = batched_commands(call['target']) or [call['target']]
+            commands = [_AS_USER.sub('', c) for c in commands] #who runs it doesn't matter here
+            for command in commands:
+                earlier = seen.get((host, command))
+                if earlier is not None:
+                    call['notes'].append('"%s" same as #%d' % (command[:60], earlier['number']))
+                exists = _EXISTS.match(command)
+                if exists and (host, exists.group(1)) in created:
+                    call['notes'].append('%s was created by #%d' % (exists.group(1), created[(host, exists.group(1))]['number']))
+
+            changes = call['kind'] == 'put' or [c for c in commands if not PROBE.match(c)]
+            if changes:
+                #something may have changed on the host, so probes aren't redundant anymore
+                for key in [k for k in seen if k[0] == host and PROBE.match(k[1])]:
+                    del seen[key]
+            if call['kind'] == 'put':
+                created.setdefault((host, call['target']), call)
+            for command in commands:
+                for path in _MKDIR.findall(command):
+                    created.setdefault((host, path.rstrip('/')), call)
+                seen.setdefault((host, command), call)
+
+    def report(self):
+        """
+        Prints the recorded operations of each host and module, and the counts per module.
+        """
+        self.annotate()
+        print green('========== %s ==========' % (self.fake and 'Plan (nothing was sent to the hosts)' or 'Recorded operations'))
+        last = None
+        for call in self.calls:
+            if (call['host'], call['module']) != last:
+                last = (call['host'], call['module'])
+                print green('--- [%s] %s ---' % last)
+            commands = batched_commands(call['target'])
+            if commands is None:
+                line = '%4d. %-6s %s' % (call['number'], call['kind'], call['target'].split('\n')[0])
+            else:
+                line = '%4d. %-6s batch of %d: %s' % (call['number'], call['kind'], len(commands), '; '.join(commands))
+            if call['notes']:
+                print yellow('%s    <-- redundant? %s' % (line, ', '.join(call['notes'])))
+            else:
+                print line
+
+        redundant = len([c for c in self.calls if c['notes']])
+        print green('========== Round trips per module ==========')
+        print '%-24s %9s %7s %8s %12s' % ('module', 'commands', 'probes', 'uploads', 'round trips')
+        stats = self.stats()
+        for module in sorted(stats):
+            s = stats[module]
+            print '%-24s %9d %7d %8d %12d' % (module, s['commands'], s['probes'], s['uploads'], s['round_trips'])
+        print '%-24s %38d' % ('total', sum(s['round_trips'] for s in stats.values()))
+        if redundant:
+            print yellow('%d calls look redundant (marked above).' % redundant)
@@ -0,0 +1,125 @@
+"""
+The module registry.
+
+The fabfile needs to know a few things about the modules in ``MODULES`` before running a command: which operating
+methods and extra commands they have, and their ``REQUIRES``/``PROVIDES`` lists (to put them in order).  The
+registry reads these from the modules' source code (with the ``ast`` module) instead of importing them, so that a
+module (and everything it imports) is only loaded once one of its methods actually runs.  ``fab -l``,
+``fab commands`` and commands that only touch one module don't pay for importing all of them.
+
+Only what's written literally in the module is seen: a top level ``def`` (and its arguments, which tell whether it
+takes the host's context, see the context module) and ``REQUIRES``/``PROVIDES`` lists of strings.  Modules that build these at import time are still loaded correctly, they're just not described
+correctly before that.
+
+To see what each module can do::
+
+    $ fab commands
+"""
+from __future__ import absolute_import
+import ast
+import imp
+import os
+import sys
+from modules.utils import try_import
+
+OPERATING_METHODS = ('bootstrap', 'deploy', 'start', 'stop')
+#functions every module has that aren't meant to be run on their own
+_NOT_COMMANDS = ('setup_env', 'managed_files', 'extend_context')
+
+_infos = {}
+
+
+class ModuleInfo(object):
+    """
+    What the registry knows about a module without importing it.
+
+    ``requires`` is None when the module doesn't declare ``REQUIRES`` (see 'Module dependencies' in the fabfile docs).
+    """
+    def __init__(self, name, path, doc, functions, requires, provides, arguments=None):
+        self.name = name
+        self.path = path
+        self.doc = doc
+        self.functions = functions #{name: first line of the docstring}
+        self.arguments = arguments or {} #{name: [argument names]}
+        self.requires = requires
+        self.provides = provides
+
+    @property
+    def operating_methods(self):
+        return [m for m in OPERATING_METHODS if m in self.functions]
+
+    @property
+    def commands(self):
+        """
+        The module's public functions that aren't operating methods, i.e. the ones for ``run_command``.
+        """
+        return sorted(f for f in self.functions if f not in OPERATING_METHODS and f not in _NOT_COMMANDS)
+
+    def has(self, function):
+        return function in self.functions
+
+    def takes_context(self, function):
+        """
+        Whether the function takes the host's context as its first argument (``def deploy(ctx)``).
+        """
+        return self.arguments.get(function, [])[:1] == ['ctx']
+
+
+def _find_source(name):
+    """
+    Returns the path of a module's source file, without importing it (its parent packages do get imported).
+    """
+    package, _, module = name.rpartition('.')
+    if package:
+        search_path = try_import(package).__path__
+    else:
+        search_path = None
+    f, path, description = imp.find_module(module, search_path)
+    if f is not None:
+        f.close()
+    if description[2] == imp.PKG_DIRECTORY:
+        path = os.path.join(path, '__init__.py')
+    return path
+
+def _literal_list(node):
+    try:
+        value = ast.literal_eval(node)
+    except ValueError:
+        return None
+    return list(value)
+
+def _first_line(doc):
+    return (doc or '').strip().split('\n')[0].strip()
+
+def info(name):
+    """
+    Returns the ModuleInfo of a module (by its dotted name, as in settings.MODULES).
+    """
+    if name not in _infos:
+        path = _find_source(name)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        functions = {}
+        arguments = {}
+        requires = provides = None
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef) and not node.name.startswith('_'):
+                functions[node.name] = _first_line(ast.get_docstring(node))
+                arguments[node.name] = [a.id for a in node.args.args if isinstance(a, ast.Name)]
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if isinstance(target, ast.Name) and target.id == 'REQUIRES':
+                        requires = _literal_list(node.value)
+                    elif isinstance(target, ast.Name) and target.id == 'PROVIDES':
+                        provides = _literal_list(node.value)
+        _infos[name] = ModuleInfo(name, path, _first_line(ast.get_docstring(tree)), functions, requires, provides or [],
+                                    arguments)
+    return _infos[name]
+
+def load(name):
+    """
+    Imports a module (the first time it's needed) and returns it.  Returns None if it can't be imported.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return try_import(name)
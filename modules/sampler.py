@@ -0,0 +1,144 @@
+"""
+Resource sampling on the hosts.
+
+Put ``sample`` in front of a command to find out what a slow step was waiting on::
+
+    $ fab staging sample bootstrap
+    $ fab production sample deploy:parallel=8,trace=deploy_trace.json
+
+While the modules run on a host, a small shell loop on that host reads ``/proc`` every ``SAMPLER_INTERVAL`` seconds:
+CPU time (busy and waiting for IO), memory in use, sectors read and written by the disks and bytes received and sent
+by the network interfaces (other than ``lo``).  When the host is done the samples are fetched and lined up with the
+remote operations of the run (see the trace module; the difference between the host's clock and the local one is
+measured when the sampler starts).  At the end of the run, a table shows for each module step how busy each
+resource was while it ran, e.g. a pip install at 100% CPU is compiling, a ``mv`` with high IO wait is waiting for the
+disk, a git fetch with a busy network and an idle CPU is downloading.  With ``trace=<file>``, the samples are also
+written to the trace, as counters (graphs) under each host.
+
+Steps shorter than the interval may have no samples (shown as ``-``).  Linux hosts only.
+
+Sampler Settings
+----------------
+::
+
+    SAMPLER_INTERVAL = 1 #Seconds between two samples
+
+"""
+from __future__ import absolute_import
+import time
+from fabric.api import env
+from fabric.colors import green
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run
+from modules import trace
+import settings
+
+#Prints "<time> <cpu total> <idle> <iowait> <mem total kB> <mem available kB> <sectors read> <sectors written> <rx> <tx>"
+_SAMPLE_AWK = r'''
+FILENAME == "/proc/stat" && $1 == "cpu" { total = $2 + $3 + $4 + $5 + $6 + $7 + $8 + $9; idle = $5; iowait = $6 }
+FILENAME == "/proc/meminfo" && $1 == "MemTotal:" { memtotal = $2 }
+FILENAME == "/proc/meminfo" && $1 == "MemAvailable:" { memavailable = $2 }
+FILENAME == "/proc/diskstats" && $3 ~ /^(sd|vd|xvd|hd)[a-z]+$|^nvme[0-9]+n[0-9]+$|^mmcblk[0-9]+$/ { read += $6; written += $10 }
+FILENAME == "/proc/net/dev" && index($0, ":") { split($0, a, ":"); gsub(/ /, "", a[1]); split(a[2], f, " "); if (a[1] != "lo") { rx += f[1]; tx += f[9] } }
+END { printf "%s %.0f %.0f %.0f %.0f %.0f %.0f %.0f %.0f %.0f\n", t, total, idle, iowait, memtotal, memavailable, read, written, rx, tx }
+'''
+
+_START = '''cat > %(script)s <<'DT_SAMPLER'
+while :; do
+    awk -v t="$(date +%%s.%%N)" '%(awk)s' /proc/stat /proc/meminfo /proc/diskstats /proc/net/dev
+    sleep %(interval)s
+done
+DT_SAMPLER
+nohup sh %(script)s > %(out)s 2>/dev/null < /dev/null &
+echo "SAMPLER $! $(date +%%s.%%N)"'''
+
+_running = {} #host -> (pid, output file, clock offset)
+
+
+def start():
+    """
+    Starts sampling on the current host.
+    """
+    name = '/tmp/deploy_tools-sampler-%s-%d' % (env.host_string.replace('@', '_').replace(':', '_'), int(time.time()))
+    before = time.time()
+    with fab_settings(hide('running', 'stdout')):
+        out = run(_START % dict(script=name + '.sh', out=name + '.txt', awk=_SAMPLE_AWK.strip(),
+                                interval=getattr(settings, 'SAMPLER_INTERVAL', 1)), pty=False)
+    after = time.time()
+    for line in out.replace('\r', '').split('\n'):
+        if line.startswith('SAMPLER '):
+            pid, remote_now = line.split()[1:3]
+            _running[env.host_string] = (pid, name, float(remote_now) - (before + after) / 2)
+
+def _parse(out, offset):
+    """
+    Turns the raw readings into samples (one per pair of consecutive readings), timed on the local clock.
+    """
+    readings = []
+    for line in out.replace('\r', '').split('\n'):
+        fields = line.split()
+        if len(fields) == 10:
+            readings.append([float(f) for f in fields])
+    samples = []
+    for a, b in zip(readings, readings[1:]):
+        seconds = b[0] - a[0]
+        cpu = (b[1] - a[1]) or 1
+        if seconds <= 0:
+            continue
+        samples.append({
+            'time': (a[0] + b[0]) / 2 - offset,
+            'cpu': 100.0 * (cpu - (b[2] - a[2]) - (b[3] - a[3])) / cpu,
+            'iowait': 100.0 * (b[3] - a[3]) / cpu,
+            'mem_used_mb': (b[4] - b[5]) / 1024,
+            'disk_read_mbs': (b[6] - a[6]) * 512 / seconds / 1e6,
+            'disk_write_mbs': (b[7] - a[7]) * 512 / seconds / 1e6,
+            'net_rx_mbs': (b[8] - a[8]) / seconds / 1e6,
+            'net_tx_mbs': (b[9] - a[9]) / seconds / 1e6,
+        })
+    return samples
+
+def stop():
+    """
+    Stops sampling on the current host and adds the samples to the trace.
+    """
+    if env.host_string not in _running:
+        return
+    pid, name, offset = _running.pop(env.host_string)
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run('kill %s; cat %s.txt; rm -f %s.sh %s.txt' % (pid, name, name, name))
+    trace.add_events([{'cat': 'sample', 'name': 'resources', 'host': env.host_string, 'module': None, 'step': None,
+                       'start': s.pop('time'), 'duration': 0, 'args': s} for s in _parse(out, offset)])
+
+def _mean(samples, key):
+    if not samples:
+        return '-'
+    return '%.1f' % (sum(s['args'][key] for s in samples) / len(samples))
+
+def report(events=None):
+    """
+    Prints how busy each resource was during each step (averaged over the samples taken while the step's remote
+    operations ran, on all hosts).
+    """
+    events = trace._events if events is None else events
+    samples = {}
+    for e in events:
+        if e['cat'] == 'sample':
+            samples.setdefault(e['host'], []).append(e)
+    if not samples:
+        return
+    steps = {}
+    for e in events:
+        if e['cat'] in ('module', 'upload_template', 'sample'):
+            continue
+        s = steps.setdefault((e['module'], e['step']), {'time': 0.0, 'samples': []})
+        s['time'] += e['duration']
+        s['samples'].extend(x for x in samples.get(e['host'], ()) if e['start'] <= x['start'] <= e['start'] + e['duration'])
+    print green('========== Resources per step (averages while the step ran) ==========')
+    print '%-40s %8s %6s %6s %8s %8s %8s %8s %8s' % ('module.step', 'time', 'cpu%', 'iow%', 'mem MB', 'disk r', 'disk w',
+                                                    'net rx', 'net tx')
+    for (module, step), s in sorted(steps.items(), key=lambda item: -item[1]['time']):
+        print '%-40s %7.1fs %6s %6s %8s %8s %8s %8s %8s' % (
+            '%s.%s' % (module, step), s['time'], _mean(s['samples'], 'cpu'), _mean(s['samples'], 'iowait'),
+            _mean(s['samples'], 'mem_used_mb'), _mean(s['samples'], 'disk_read_mbs'), _mean(s['samples'], 'disk_write_mbs'),
+            _mean(s['samples'], 'net_rx_mbs'), _mean(s['samples'], 'net_tx_mbs'))
+    print '(disk and net in MB/s)'
@@ -25,138 +25,112 @@ import posixpath
 from fabric.context_managers import cd, show
 from fabric.contrib.files import uncomment
 from fabric.operations import sudo, require, put
-from fabric.state import env
 from fabric.contrib import files
 from fabric.colors import green
-from modules.utils import what_os
+from modules.batch import RemoteBatch
+from modules.uploads import upload_if_changed
+from modules import ledger
 import settings
 
-
-def setup_env(deploy_level="staging"):
-    if deploy_level == "staging":
-        _staging()
-    elif deploy_level == "production":
-        _production()
-    else:
-        raise Exception("Unrecognized Deploy Level: %s" % deploy_level)
-
-#    env.user = settings.PROJECT_USER
-#    env.sudo_user = settings.SUDO_USER
-    env.os = what_os()
-    env.supervisor_init_path = settings.SUPERVISOR_INIT_TEMPLATE
-    env.project = settings.PROJECT_NAME
-    env.project_root = settings.PROJECT_ROOT % env #remember to pass in the 'env' dict before using this field from settings, since it could contain keywords.
-    env.sudo_user = settings.SUDO_USER
-    _setup_path()
-    _populate_supervisor_dict()
-
-def _populate_supervisor_dict():
-    d = settings.SUPERVISOR_DICT
-    d["project_root"] = env.project_root
-    d["www_root"] = env.www_root
-    d["log_dir"] = env.log_dir
-    d["code_root"] = env.code_root
-    d["project_media"] = env.project_media
-    d["project_static"] = env.project_static
-    d["virtualenv_root"] = env.virtualenv_root
-    d["services"] = env.services
-    d["environment"] = env.environment
-    d["sudo_user"] = env.sudo_user
-    
-    env.sup_dict = d
-
-def _production():
-    """ use production environment on remote host"""
-    env.environment = 'production'
-    env.server_name = 'project-production.dimagi.com'
-    env.hosts = [settings.PRODUCTION_HOST]
-
-def _staging():
-    """ use staging environment on remote host"""
-    env.environment = 'staging'
-    env.server_name = 'project-staging.dimagi.com'
-    env.hosts = [settings.STAGING_HOST]
-
-def _setup_path():
+#see 'Module dependencies' in the fabfile docs.  Supervisor is installed with pip and runs the django code.
+REQUIRES = ["virtualenv", "code"]
+PROVIDES = ["supervisor"]
+
+
+def extend_context(ctx):
+    supervisor_conf_root = posixpath.join(ctx.services_root, 'supervisor')
+    return ctx.replace(
+        supervisor_init_path=settings.SUPERVISOR_INIT_TEMPLATE,
+        sup_template_path=os.path.join(ctx.local_settings_folder, settings.SUPERVISOR_TEMPLATE_PATH), #note the us of os.path not posixpath
+        supervisor_conf_root=supervisor_conf_root,
+        supervisor_conf_path=posixpath.join(supervisor_conf_root, 'supervisor.conf'),
+    )
+
+def _supervisor_dict(ctx):
+    d = dict(settings.SUPERVISOR_DICT)
+    d["project_root"] = ctx.project_root
+    d["www_root"] = ctx.www_root
+    d["log_dir"] = ctx.log_dir
+    d["code_root"] = ctx.code_root
+    d["project_media"] = ctx.project_media
+    d["project_static"] = ctx.project_static
+    d["virtualenv_root"] = ctx.virtualenv_root
+    d["services"] = ctx.services_root
+    d["environment"] = ctx.environment
+    d["sudo_user"] = ctx.sudo_user
+    return d
+
+def managed_files(ctx):
     """
-    Creates all the various paths that will be needed
-    in deploying code, populating config templates, etc.
+    The config files this module uploads (see the uploads module).
     """
-    # using posixpath to ensure unix style slashes. See bug-ticket: http://code.fabfile.org/attachments/61/posixpath.patch
-    env.project_root = settings.PROJECT_ROOT
-    env.www_root = posixpath.join(env.project_root,'www',env.environment)
-    env.log_dir = posixpath.join(env.www_root,'log')
-    env.code_root = posixpath.join(env.www_root,'code_root')
-    settings_folder = os.path.split(os.path.abspath(settings.__file__))[0]
-    env.sup_template_path = os.path.join(settings_folder, settings.SUPERVISOR_TEMPLATE_PATH) #note the us of os.path not posixpath
-    env.virtualenv_name = getattr(settings, 'PYTHON_ENV_NAME', 'python_env') #not a required setting and should be sufficient with default name
-    env.virtualenv_root = posixpath.join(env.www_root, env.virtualenv_name)
-    env.services_root = posixpath.join(env.project_root, 'services')
-    env.supervisor_conf_root = posixpath.join(env.services_root, 'supervisor')
-    env.supervisor_conf_path = posixpath.join(env.supervisor_conf_root, 'supervisor.conf')
-    env.supervisor_init_template_path = settings.SUPERVISOR_INIT_TEMPLATE
-
-
-def setup_dirs():
-    """ create (if necessary) and make writable uploaded media, log, etc. directories """
-    if not files.exists(env.log_dir):
-        print green('Log Directory (%s) does not exist on host, creating...' % env.log_dir)
-        sudo('mkdir -p %(log_dir)s' % env, user=env.sudo_user)
-        sudo('chmod a+w %(log_dir)s' % env, user=env.sudo_user)
+    return [posixpath.join(ctx.services_root, 'supervisor', 'supervisor.conf')]
 
-    if not files.exists(env.supervisor_conf_root):
-        print green('Supervisor services (%s) folder does not exist. Creating...' % env.supervisor_conf_root)
-        sudo('mkdir -p %(supervisor_conf_root)s' % env, user=env.sudo_user)
+def setup_dirs(ctx):
+    """ create (if necessary) and make writable uploaded media, log, etc. directories """
+    print green('Making sure the log (%(log_dir)s) and supervisor services (%(supervisor_conf_root)s) folders exist...' % ctx)
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p %(log_dir)s' % ctx, user=ctx.sudo_user)
+        batch.add('chmod a+w %(log_dir)s' % ctx, user=ctx.sudo_user)
+        batch.add('mkdir -p %(supervisor_conf_root)s' % ctx, user=ctx.sudo_user)
 
-def upload_sup_template():
+def upload_sup_template(ctx):
     """
     Uploads the supervisor template to the server (while populating the template)
+
+    Returns False (and uploads nothing) if the conf on the host is already up to date.
     """
-    require('supervisor_conf_path','services_root','sudo_user', 'sup_template_path', provided_by=('setup_env'))
-    files.upload_template(env.sup_template_path, env.supervisor_conf_path, context=env.sup_dict, use_sudo=True)
+    return upload_if_changed(ctx.sup_template_path, ctx.supervisor_conf_path, context=_supervisor_dict(ctx), use_sudo=True)
 
-def install_supervisor():
-    require('environment', 'project_root', 'virtualenv_root', 'sudo_user', provided_by='setup_env')
+def install_supervisor(ctx):
+    init_temp_path = '/tmp/supervisor_init.tmp'
+    put(ctx.supervisor_init_path, init_temp_path)
 
+    batch = RemoteBatch()
     #we don't install supervisor in the virtualenv since we want it to be able to run systemwide.
-    sudo('pip install supervisor' % env, pty=True, shell=True)
+    batch.add('pip install supervisor')
 
     #create the standard conf file
-    sudo('echo_supervisord_conf > /tmp/supervisord.conf' % env)
-    sudo('mv /tmp/supervisord.conf /etc/supervisord.conf')
+    batch.add('echo_supervisord_conf > /tmp/supervisord.conf')
+    batch.add('mv /tmp/supervisord.conf /etc/supervisord.conf')
 
     #uncomment the include directive in supervisord.conf so we can point it to our supervisor conf
-    uncomment('/etc/supervisord.conf', '\;\\[include\\]', use_sudo=True, char=';', backup='.bak')
-    sudo("echo 'files = %(supervisor_conf_root)s/*.conf' >> /etc/supervisord.conf" % env)
+    batch.add("sed -i.bak -e 's/^;\\[include\\]/[include]/' /etc/supervisord.conf")
+    batch.add("echo 'files = %(supervisor_conf_root)s/*.conf' >> /etc/supervisord.conf" % ctx)
 
-    init_temp_path = '/tmp/supervisor_init.tmp'
-    put(env.supervisor_init_path, init_temp_path)
-    sudo('chown root %s' % init_temp_path)
-    sudo('chgrp root %s' % init_temp_path)
-    sudo('chmod +x %s' % init_temp_path)
-    sudo('mv %s /etc/init.d/supervisord' % init_temp_path)
-    sudo('chmod +x /etc/init.d/supervisord')
-    if env.os == 'ubuntu':
-        sudo('update-rc.d supervisord defaults')
-    elif env.os == 'redhat':
-        sudo('chkconfig --add supervisord')
-
-    sudo('service supervisord start')
+    batch.add('chown root %s' % init_temp_path)
+    batch.add('chgrp root %s' % init_temp_path)
+    batch.add('chmod +x %s' % init_temp_path)
+    batch.add('mv %s /etc/init.d/supervisord' % init_temp_path)
+    batch.add('chmod +x /etc/init.d/supervisord')
+    if ctx.os == 'ubuntu':
+        batch.add('update-rc.d supervisord defaults')
+    elif ctx.os == 'redhat':
+        batch.add('chkconfig --add supervisord')
+
+    batch.add('service supervisord start')
 
     #update supervisor instance
-    _supervisor_command('update')
+    batch.add('supervisorctl update')
+    batch.execute()
+
+def bootstrap(ctx):
+    """
+    Installs supervisor (unless it was installed the same way already, see the ledger module), creates required
+    directories (if they don't exist). Points supervisord.conf to look in the correct folder for service info
+    """
+    inputs = {'init_script': ledger.file_hash(ctx.supervisor_init_path), 'conf_root': ctx.supervisor_conf_root, 'os': ctx.os}
+    ledger.step(ctx, 'supervisor.install', inputs, install_supervisor, (ctx,))
+    setup_dirs(ctx)
+    upload_sup_template(ctx)
 
-def bootstrap(deploy_level='staging'):
+def deploy(ctx):
     """
-    Installs supervisor, creates required directories (if they don't exist). Points supervisord.conf to look in the correct
-    folder for service info
+    Uploads the supervisor conf and has supervisor pick it up, if it changed.
     """
-    setup_env(deploy_level)
-    install_supervisor()
-    setup_dirs()
-    upload_sup_template()
+    if upload_sup_template(ctx):
+        _supervisor_command('update')
 
 
 def _supervisor_command(command):
-    require('hosts', provided_by=('setup_env'))
     sudo('supervisorctl %s' % command)
\ No newline at end of file
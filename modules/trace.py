@@ -0,0 +1,230 @@
+"""
+Per-step timing.
+
+When tracing is switched on (``trace=<file>`` on any of the fabfile commands), every remote operation (``run``,
+``sudo``, ``put``, ``get`` and ``upload_template``) is timed and recorded along with the host, the module, the step
+(the module function that issued it), the command and the number of bytes sent and received.  Each module's operating
+method is recorded as a span of its own, with its operations nested underneath::
+
+    $ fab staging deploy:trace=deploy_trace.json
+    $ fab production deploy:parallel=16,trace=deploy_trace.json
+    $ fab staging run_command:collectstatic,module=modules.django,trace=collectstatic.json
+
+The file is written in the Chrome trace format: open it in chrome://tracing or https://ui.perfetto.dev to see the
+run on a timeline (one row per host and module).  At the end of the run the slowest steps are printed too.
+
+Trace Settings
+--------------
+::
+
+    TRACE_TOP_STEPS = 10 #How many of the slowest steps are listed at the end of a traced run
+
+"""
+from __future__ import absolute_import
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from fabric import operations
+from fabric.api import env
+from fabric.colors import green
+from fabric.contrib import files
+import settings
+
+_enabled = False
+_events = []
+_current = {'module': None}
+_originals = {} #name -> the fabric function that was wrapped
+
+#modules whose functions are helpers, not steps (the step is whoever called them)
+_HELPER_MODULES = ('modules.trace', 'modules.batch', 'modules.uploads', 'modules.utils', 'modules.connections')
+
+
+def _step():
+    """
+    Returns the name of the innermost function on the stack that belongs to the running module (or to another
+    deploy_tools module).
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        name = frame.f_globals.get('__name__', '')
+        if name == _current['module'] or (name.startswith('modules.') and name not in _HELPER_MODULES):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return None
+
+def _record(cat, name, start, end, **args):
+    _events.append({
+        'cat': cat,
+        'name': name,
+        'host': env.host_string,
+        'module': _current['module'],
+        'step': args.pop('step', None) or _step(),
+        'start': start,
+        'duration': end - start,
+        'args': args,
+    })
+
+def _local_size(local_path):
+    if hasattr(local_path, 'getvalue'):
+        return len(local_path.getvalue())
+    try:
+        return os.path.getsize(os.path.expanduser(local_path))
+    except (OSError, TypeError):
+        return 0
+
+def _traced_run_command(command, *args, **kwargs):
+    if not _enabled:
+        return _originals['_run_command'](command, *args, **kwargs)
+    start = time.time()
+    out = _originals['_run_command'](command, *args, **kwargs)
+    sent = len(command)
+    received = len(out) + len(getattr(out, 'stderr', '') or '')
+    _record(kwargs.get('sudo') and 'sudo' or 'run', command.split('\n')[0][:80], start, time.time(),
+            command=command, bytes_sent=sent, bytes_received=received, return_code=getattr(out, 'return_code', None))
+    return out
+
+def _traced_put(local_path=None, remote_path=None, *args, **kwargs):
+    if not _enabled:
+        return _originals['put'](local_path, remote_path, *args, **kwargs)
+    start = time.time()
+    result = _originals['put'](local_path, remote_path, *args, **kwargs)
+    _record('put', 'put %s' % remote_path, start, time.time(), remote_path=remote_path, bytes_sent=_local_size(local_path))
+    return result
+
+def _traced_get(remote_path, local_path=None, *args, **kwargs):
+    if not _enabled:
+        return _originals['get'](remote_path, local_path, *args, **kwargs)
+    start = time.time()
+    result = _originals['get'](remote_path, local_path, *args, **kwargs)
+    received = sum(_local_size(path) for path in result)
+    _record('get', 'get %s' % remote_path, start, time.time(), remote_path=remote_path, bytes_received=received)
+    return result
+
+def _traced_upload_template(filename, destination, *args, **kwargs):
+    if not _enabled:
+        return _originals['upload_template'](filename, destination, *args, **kwargs)
+    step = _step()
+    start = time.time()
+    result = _originals['upload_template'](filename, destination, *args, **kwargs)
+    _record('upload_template', 'upload_template %s' % destination, start, time.time(), step=step, template=filename,
+            remote_path=destination)
+    return result
+
+_WRAPPERS = {
+    'put': (operations, _traced_put),
+    'get': (operations, _traced_get),
+    'upload_template': (files, _traced_upload_template),
+}
+
+def install():
+    """
+    Wraps fabric's remote operations so they can be timed.  They behave as usual while tracing is off.
+    """
+    if _originals:
+        return
+    _originals['_run_command'] = operations._run_command
+    operations._run_command = _traced_run_command #run() and sudo() both go through this one
+    for name, (module, wrapper) in _WRAPPERS.items():
+        _originals[name] = original = getattr(module, name)
+        #replace every reference to the function, including the ones made with 'from fabric.api import *'
+        for loaded in sys.modules.values():
+            if loaded is not None and getattr(loaded, name, None) is original:
+                setattr(loaded, name, wrapper)
+
+def start():
+    """
+    Starts recording.
+    """
+    global _enabled
+    install()
+    _enabled = True
+
+def enabled():
+    return _enabled
+
+def current_module():
+    """
+    Returns the name of the module whose operating method is running (see module_span), if any.
+    """
+    return _current['module']
+
+@contextmanager
+def module_span(module, cmd):
+    """
+    Records the given module's operating method (and marks the operations done meanwhile as belonging to it).
+    """
+    previous = _current['module']
+    _current['module'] = module
+    start = time.time()
+    try:
+        yield
+    finally:
+        if _enabled:
+            _record('module', '%s.%s' % (module, cmd), start, time.time(), step=cmd)
+        _current['module'] = previous
+
+def take_events():
+    """
+    Returns the events recorded so far in this process, and forgets them (used to hand them from child processes to
+    the main one).
+    """
+    events = _events[:]
+    del _events[:]
+    return events
+
+def add_events(events):
+    _events.extend(events)
+
+_COUNTERS = (('cpu %', ('cpu', 'iowait')), ('memory MB', ('mem_used_mb',)),
+             ('disk MB/s', ('disk_read_mbs', 'disk_write_mbs')), ('net MB/s', ('net_rx_mbs', 'net_tx_mbs')))
+
+def write(path):
+    """
+    Writes the recorded events to a file in the Chrome trace format.
+    """
+    if not _events:
+        return
+    t0 = min(e['start'] for e in _events)
+    pids, tids, trace_events = {}, {}, []
+    for e in sorted(_events, key=lambda e: e['start']):
+        pid = pids.setdefault(e['host'], len(pids) + 1)
+        if e['cat'] == 'sample': #resource samples (see the sampler module) are drawn as graphs
+            for name, keys in _COUNTERS:
+                trace_events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': int((e['start'] - t0) * 1e6),
+                                     'args': dict((key, round(e['args'][key], 2)) for key in keys)})
+            continue
+        tid = tids.setdefault((e['host'], e['module']), len(tids) + 1)
+        args = dict(e['args'], module=e['module'], step=e['step'])
+        trace_events.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                             'ts': int((e['start'] - t0) * 1e6), 'dur': int(e['duration'] * 1e6), 'args': args})
+    for host, pid in pids.items():
+        trace_events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': str(host)}})
+    for (host, module), tid in tids.items():
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[host], 'tid': tid, 'args': {'name': str(module)}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+    print green('Wrote a trace of %d operations to %s (open it in chrome://tracing or ui.perfetto.dev)' % (len(_events), path))
+
+def summary(top=None):
+    """
+    Prints the slowest steps (summed over hosts), with how many remote operations they made.
+    """
+    if top is None:
+        top = getattr(settings, 'TRACE_TOP_STEPS', 10)
+    steps = {}
+    for e in _events:
+        if e['cat'] in ('module', 'upload_template', 'sample'): #spans (their operations are counted already) and samples
+            continue
+        s = steps.setdefault((e['module'], e['step']), {'time': 0.0, 'ops': 0, 'bytes': 0, 'hosts': set()})
+        s['time'] += e['duration']
+        s['ops'] += 1
+        s['bytes'] += e['args'].get('bytes_sent', 0) + e['args'].get('bytes_received', 0)
+        s['hosts'].add(e['host'])
+    if not steps:
+        return
+    print green('========== Slowest steps ==========')
+    print '%-45s %9s %6s %10s %6s' % ('module.step', 'time', 'ops', 'bytes', 'hosts')
+    for (module, step), s in sorted(steps.items(), key=lambda item: -item[1]['time'])[:top]:
+        print '%-45s %8.2fs %6d %10d %6d' % ('%s.%s' % (module, step), s['time'], s['ops'], s['bytes'], len(s['hosts']))
@@ -0,0 +1,84 @@
+"""
+Checksum-gated uploads.
+
+Most deploys don't change any config file, yet re-uploading a config (and reloading the service that reads it) on
+every deploy costs round trips and causes latency blips.  ``upload_if_changed()`` renders a template (or reads a
+plain file) locally, compares its sha1 with the one of the file on the host and only uploads it when they differ.
+It returns whether the file was uploaded, so the caller can reload/restart its service only then::
+
+    if upload_if_changed(ctx.sup_template_path, ctx.supervisor_conf_path, context=_supervisor_dict(ctx), use_sudo=True):
+        sudo('supervisorctl update')
+
+The remote checksums are fetched with ``sha1sum``.  Modules can list the files they manage in a module level
+``managed_files(ctx)`` function; the fabfile asks every module for these before running a command on a
+host and fetches all of their checksums in one go, so checking them costs no further round trips.
+"""
+from __future__ import absolute_import
+import hashlib
+from StringIO import StringIO
+from fabric.api import env
+from fabric.colors import green
+from fabric.context_managers import settings as fab_settings, hide
+from fabric.operations import run, put
+
+_checksums = {} #remote checksums by host, then path.  None for files that don't exist.
+
+
+def _host_checksums():
+    return _checksums.setdefault(env.host_string, {})
+
+def prefetch_checksums(paths):
+    """
+    Fetches the checksums of the given remote files (of the current host) in one round trip.
+    """
+    paths = [p for p in paths if p not in _host_checksums()]
+    if not paths:
+        return
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run('sha1sum %s 2>/dev/null; true' % ' '.join(paths))
+    found = {}
+    for line in out.replace('\r', '').split('\n'):
+        checksum, _, path = line.strip().partition('  ')
+        if path:
+            found[path] = checksum
+    for path in paths:
+        _host_checksums()[path] = found.get(path)
+
+def remote_checksum(path):
+    """
+    Returns the sha1 of a remote file (None if it doesn't exist), fetching it unless it was prefetched.
+    """
+    prefetch_checksums([path])
+    return _host_checksums()[path]
+
+def render(local_path, context=None):
+    """
+    Returns the contents of a local file, filled in with the context like ``upload_template()`` does.
+    """
+    with open(local_path) as f:
+        text = f.read()
+    if context:
+        text = text % context
+    return text
+
+def upload_if_changed(local_path, remote_path, context=None, use_sudo=False, mode=None, staging_path=None):
+    """
+    Uploads the (rendered) local file unless the remote file has the same contents.  Returns True if it was uploaded.
+
+    With ``context=None`` the file is uploaded as is, otherwise it's treated as a template.  With ``staging_path``
+    the file is uploaded there instead, and the caller moves it to ``remote_path``.
+    """
+    text = render(local_path, context)
+    checksum = hashlib.sha1(text).hexdigest()
+    if remote_checksum(remote_path) == checksum:
+        print green('%s is unchanged, not uploading it.' % remote_path)
+        return False
+    put(StringIO(text), staging_path or remote_path, use_sudo=use_sudo, mode=mode)
+    _host_checksums()[remote_path] = checksum
+    return True
+
+def forget(remote_path):
+    """
+    Drops what's known about a remote file's checksum (e.g. after it was moved or changed on the host).
+    """
+    _host_checksums().pop(remote_path, None)
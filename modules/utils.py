@@ -9,29 +9,129 @@ from fabric.context_managers import *
 from fabric.operations import *
 from fabric.contrib import files
 from fabric.api import env
+from fabric.colors import green
+from fabric import utils
+from modules import facts
+from modules.batch import RemoteBatch
+import posixpath
 import sys
 
+#see 'Module dependencies' in the fabfile docs
+REQUIRES = []
+PROVIDES = []
+
+#Only one package manager command (yum, apt-get) can run on a host at a time, see package_lock()
+PACKAGE_LOCK_PATH = '/var/lock/deploy_tools-packages.lock'
+
+#How to list the installed packages / install packages, per OS
+PACKAGE_QUERY_CMDS = {
+    'ubuntu': "dpkg-query -W -f='${Package} ${Status}\\n'",
+    'redhat': "rpm -qa --qf '%{NAME}\\n'",
+}
+PACKAGE_INSTALL_CMDS = {
+    'ubuntu': 'apt-get install -y',
+    'redhat': 'yum install -y',
+}
+
+_installed_packages = {} #package names installed on each host, see installed_packages()
+
 def what_os():
     """
     Returns a string indicating the Host OS.  Currently
     Only supports 'redhat' and 'ubuntu'
+
+    The answer comes from the host facts cache (see the facts module), so the host
+    is only probed when nothing is cached for it yet.
+    """
+    return facts.get_facts()['os']
+
+
+def package_lock(command):
+    """
+    Wraps a package manager command so that it waits for any other package manager command
+    started by deploy tools on the same host.
+
+    Needed when modules are run concurrently (see ``CONCURRENT_MODULES``), since apt-get gives up straight away
+    if another apt-get is holding its lock.
+
+    >>> package_lock('yum install -y git')
+    'flock /var/lock/deploy_tools-packages.lock yum install -y git'
     """
-    with settings(
-        hide('warnings', 'running', 'stdout', 'stderr'),
-        warn_only=True
-    ):
-        print 'Testing operating system type...'
-        if(files.exists('/etc/lsb-release',verbose=True) and files.contains(text='DISTRIB_ID=Ubuntu', filename='/etc/lsb-release')):
-            env.os = 'ubuntu'
-            print 'Found lsb-release and contains "DISTRIB_ID=Ubuntu", this is an Ubuntu System.'
-        elif(files.exists('/etc/redhat-release',verbose=True)):
-            env.os = 'redhat'
-            print 'Found /etc/redhat-release, this is a RedHat system.'
-        else:
-            print 'System OS not recognized! Aborting.'
-            exit()
-        return env.os
+    return 'flock %s %s' % (PACKAGE_LOCK_PATH, command)
+
 
+def installed_packages():
+    """
+    Returns the set of (OS) package names installed on the host.
+
+    The host is only asked once per run; install_missing_packages() keeps the set up to date.
+    """
+    if env.host_string not in _installed_packages:
+        os_name = what_os()
+        with settings(hide('running', 'stdout')):
+            out = run(PACKAGE_QUERY_CMDS[os_name])
+        names = set()
+        for line in out.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            if os_name == 'ubuntu' and not line.strip().endswith('install ok installed'):
+                continue #dpkg also lists removed packages that left their config files behind
+            names.add(fields[0])
+        _installed_packages[env.host_string] = names
+    return _installed_packages[env.host_string]
+
+
+def install_missing_packages(packages):
+    """
+    Installs those of the given (OS) packages that aren't installed yet, in one package manager call.
+    Nothing is run if they're all installed already.
+
+    Returns the list of packages that were installed.
+
+    Packages are matched by name, so list real package names (not 'provides' names or groups,
+    those get handed to the package manager every time).
+    """
+    installed = installed_packages()
+    missing = [p for p in packages if p not in installed]
+    if not missing:
+        print 'All %d packages are already installed.' % len(packages)
+        return []
+    print 'Installing %d of %d packages: %s' % (len(missing), len(packages), ' '.join(missing))
+    sudo(package_lock('%s %s' % (PACKAGE_INSTALL_CMDS[what_os()], ' '.join(missing))))
+    installed.update(missing)
+    return missing
+
+
+def switch_release(live, releases_root, name, keep, user):
+    """
+    Points the 'live' symlink at the given release (a folder in releases_root), with an atomic rename, and removes
+    all but the newest 'keep' releases.  A 'live' that is still a real folder (from before releases were used) is
+    moved into releases_root first.  Used for the django code_root and the virtualenv.
+    """
+    target = posixpath.join(releases_root, name)
+    print green('Switching %s over to %s' % (live, target))
+    with RemoteBatch() as batch:
+        batch.add('if [ -d %(live)s ] && [ ! -L %(live)s ]; then mv %(live)s %(root)s/legacy-$(date +%%s); fi'
+                  % dict(live=live, root=releases_root), user=user)
+        batch.add('ln -sfn %s %s.new' % (target, live), user=user)
+        batch.add('mv -T %s.new %s' % (live, live), user=user)
+        batch.add('touch %s' % target, user=user) #newest first in 'ls -t', see rollback_release()
+        batch.add('cd %s && ls -1t | grep -v -x %s | tail -n +%d | xargs -r rm -rf' % (releases_root, name, keep), user=user)
+
+def rollback_release(live, releases_root, keep, user):
+    """
+    Switches the 'live' symlink back to the complete release (in releases_root) that was live before the current one.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = run('readlink -f %s; cd %s && for d in $(ls -1t); do [ -f $d/.complete ] && echo $d; done; true'
+                  % (live, releases_root))
+    lines = [l.strip() for l in out.replace('\r', '').split('\n') if l.strip()]
+    current = posixpath.basename(lines[0]) if lines else None
+    previous = [name for name in lines[1:] if name != current]
+    if not previous:
+        utils.abort('No earlier release to roll back to in %s' % releases_root)
+    switch_release(live, releases_root, previous[0], keep, user)
 
 def try_import(module_name):
     """
@@ -69,28 +169,28 @@ def try_import(module_name):
         return None
 
 
-def bootstrap(deploy_level='staging'):
+def bootstrap(ctx):
     """
     Does nothing in this module.
     """
     pass
 
 
-def develop(deploy_level='staging'):
+def develop(ctx):
     """
     Does nothing in this module.
     """
     pass
 
 
-def stop(deploy_level='staging'):
+def stop(ctx):
     """
     Does nothing in this module.
     """
     pass
 
 
-def start(deploy_level='staging'):
+def start(ctx):
     """
     Does nothing in this module.
     """
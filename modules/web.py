@@ -25,167 +25,122 @@ from fabric import utils
 from fabric.context_managers import cd
 from fabric.contrib.files import uncomment, upload_template
 from fabric.operations import sudo, require, put
-from fabric.state import env
 from fabric.contrib import files
 from fabric.colors import green, yellow
-from modules.utils import what_os
+from modules.batch import RemoteBatch
+from modules.uploads import upload_if_changed
 from fabric.context_managers import settings as fab_settings
 import settings
 
-
-def setup_env(deploy_level="staging"):
-    if deploy_level == "staging":
-        _staging()
-    elif deploy_level == "production":
-        _production()
-    else:
-        raise Exception("Unrecognized Deploy Level: %s" % deploy_level)
-    env.os = what_os()
-#    env.user = settings.PROJECT_USER
-#    env.sudo_user = settings.SUDO_USER
-    env.project = settings.PROJECT_NAME
-    env.project_root = settings.PROJECT_ROOT % env #remember to pass in the 'env' dict before using this field from settings, since it could contain keywords.
-    env.httpd = settings.WEB_HTTPD
-    env.httpd_local_template_path = settings.WEB_CONFIG_TEMPLATE_PATH
-    httpd_dict = settings.WEB_PARAM_DICT
-    _setup_path()
-
-    #insert some additional useful pairs
-    httpd_dict["code_root"] = env.code_root
-    httpd_dict["log_dir"] = env.log_dir
-    httpd_dict["project"] = env.project
-    httpd_dict["virtualenv_root"] = env.virtualenv_root
-    env.httpd_dict = httpd_dict
-
-def _production():
-    """ use production environment on remote host"""
-    env.environment = 'production'
-    env.server_name = 'project-production.dimagi.com'
-    env.hosts = settings.PRODUCTION_HOST
-
-def _staging():
-    """ use staging environment on remote host"""
-    env.environment = 'staging'
-    env.server_name = 'project-staging.dimagi.com'
-    env.hosts = settings.STAGING_HOST
-
-def _setup_path():
+#see 'Module dependencies' in the fabfile docs.  Apache itself comes from the os module.
+REQUIRES = ["os_packages"]
+PROVIDES = ["httpd"]
+
+
+def extend_context(ctx):
+    httpd_services_root = posixpath.join(ctx.services_root, 'apache')
+    httpd_services_template_name = '%(project)s.conf' % ctx
+    return ctx.replace(
+        httpd=settings.WEB_HTTPD,
+        httpd_local_template_path=settings.WEB_CONFIG_TEMPLATE_PATH,
+        httpd_services_root=httpd_services_root,
+        httpd_services_template_name=httpd_services_template_name,
+        httpd_remote_services_template_path=posixpath.join(httpd_services_root, httpd_services_template_name),
+        httpd_remote_conf_root=ctx.httpd_conf_root, #from the host's facts
+        httpd_service_name=ctx.httpd_service,
+    )
+
+def _httpd_dict(ctx):
     """
-    Assigns all the various paths that will be needed (to the env object)
-    in deploying code, populating config templates, etc.
+    The params of the httpd conf template, with some additional useful pairs
     """
-    env.sup_template_path = posixpath.join(posixpath.abspath(settings.__file__),settings.SUPERVISOR_TEMPLATE_PATH)
-    env.project_root = settings.PROJECT_ROOT
-    env.www_root = posixpath.join(env.project_root,'www',env.environment)
-    env.log_dir = posixpath.join(env.www_root,'log')
-    env.code_root = posixpath.join(env.www_root,'code_root')
-    env.project_media = posixpath.join(env.code_root, 'media')
-    env.project_static = posixpath.join(env.project_root, 'static')
-    env.virtualenv_name = getattr(settings, 'PYTHON_ENV_NAME', 'python_env') #not a required setting and should be sufficient with default name
-    env.virtualenv_root = posixpath.join(env.www_root, env.virtualenv_name)
-    env.services_root = posixpath.join(env.project_root, 'services')
-    env.httpd_services_root = posixpath.join(env.services_root, 'apache')
-    env.httpd_services_template_name = '%(project)s.conf' % env
-    env.httpd_remote_services_template_path = posixpath.join(env.httpd_services_root,env.httpd_services_template_name)
-    env.supervisor_conf_root = posixpath.join(env.services_root, 'supervisor')
-    env.supervisor_conf_path = posixpath.join(env.supervisor_conf_root, 'supervisor.conf')
-    env.supervisor_init_template_path = settings.SUPERVISOR_INIT_TEMPLATE
-    if env.os == 'ubuntu':
-        env.httpd_remote_conf_root = '/etc/apache2/sites-enabled'
-        env.httpd_user_group = 'www-data'
-    elif env.os == 'redhat':
-        env.httpd_remote_conf_root = '/etc/httpd/conf.d'
-        env.httpd_user_group = 'apache'
-    else:
-        utils.abort('In Web module. Remote operating system ("%(os)s") not recognized. Aborting.' % env)
-
-
-
-def setup_dirs():
-    """ create (if necessary) and make writable uploaded media, log, etc. directories """
-    if not files.exists(env.log_dir):
-        print green('Log Directory (%s) does not exist on host, creating...' % env.log_dir)
-        sudo('mkdir -p %(log_dir)s' % env)
-        sudo('chmod a+w %(log_dir)s' % env)
+    httpd_dict = dict(settings.WEB_PARAM_DICT)
+    httpd_dict["code_root"] = ctx.code_root
+    httpd_dict["log_dir"] = ctx.log_dir
+    httpd_dict["project"] = ctx.project
+    httpd_dict["virtualenv_root"] = ctx.virtualenv_root
+    return httpd_dict
+
+def managed_files(ctx):
+    """
+    The config files this module uploads (see the uploads module).
+    """
+    return [posixpath.join(ctx.services_root, 'apache', '%s.conf' % ctx.project)]
 
-    if not files.exists(env.httpd_services_root):
-        print green('Services/apache Directory (%(httpd_services_root)s) does not exist on host, creating...' % env)
-        sudo('mkdir -p %(httpd_services_root)s' % env)
-        sudo('chmod a+w %(httpd_services_root)s' % env)
+
+def setup_dirs(ctx):
+    """ create (if necessary) and make writable uploaded media, log, etc. directories """
+    print green('Making sure the log (%(log_dir)s) and services/apache (%(httpd_services_root)s) directories exist...' % ctx)
+    with RemoteBatch() as batch:
+        batch.add('mkdir -p %(log_dir)s' % ctx)
+        batch.add('chmod a+w %(log_dir)s' % ctx)
+        batch.add('mkdir -p %(httpd_services_root)s' % ctx)
+        batch.add('chmod a+w %(httpd_services_root)s' % ctx)
 
 
-def bootstrap(deploy_level="staging"):
+def bootstrap(ctx):
     """
-    Sets up log directories if they don't exist, uploads the apache conf and reloads apache.
+    Sets up log directories if they don't exist, uploads the apache conf and reloads apache (if the conf changed).
     """
     print green("In Web Module, bootstrap().")
-    setup_env(deploy_level)
-    setup_dirs()
-    start_apache() #reload fails if we don't start apache for the first time
-    upload_apache_conf()
-    reload_apache()
+    setup_dirs(ctx)
+    start_apache(ctx) #reload fails if we don't start apache for the first time
+    if upload_apache_conf(ctx):
+        reload_apache(ctx)
     print green("Done bootstrapping web module")
 
-def deploy():
+def deploy(ctx):
     """
-    Uploads the httpd conf (apache or nginx in future) to the correct place.
+    Uploads the httpd conf (apache or nginx in future) to the correct place, and reloads apache if it changed.
     """
-    upload_apache_conf()
-    reload_apache()
+    if upload_apache_conf(ctx):
+        reload_apache(ctx)
 
-def upload_apache_conf():
+def upload_apache_conf(ctx):
     """
     Upload and link Supervisor configuration from the template.
+
+    Nothing is done (and False is returned) if the conf on the host is already up to date.
     """
-    require('environment', 'httpd_services_template_name', provided_by=('setup_env'))
-    env.tmp_destination = posixpath.join('/', 'tmp', env.httpd_services_template_name)
-    files.upload_template(env.httpd_local_template_path, env.tmp_destination, context=env.httpd_dict, use_sudo=True)
-    env.httpd_sudo_user = settings.SUDO_USER
-    sudo('chown -R %(httpd_sudo_user)s %(tmp_destination)s' % env)
-    sudo('chgrp -R %(httpd_user_group)s %(tmp_destination)s' % env)
-    sudo('chmod -R g+w %(tmp_destination)s' % env)
-    sudo('mv -f %(tmp_destination)s %(httpd_remote_services_template_path)s' % env)
-    if env.os == 'ubuntu':
-        sudo('a2enmod proxy')
-        sudo('a2enmod proxy_http')
+    ctx = ctx.replace(tmp_destination=posixpath.join('/', 'tmp', ctx.httpd_services_template_name),
+                      httpd_sudo_user=settings.SUDO_USER)
+    if not upload_if_changed(ctx.httpd_local_template_path, ctx.httpd_remote_services_template_path, context=_httpd_dict(ctx),
+                             use_sudo=True, staging_path=ctx.tmp_destination):
+        return False
+    batch = RemoteBatch()
+    batch.add('chown -R %(httpd_sudo_user)s %(tmp_destination)s' % ctx)
+    batch.add('chgrp -R %(httpd_user_group)s %(tmp_destination)s' % ctx)
+    batch.add('chmod -R g+w %(tmp_destination)s' % ctx)
+    batch.add('mv -f %(tmp_destination)s %(httpd_remote_services_template_path)s' % ctx)
+    if ctx.os == 'ubuntu':
+        batch.add('a2enmod proxy')
+        batch.add('a2enmod proxy_http')
     #should already be enabled for redhat
-    elif env.os != 'redhat':
+    elif ctx.os != 'redhat':
         utils.abort('OS Not recognized in Web Module')
-    with(fab_settings(warn_only=True)):
-        sudo('rm %(httpd_remote_conf_root)s/%(project)s' % env)
-    sudo('ln -s %(httpd_remote_services_template_path)s %(httpd_remote_conf_root)s/%(project)s' % env) #symbolic link our apache conf to the 'sites-enabled' folder
+    batch.add('rm %(httpd_remote_conf_root)s/%(project)s' % ctx, warn_only=True)
+    batch.add('ln -s %(httpd_remote_services_template_path)s %(httpd_remote_conf_root)s/%(project)s' % ctx) #symbolic link our apache conf to the 'sites-enabled' folder
+    batch.execute()
+    return True
 
-def run_apache_command(command):
+def run_apache_command(ctx, command):
     """
     Runs the given command on the apache service
     """
-    require('os', provided_by=('setup_env'))
-    if env.os == 'ubuntu':
-        httpd_service_name = 'apache2'
-    elif env.os == 'redhat':
-        httpd_service_name = 'httpd'
-    else:
-        utils.abort('OS Not recognized in Web Module')
-    #execute the command
-    sudo('/etc/init.d/%s %s' % (httpd_service_name, command))
+    sudo('/etc/init.d/%s %s' % (ctx.httpd_service_name, command))
 
 #convenience functions:
-def restart_apache():
-    require('os', provided_by=('setup_env'))
-    run_apache_command('restart')
+def restart_apache(ctx):
+    run_apache_command(ctx, 'restart')
 
-def stop_apache():
-    require('os', provided_by=('setup_env'))
-    run_apache_command('stop')
+def stop_apache(ctx):
+    run_apache_command(ctx, 'stop')
 
-def start_apache():
-    require('os', provided_by=('setup_env'))
-    run_apache_command('start')
+def start_apache(ctx):
+    run_apache_command(ctx, 'start')
 
-def reload_apache():
-    require('os', provided_by=('setup_env'))
-    run_apache_command('reload')
+def reload_apache(ctx):
+    run_apache_command(ctx, 'reload')
 
-def status_apache():
-    require('os', provided_by=('setup_env'))
-    run_apache_command('status')
\ No newline at end of file
+def status_apache(ctx):
+    run_apache_command(ctx, 'status')
\ No newline at end of file